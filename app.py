@@ -3,9 +3,19 @@ import os
 import json
 import ollama
 import app_models
+import app_archive
 import app_images
+import app_fanout
+import app_context
+import app_metrics
+import app_reasoning
+import app_responses
+import app_saver
+import app_scheduler
+import app_search
+import app_storage
 import app_threads
-from time import sleep
+from time import sleep, perf_counter
 import streamlit as st
 from typing import Literal
 from datetime import datetime
@@ -70,6 +80,17 @@ if 'initial_message' not in st.session_state:
 if "messages" not in st.session_state:
     st.session_state.messages = st.session_state.initial_message
 
+# Number of latest messages rendered, older ones are rendered on demand:
+if 'history_page' not in st.session_state:
+    st.session_state.history_page = 20
+
+if 'history_window' not in st.session_state:
+    st.session_state.history_window = st.session_state.history_page
+
+# Number of older messages of the thread not loaded from the storage yet (only the latest ones are loaded first):
+if 'messages_offset' not in st.session_state:
+    st.session_state.messages_offset = 0
+
 if 'last_saved' not in st.session_state:
     st.session_state.last_saved = None
 
@@ -87,6 +108,46 @@ if 'folder' not in st.session_state:
         if not os.path.exists(folders):
             os.makedirs(folders)
 
+# Storage backend of the threads, "folder" (json files) or "sqlite" (see app_storage.py):
+if 'storage' not in st.session_state:
+    st.session_state.storage = os.environ.get("LOCALGPT_STORAGE", "folder")
+
+app_storage.configure(st.session_state.storage)
+
+# Generation options of the model (None = model's default):
+if 'options' not in st.session_state:
+    st.session_state.options = {"temperature": None, "seed": None}
+
+if 'cache_responses' not in st.session_state:
+    st.session_state.cache_responses = False
+
+# Cache of the deterministic responses (shared by all sessions, created only once):
+app_responses.configure(
+    cache_folder=os.path.join(st.session_state.folder['temp'], "responses"))
+
+# Base64s of the images evicted from memory are kept on disk (under the threads folder), so they are not encoded again:
+app_images.configure_base64_cache(
+    max_bytes=256 * 1024 * 1024,
+    disk_folder=os.path.join(st.session_state.folder['threads'], ".cache", "base64"),
+    disk_max_bytes=1024 * 1024 * 1024
+)
+
+# Deleted threads (left by earlier runs) are archived in background, once per session:
+if 'archived' not in st.session_state:
+    st.session_state.archived = app_archive.schedule_archiving(
+        deleted_threads_folder=st.session_state.folder['deleted_threads'],
+        deleted_images_folder=st.session_state.folder['deleted_images']
+    )
+
+# Compare mode (one prompt to many models at once):
+if 'compare' not in st.session_state:
+    st.session_state.compare = {
+        "enabled": False, "models": [], "concurrency": app_fanout.DEFAULT_CONCURRENCY}
+
+# Answers of the compare mode, waiting for the user to choose one:
+if 'comparison' not in st.session_state:
+    st.session_state.comparison = None
+
 if 'config_file' not in st.session_state:
     # ./threads/config.json
     st.session_state.config_file = f"_configs.json"
@@ -121,16 +182,30 @@ def write_as_ai(message: str):
         message (string): Content to write into that entry
     """
     with st.chat_message("assistant", avatar=st.session_state.icons["assistant"]):
-        msg = message['content']
-        if "<think>" in msg:
-            ind = msg.find("</think>") + len("</think>")
-            th = msg[8: ind-9]
-            rs = msg[ind:]
-
-            st.expander(label="Think", expanded=False, icon="💭").markdown(th)
-            st.markdown(rs)
-        else:
-            st.markdown(message['content'])
+        # New messages have the reasoning stored separately, older ones are parsed (cached)
+        reasoning = message.get('reasoning')
+        answer = message['content']
+        if reasoning is None and "<think>" in answer:
+            reasoning, answer = app_reasoning.split_reasoning(answer)
+
+        if reasoning:
+            st.expander(label="Think", expanded=False,
+                        icon="💭").markdown(reasoning)
+        st.markdown(answer)
+
+        if message.get('incomplete'):
+            st.caption("⚠️ Incomplete response, generation was interrupted.")
+
+        if 'metrics' in message:
+            st.caption(app_metrics.format_metrics(message['metrics']))
+
+        # Answers of other models, when this one was chosen in compare mode:
+        if message.get('alternatives'):
+            alt = st.expander(
+                label=f"Other models' answers ({len(message['alternatives'])})", expanded=False, icon="🔀")
+            for alternative in message['alternatives']:
+                alt.markdown(f"**{alternative['model']}:**")
+                alt.markdown(alternative['content'])
 
 
 def write_as_user(message: str):
@@ -151,9 +226,11 @@ def write_as_user(message: str):
         if 'image_files' in message:
             # Debug: st.info(message['image_files'])
 
+            # Thumbnails are cached, so that full images are not read and sent on every rerun
             if len(message['image_files']) == 1:
                 st.image(
-                    os.path.join(image_folder, message['image_files'][0]),
+                    app_images.get_thumbnail(
+                        os.path.join(image_folder, message['image_files'][0])),
                     width=200
                 )
 
@@ -163,7 +240,8 @@ def write_as_user(message: str):
 
                 for i, image_file in enumerate(message['image_files']):
                     col_list[i].image(
-                        os.path.join(image_folder, image_file),
+                        app_images.get_thumbnail(
+                            os.path.join(image_folder, image_file)),
                         # use_column_width=True
                         use_container_width=True
                     )
@@ -176,12 +254,14 @@ why = """
 """
 
 
-def create_message(role: Literal['user', "assistant"], content: str):
+def create_message(role: Literal['user', "assistant"], content: str, metrics: dict = None, reasoning: str = None):
     """Creates a new message and appends it to the thread
 
     Args:
         role (Literal['user', "assistant"]): Role of the message (User or AI)
         content (str): Content of the message
+        metrics (dict, optional): Generation metrics of the response (for AI). Defaults to None.
+        reasoning (str, optional): Thinking part of the response of reasoning models (for AI). Defaults to None.
     """
 
     def handle_error(error_message):
@@ -200,6 +280,11 @@ def create_message(role: Literal['user', "assistant"], content: str):
         if not has_image:
             return {"role": role, "content": content}
 
+        # Images are rejected up front if the selected model is known to be text only:
+        model_info = app_models.get_model_info(st.session_state.model)
+        if model_info and model_info['vision'] is False:
+            return handle_error(f"Model `{st.session_state.model}` does not support images, choose a vision model (👁️) to attach images.")
+
         # Extract the images from the prompt:
         contents = app_images.parse_images_from_prompt(content)
         if contents['status'] == 'error':
@@ -210,26 +295,27 @@ def create_message(role: Literal['user', "assistant"], content: str):
             image_list=contents['image_list'],
             image_folder=st.session_state.folder['images'],
             thread_name=st.session_state.thread_name,
+            model_name=st.session_state.model,
         )
         if resp['status'] == 'error':
             return handle_error(f"Error saving images: {resp['message']} for `{resp['path']}`")
 
-        # Convert the image paths to base64's:
-        b64_img_list = app_images.image_list_to_base64(
-            image_list=resp['image_list'],
-            image_folder=st.session_state.folder['images'],
-            thread_name=st.session_state.thread_name,
-        )
-        if b64_img_list['status'] == 'error':
-            return handle_error(f"Error converting images to base64: {b64_img_list['message']} for `{b64_img_list['path']}`")
+        # Some images failed, continue with the rest and show which ones were skipped:
+        if resp['status'] == 'partial':
+            for error in resp['errors']:
+                st.warning(
+                    f"Skipped image: {error['message']} for `{error['path']}`")
+
+        # Formats are already validated while saving, base64's are created only when the request is sent:
+        mimes = [app_images.get_mime_type(image)
+                 for image in resp['image_list']]
 
         # Construct the message with images
         return {
             "role": role,                                   # ai or user
             # text part of prompt
             "content": contents['prompt'],
-            "images": b64_img_list['result'],               # mime (jpg png)
-            "mimes": b64_img_list['mime_types'],            # image in base64
+            "mimes": mimes,                                 # mime (jpg png)
             # local paths of the images saved
             "image_files": resp['image_list']
         }
@@ -244,6 +330,10 @@ def create_message(role: Literal['user', "assistant"], content: str):
         #   directly the new_msg will be used as returned from the process_user_message()
     else:
         new_msg = {"role": role, "content": content}
+        if reasoning:
+            new_msg["reasoning"] = reasoning
+        if metrics:
+            new_msg["metrics"] = metrics
 
     # Append the new message to the thread:
     st.session_state.messages.append(new_msg)
@@ -256,47 +346,328 @@ def create_message(role: Literal['user', "assistant"], content: str):
 
 
 # Function to get response from the chatbot model:
-def get_response(full_response: bool = False):
+def get_response(full_response: bool = False, status_box=None):
     """Get response from the chatbot model
 
     Args:
         full_response (bool, optional): If True, returns full response at once. Defaults to False.
+        status_box (optional): Streamlit placeholder to show the queue position while waiting. Defaults to None.
 
     Yields:
         str: Response from the large language model.
     """
-    response = ollama.chat(
-        model=st.session_state['model'],
+    # Only the latest messages which fit in the model's token budget are sent:
+    load_messages_for_context(st.session_state['model'])
+    context = app_context.build_context(
         messages=st.session_state['messages'],
-        stream=True,
-        # format='json',
-        format='',
+        model_name=st.session_state['model'],
+        offset=st.session_state.messages_offset,
+        num_ctx=st.session_state.options.get('num_ctx')
+    )
+    st.session_state.context_info = {
+        "tokens": context['tokens'], "dropped": context['dropped']}
+
+    # Attach the base64 images only now, for the messages going to the model:
+    request = app_threads.prepare_messages_for_model(
+        messages=context['messages'],
+        image_folder=st.session_state.folder['images'],
+        thread_name=st.session_state.thread_name,
+        model_name=st.session_state['model']
+    )
+    if request['status'] == 'error':
+        raise ValueError(
+            f"Error converting images to base64: {request['message']} for `{request['path']}`")
+
+    st.session_state.last_metrics = None
+
+    # Chunks received till now, checkpointed to the thread on a throttle (not on every chunk):
+    st.session_state.partial_chunks = []
+
+    # Options which are not set are left to the model's defaults, context size is the one the context was built for:
+    options = app_context.request_options(
+        options={key: value for key, value in st.session_state.options.items()
+                 if value is not None},
+        budget=context['budget']
     )
 
-    # Return is one time statement, but yield is a generator
-    if full_response:
-        return response
-    # It returns one iterator, and then waits for the next response(s) to come
-    # New responses keep on coming, and we can keep on yielding them using that iterator
-    for chunk in response:
-        yield chunk["message"]["content"]
+    # Same deterministic request was answered before, replay it (opt-in):
+    cache_key = None
+    if st.session_state.cache_responses and app_responses.is_deterministic(options):
+        cache_key = app_responses.make_key(
+            model_name=st.session_state['model'],
+            messages=request['messages'],
+            options=options
+        )
+        cached = app_responses.get_response(cache_key)
+
+        if cached:
+            st.session_state.last_metrics = {
+                **(cached['metrics'] or {}), "cached": True}
+            for text in app_responses.replay(cached['text']):
+                st.session_state.partial_chunks.append(text)
+                yield text
+            return
+
+    # Wait for the turn in the scheduler (shared by all the users of this server):
+    scheduler = app_scheduler.scheduler
+    ticket = scheduler.submit(st.session_state['model'])
+
+    try:
+        while not scheduler.wait(ticket, timeout=0.5):
+            if status_box is not None:
+                status_box.info(
+                    f"⏳ Waiting for the model, position {scheduler.position(ticket)} in queue...")
+        if status_box is not None:
+            status_box.empty()
+
+        start_time = perf_counter()
+        ttft = None
+        last_checkpoint_time = start_time
+        last_checkpoint_chars = 0
+        received_chars = 0
+
+        response = ollama.chat(
+            model=st.session_state['model'],
+            messages=request['messages'],
+            stream=True,
+            # format='json',
+            format='',
+            options=options or None,
+        )
+
+        # Return is one time statement, but yield is a generator
+        if full_response:
+            return response
+        # It returns one iterator, and then waits for the next response(s) to come
+        # New responses keep on coming, and we can keep on yielding them using that iterator
+        for chunk in response:
+            if ttft is None and chunk["message"]["content"]:
+                ttft = perf_counter() - start_time
+
+            # Last chunk has the counts and durations of the generation:
+            if chunk["done"]:
+                st.session_state.last_metrics = app_metrics.collect_metrics(
+                    final_chunk=chunk,
+                    model_name=st.session_state['model'],
+                    ttft=ttft
+                )
+
+            st.session_state.partial_chunks.append(chunk["message"]["content"])
+            received_chars += len(chunk["message"]["content"])
+
+            due = (
+                perf_counter() - last_checkpoint_time >= app_threads.CHECKPOINT_SECONDS
+                or received_chars - last_checkpoint_chars >= app_threads.CHECKPOINT_CHARS
+            )
+            if due and not chunk["done"]:
+                # Saved in the background, newer checkpoints replace the pending one:
+                app_saver.saver.submit(
+                    messages=st.session_state.messages + [app_threads.make_partial_message(
+                        "".join(st.session_state.partial_chunks))],
+                    thread_name=st.session_state.thread_name,
+                    model_name=st.session_state.model,
+                    thread_folder=st.session_state.folder['threads'],
+                    offset=st.session_state.messages_offset
+                )
+                last_checkpoint_time = perf_counter()
+                last_checkpoint_chars = received_chars
+
+            yield chunk["message"]["content"]
+
+    finally:
+        # Slot is freed even if the stream failed or was stopped
+        scheduler.release(ticket)
+
+    # Whole response is received, cache it for the same request next time:
+    if cache_key:
+        app_responses.put_response(
+            key=cache_key,
+            text="".join(st.session_state.partial_chunks),
+            metrics=st.session_state.last_metrics
+        )
+
+
+def write_response_stream(container):
+    """Writes the response of the model live, thinking goes in a collapsed expander and answer in the main area
+
+    Args:
+        container: Streamlit container to write the response in
+
+    Returns:
+        tuple: (answer, reasoning) of the response, reasoning is None if model did not think
+    """
+    splitter = app_reasoning.ReasoningSplitter()
+
+    # Expander is created only if the model starts thinking, above the answer
+    think_slot = container.container()
+    think_box = None
+    answer_box = container.empty()
+
+    def show(parts):
+        nonlocal think_box
+        kinds = {kind for kind, _ in parts}
+
+        if "reasoning" in kinds:
+            if think_box is None:
+                think_box = think_slot.expander(
+                    label="Thinking...", expanded=False, icon="💭").empty()
+            think_box.markdown("".join(splitter.reasoning))
+
+        if "answer" in kinds:
+            answer_box.markdown("".join(splitter.answer) + "▌")
+
+    for text in get_response(status_box=answer_box):
+        show(splitter.feed(text))
+    show(splitter.finish())
+
+    answer_box.markdown(splitter.get_answer())
+    return splitter.get_answer(), splitter.get_reasoning()
+
+
+def write_comparison_stream(model_names: list[str]):
+    """Sends the prompt to all the models at once and writes their responses side by side
+
+    Args:
+        model_names (list[str]): Models to compare
+
+    Returns:
+        list: List of answers (dicts with model, content, reasoning, metrics and error)
+    """
+    options = {key: value for key, value in st.session_state.options.items()
+               if value is not None}
+
+    # Every model gets its own context window (and num_ctx) and image sizes:
+    model_requests = {}
+    model_options = {}
+    for model_name in model_names:
+        load_messages_for_context(model_name)
+        context = app_context.build_context(
+            messages=st.session_state.messages,
+            model_name=model_name,
+            offset=st.session_state.messages_offset,
+            num_ctx=options.get('num_ctx')
+        )
+        request = app_threads.prepare_messages_for_model(
+            messages=context['messages'],
+            image_folder=st.session_state.folder['images'],
+            thread_name=st.session_state.thread_name,
+            model_name=model_name
+        )
+        if request['status'] == 'error':
+            raise ValueError(
+                f"Error converting images to base64: {request['message']} for `{request['path']}`")
+        model_requests[model_name] = request['messages']
+        model_options[model_name] = app_context.request_options(
+            options, context['budget'])
+
+    answers = {}
+    columns = st.columns(len(model_names))
+    for col, model_name in zip(columns, model_names):
+        col.caption(f"**{model_name}**")
+        answers[model_name] = {
+            "splitter": app_reasoning.ReasoningSplitter(),
+            "think_slot": col.container(),
+            "think_box": None,
+            "answer_box": col.empty(),
+            "metrics": None,
+            "error": None,
+        }
+
+    events = app_fanout.fan_out(
+        model_requests=model_requests,
+        options=model_options,
+        max_concurrency=st.session_state.compare['concurrency']
+    )
+
+    for kind, model_name, value in events:
+        answer = answers[model_name]
+
+        if kind == "chunk":
+            parts = answer['splitter'].feed(value)
+        elif kind == "done":
+            parts = answer['splitter'].finish()
+            answer['metrics'] = value
+        else:
+            answer['error'] = value
+            answer['answer_box'].error(value)
+            continue
+
+        if any(part_kind == "reasoning" for part_kind, _ in parts):
+            if answer['think_box'] is None:
+                answer['think_box'] = answer['think_slot'].expander(
+                    label="Thinking...", expanded=False, icon="💭").empty()
+            answer['think_box'].markdown(
+                "".join(answer['splitter'].reasoning))
+
+        if any(part_kind == "answer" for part_kind, _ in parts):
+            answer['answer_box'].markdown(
+                "".join(answer['splitter'].answer))
+
+    return [
+        {
+            "model": model_name,
+            "content": answers[model_name]['splitter'].get_answer(),
+            "reasoning": answers[model_name]['splitter'].get_reasoning(),
+            "metrics": answers[model_name]['metrics'],
+            "error": answers[model_name]['error'],
+        }
+        for model_name in model_names
+    ]
+
+
+def keep_comparison_answer(choice: int):
+    """Keeps the chosen answer of compare mode in the thread, other answers are stored as its alternatives
+
+    Args:
+        choice (int): Index of the chosen answer
+    """
+    comparison = st.session_state.comparison
+    chosen = comparison[choice]
+
+    new_msg = {"role": "assistant", "content": chosen['content']}
+    if chosen['reasoning']:
+        new_msg['reasoning'] = chosen['reasoning']
+    if chosen['metrics']:
+        new_msg['metrics'] = chosen['metrics']
+
+    new_msg['alternatives'] = [
+        {key: answer[key] for key in ("model", "content", "reasoning", "metrics")}
+        for ind, answer in enumerate(comparison)
+        if ind != choice and not answer['error']
+    ]
+
+    st.session_state.messages.append(new_msg)
+    st.session_state.comparison = None
+
+    app_saver.saver.submit(
+        messages=st.session_state.messages,
+        thread_name=st.session_state.thread_name,
+        model_name=st.session_state.model,
+        thread_folder=st.session_state.folder['threads'],
+        offset=st.session_state.messages_offset
+    )
 
 
 # ---------------------------------------------------------------------------------------
 # Thread Functions:
 # ---------------------------------------------------------------------------------------
 
-def load_conversation_helper_fn(thread_name: str):
-    """Helper function to load the conversation of the selected thread
+def load_conversation_helper_fn(thread_name: str, message_index: int = None):
+    """Helper function to load the conversation of the selected thread (only its latest messages, older ones on demand)
 
     Args:
         thread_name (str): Name of the thread to load
+        message_index (int, optional): Message which must be loaded and shown (e.g. search hit). Defaults to None.
     """
+    # Pending saves are written first, so the latest state of the thread is loaded:
+    app_saver.saver.flush()
+
     # Load the conversation from the thread:
     resp = app_threads.load_conversation(
         thread_name=thread_name,
         thread_folder=st.session_state.folder['threads'],
-        image_folder=st.session_state.folder['images']
+        image_folder=st.session_state.folder['images'],
+        tail=st.session_state.history_page
     )
 
     if resp['status'] == 'error':
@@ -304,12 +675,67 @@ def load_conversation_helper_fn(thread_name: str):
         st.error(f"Error: {resp['message']}")
     else:
         st.session_state.messages = resp['messages']
+        st.session_state.messages_offset = resp['offset']
+        st.session_state.history_window = st.session_state.history_page
         st.session_state.thread_name = resp['thread_name']
         st.session_state.model = resp['model_name']
         st.session_state.last_saved = resp['last_saved']
+
+        # Older messages till the asked one are loaded and shown as well:
+        if message_index is not None and message_index < st.session_state.messages_offset:
+            load_older_messages(
+                st.session_state.messages_offset - message_index)
+        if message_index is not None:
+            st.session_state.history_window = max(
+                st.session_state.history_window,
+                st.session_state.messages_offset + len(st.session_state.messages) - message_index)
+
+        # Start loading the thread's model now, rather than on the first prompt:
+        app_models.prewarm_model(st.session_state.model)
         # st.rerun()
 
 
+def load_older_messages(count: int):
+    """Load the older messages of the thread from the storage and put them before the loaded ones
+
+    Args:
+        count (int): Number of older messages to load
+
+    Returns:
+        bool: True if messages were loaded
+    """
+    start = max(0, st.session_state.messages_offset - count)
+    resp = app_threads.load_messages(
+        thread_name=st.session_state.thread_name,
+        thread_folder=st.session_state.folder['threads'],
+        start=start,
+        end=st.session_state.messages_offset
+    )
+
+    if resp['status'] == 'error':
+        st.error(f"Error: {resp['message']}")
+        return False
+
+    st.session_state.messages = resp['messages'] + st.session_state.messages
+    st.session_state.messages_offset = start
+    return True
+
+
+def load_messages_for_context(model_name: str):
+    """Load the older messages of the thread, as long as they may still fit in the context of the model
+
+    Args:
+        model_name (str): Name of the model
+    """
+    budget = app_context.get_context_budget(
+        model_name, st.session_state.options.get('num_ctx'))
+    while st.session_state.messages_offset:
+        tokens = sum(app_context.count_tokens(message)
+                     for message in st.session_state.messages)
+        if tokens >= budget or not load_older_messages(st.session_state.history_page):
+            return
+
+
 def delete_thread_helper_fn(
         thread_name: str
 ):
@@ -318,6 +744,9 @@ def delete_thread_helper_fn(
     Args:
         thread_name (str): Name of the thread to delete
     """
+    # Pending saves are written first, so they do not bring the thread back after it is deleted:
+    app_saver.saver.flush()
+
     # Delete the thread:
     resp = app_threads.delete_thread(
         thread_name=thread_name,
@@ -334,11 +763,40 @@ def delete_thread_helper_fn(
         st.session_state.thread_name = "New Thread"
         new_thread_name = st.session_state.thread_name
         st.session_state.pop('messages')
+        st.session_state.messages_offset = 0
+        st.session_state.history_window = st.session_state.history_page
+
+        # Deleted thread is packed in an archive in background:
+        app_archive.schedule_archiving(
+            deleted_threads_folder=st.session_state.folder['deleted_threads'],
+            deleted_images_folder=st.session_state.folder['deleted_images']
+        )
 
         st.toast(f"Thread `{thread_name}` deleted successfully!",
                  icon=st.session_state.icons['delete_thread'])
         # st.rerun()
 
+
+def restore_thread_helper_fn(archive_name: str):
+    """Helper function to restore the archived thread and load it
+
+    Args:
+        archive_name (str): Name of the archive to restore
+    """
+    resp = app_archive.restore_thread(
+        archive_name=archive_name,
+        deleted_threads_folder=st.session_state.folder['deleted_threads'],
+        thread_folder=st.session_state.folder['threads'],
+        image_folder=st.session_state.folder['images']
+    )
+
+    if resp['status'] == 'error':
+        st.error(f"Error in restoring thread: {resp['message']}")
+    else:
+        load_conversation_helper_fn(resp['thread_name'])
+        st.toast(f"Thread `{resp['thread_name']}` restored successfully!",
+                 icon=st.session_state.icons['save_thread'])
+
 # ---------------------------------------------------------------------------------------
 # Sidebar Actions:
 # ---------------------------------------------------------------------------------------
@@ -348,21 +806,21 @@ st.sidebar.title(":gear: :orange[Customize here:] ")
 # st.sidebar.markdown("---")
 
 
-# Load Model:
-all_models = ollama.list()["models"]
-actual_names = [model['model'] for model in all_models]
+# Load Model (from the registry, it is refreshed in background and shared by all sessions):
+all_models = app_models.get_models()
+actual_names = [model['name'] for model in all_models]
 
 # Update the model name if the default set model is not available:
 if st.session_state.default_model not in actual_names:
     st.session_state.model = actual_names[0]
 
 available_models = []
-for model in ollama.list()["models"]:
-    model_family = model['details']['family'].ljust(8)
-    model_parameters = model['details']['parameter_size'].rjust(8)
-    model_name = model['model']
-    # available_models.append(f'{model_family}{model_parameters} : {model_name}')
-    available_models.append(f'{model_name} {model_parameters}')
+for model in all_models:
+    model_parameters = model['parameter_size'].rjust(8)
+    model_name = model['name']
+    # Vision models are marked, as only they can take the image attachments
+    vision_mark = " 👁️" if model['vision'] else ""
+    available_models.append(f'{model_name} {model_parameters}{vision_mark}')
 
 
 def model_mapper(model_name: str):
@@ -381,10 +839,63 @@ selected_model = st.sidebar.selectbox(
     help="Choose the model you want to use for the chatbot. Figures on the right are model parameter size",
     index=actual_names.index(st.session_state.model)
 )
+# Model switched from the sidebar, start loading it in background:
+if model_mapper(selected_model) != st.session_state.model:
+    app_models.prewarm_model(model_mapper(selected_model))
+
 st.session_state.model = model_mapper(selected_model)
 # st.write(st.session_state.model)
 
 
+# Generation options:
+options_sec = st.sidebar.expander("Generation Options:", expanded=False)
+st.session_state.options['temperature'] = options_sec.number_input(
+    label="Temperature:",
+    min_value=0.0,
+    max_value=2.0,
+    value=st.session_state.options['temperature'],
+    step=0.1,
+    placeholder="Model default",
+    help="Leave empty to use the model's default. 0 gives the same response every time."
+)
+st.session_state.options['seed'] = options_sec.number_input(
+    label="Seed:",
+    min_value=0,
+    value=st.session_state.options['seed'],
+    step=1,
+    placeholder="Random",
+    help="Fixed seed gives the same response for the same request."
+)
+st.session_state.cache_responses = options_sec.checkbox(
+    label="Cache deterministic responses",
+    value=st.session_state.cache_responses,
+    help="If temperature is 0 or seed is fixed, same request is answered from the cache instead of the model."
+)
+
+# Compare mode:
+compare_sec = st.sidebar.expander("Compare Models:", expanded=False)
+st.session_state.compare['enabled'] = compare_sec.toggle(
+    label="Send prompt to many models",
+    value=st.session_state.compare['enabled'],
+    help="Prompt is sent to all the selected models at once, their answers are shown side by side and you keep the one you like."
+)
+compare_labels = compare_sec.multiselect(
+    label="Models to compare:",
+    options=available_models,
+    default=[label for label in available_models
+             if model_mapper(label) in st.session_state.compare['models']],
+    max_selections=4,
+)
+st.session_state.compare['models'] = [
+    model_mapper(label) for label in compare_labels]
+st.session_state.compare['concurrency'] = compare_sec.slider(
+    label="Models generating at once:",
+    min_value=1,
+    max_value=4,
+    value=st.session_state.compare['concurrency'],
+    help="More models at once needs more (V)RAM, else the models keep swapping."
+)
+
 # st.sidebar.markdown("---")
 
 ex = st.sidebar.expander("Features of App:")
@@ -400,18 +911,24 @@ a.header(":green[Current Thread:]")
 btn = b.button("✍️", type='secondary', help="Create a new thread")
 
 if btn:
+    # Pending saves are written first, so the new name does not clash with a thread being saved:
+    app_saver.saver.flush()
+
     resp = app_threads.create_new_thread(
         thread_folder=st.session_state.folder['threads'])
 
     st.session_state.thread_name = resp
     st.session_state.messages = st.session_state.initial_message
+    st.session_state.messages_offset = 0
+    st.session_state.history_window = st.session_state.history_page
     st.session_state.last_saved = None
 
-    save_resp = app_threads.save_conversation(
+    app_saver.saver.submit(
         messages=st.session_state.messages,
         thread_name=st.session_state.thread_name,
         model_name=st.session_state.model,
-        thread_folder=st.session_state.folder['threads']
+        thread_folder=st.session_state.folder['threads'],
+        offset=st.session_state.messages_offset
     )
 
     st.toast("New thread created successfully!",
@@ -429,7 +946,9 @@ new_thread_name = cont.text_input(
 
 # Rename thread file if name changed
 if new_thread_name != st.session_state.thread_name:
-    # rename_thread(new_thread_name)
+    # Pending saves of the old name are written first, so the renamed thread is complete:
+    app_saver.saver.flush()
+
     resp = app_threads.rename_thread(
         old_thread_name=st.session_state.thread_name,
         new_thread_name=new_thread_name,
@@ -442,20 +961,68 @@ if new_thread_name != st.session_state.thread_name:
     else:
         st.session_state.thread_name = new_thread_name
 
-        app_threads.save_conversation(
+        app_saver.saver.submit(
             messages=st.session_state.messages,
             thread_name=st.session_state.thread_name,
             model_name=st.session_state.model,
-            thread_folder=st.session_state.folder['threads']
+            thread_folder=st.session_state.folder['threads'],
+            offset=st.session_state.messages_offset
         )
 
         st.toast("Thread renamed successfully!",
                  icon=st.session_state.icons['rename_thread'])
 
 
-# Show last saved timestamp (below thread name)
-if st.session_state.last_saved:
-    cont.caption(f"Last saved: {st.session_state.last_saved}")
+# Show last saved timestamp (below thread name), time of the last save which is actually on the disk:
+# Saves are written in the background, so the caption refreshes itself (without rerunning the whole app) once they land
+@st.fragment(run_every=1)
+def show_save_status():
+    save_status = app_saver.saver.status(
+        thread_name=st.session_state.thread_name,
+        thread_folder=st.session_state.folder['threads']
+    )
+    if save_status['last_saved']:
+        st.session_state.last_saved = save_status['last_saved']
+
+    if save_status['error']:
+        st.error(f"Error: {save_status['error']}")
+
+    if st.session_state.last_saved:
+        st.caption(f"Last saved: {st.session_state.last_saved}" +
+                   (" (saving...)" if save_status['pending'] else ""))
+
+
+with cont:
+    show_save_status()
+
+
+# Search the messages of all threads:
+search_query = st.sidebar.text_input(
+    label="Search threads:",
+    placeholder="Search in all conversations...",
+    help="Searches the contents of all the threads, best matches first."
+)
+
+if search_query:
+    hits = app_search.search(
+        query=search_query,
+        thread_folder=st.session_state.folder['threads'],
+        limit=10
+    )
+    search_sec = st.sidebar.container(border=True)
+
+    if not hits:
+        search_sec.caption("No matches found.")
+
+    for hit_no, hit in enumerate(hits):
+        search_sec.button(
+            label=f"{hit['thread_name']} : {hit['snippet'][:60]}",
+            key=f"search_{hit_no}",
+            help=hit['snippet'],
+            use_container_width=True,
+            on_click=lambda i=hit['thread_name'], ind=hit['index']: load_conversation_helper_fn(
+                i, ind),
+        )
 
 
 # load all the saved thread names using files:
@@ -470,11 +1037,17 @@ thread_buttons, thread_deletes = st.sidebar.columns([.95, .05], gap='small')
 threads_btn = []
 threads_dlt = []
 for ind, i in enumerate(threads):
+    # Model and size of the thread come from the storage's index, the thread itself is not read:
+    info = app_threads.get_thread_info(
+        thread_name=i,
+        thread_folder=st.session_state.folder['threads'])
+
     threads_btn.append(
         # st.sidebar.button(
         thread_buttons.button(
             label=i,
             key=f't_{i}',
+            help=f"{info['model'] or 'Unknown model'}, {info['messages']} messages, last saved {info['last_saved'] or '-'}" if info else None,
             use_container_width=True,
             on_click=lambda i=i: load_conversation_helper_fn(i),
             disabled=True if i == st.session_state.thread_name else False
@@ -491,6 +1064,26 @@ for ind, i in enumerate(threads):
         )
     )
 
+# Archived (deleted) threads, can be restored:
+deleted_sec = st.sidebar.expander("Deleted Threads:", expanded=False)
+if deleted_sec.toggle("Show archived threads", key="show_archives"):
+    archives = app_archive.list_archives(
+        st.session_state.folder['deleted_threads'])
+
+    if not archives:
+        deleted_sec.caption("No archived threads.")
+
+    for archive in archives:
+        deleted_sec.button(
+            label=f"♻️ {archive['archive']}",
+            key=f"restore_{archive['archive']}",
+            help=f"Restore this thread. {archive.get('messages', '?')} messages, "
+                 f"{archive.get('images', '?')} images, last saved {archive.get('last_saved', '-')}, "
+                 f"archive {archive['size'] / 1024:.0f} KB",
+            use_container_width=True,
+            on_click=lambda name=archive['archive']: restore_thread_helper_fn(name)
+        )
+
 # ---------------------------------------------------------------------------------------
 # Running Models Section:
 # ---------------------------------------------------------------------------------------
@@ -501,15 +1094,20 @@ models_sec = st.sidebar.expander("Running Models:", expanded=False)
 col1, col2 = models_sec.columns(2)
 
 if col1.button("Check Models"):
-    running_model_names = app_models.get_running_models(
-        temp_folder=st.session_state.folder['temp'])
-    models_sec.write(running_model_names)
+    running_models = app_models.get_running_models()
+    models_sec.write([
+        {
+            "name": model['name'],
+            "size": f"{model['size'] / 1024**3:.2f} GB",
+            "in_vram": f"{100 * model['size_vram'] / model['size']:.0f} %" if model['size'] else "-",
+            "expires_at": model['expires_at'].strftime("%d-%m-%Y %H:%M:%S") if model['expires_at'] else "-",
+        }
+        for model in running_models
+    ])
 
 if col2.button("Stop Models"):
     app_models.stop_running_models(
-        running_models=app_models.get_running_models(
-            temp_folder=st.session_state.folder['temp']
-        )
+        running_models=app_models.get_running_models()
     )
     models_sec.success("Stopped all running models.")
 
@@ -542,51 +1140,115 @@ st.subheader(
     f'✨:blue[MyGPT Local :]  {st.session_state.thread_name}', divider='rainbow')
 
 
-# Write old messages on every rerun
-for message in st.session_state.messages:
+# Write old messages on every rerun (only the latest window of them, so rerun cost does not grow with the thread)
+# Messages older than the loaded ones (messages_offset) are hidden too, they are loaded from the storage when shown
+hidden_count = max(
+    0, st.session_state.messages_offset + len(st.session_state.messages) - st.session_state.history_window)
+
+if hidden_count:
+    def show_older_messages():
+        st.session_state.history_window += st.session_state.history_page
+        missing = st.session_state.history_window - \
+            len(st.session_state.messages)
+        if missing > 0 and st.session_state.messages_offset:
+            load_older_messages(missing)
+
+    st.button(
+        label=f"Load older messages ({hidden_count} hidden)",
+        icon="⬆️",
+        use_container_width=True,
+        on_click=show_older_messages
+    )
+
+for message in st.session_state.messages[max(0, len(st.session_state.messages) - st.session_state.history_window):]:
     if message['role'] == "assistant":
         write_as_ai(message)
     else:
         write_as_user(message)
 
 
+# Answers of compare mode, waiting for the choice:
+if st.session_state.comparison:
+    st.caption("Choose the answer to keep in the thread:")
+    choice_cols = st.columns(len(st.session_state.comparison))
+
+    for ind, (col, answer) in enumerate(zip(choice_cols, st.session_state.comparison)):
+        col.caption(f"**{answer['model']}**")
+        if answer['error']:
+            col.error(answer['error'])
+            continue
+
+        if answer['reasoning']:
+            col.expander(label="Think", expanded=False,
+                         icon="💭").markdown(answer['reasoning'])
+        col.markdown(answer['content'])
+        if answer['metrics']:
+            col.caption(app_metrics.format_metrics(answer['metrics']))
+
+        col.button(
+            label="Keep this answer",
+            key=f"keep_{ind}",
+            use_container_width=True,
+            on_click=lambda ind=ind: keep_comparison_answer(ind)
+        )
+
+
 input_placeholder = "Type your message / prompt here... [Attachments are also supported!!!]"
 if inp := st.chat_input(input_placeholder):
+    # New prompt without choosing, first answer of the comparison is kept:
+    if st.session_state.comparison:
+        valid = [ind for ind, answer in enumerate(
+            st.session_state.comparison) if not answer['error']]
+        if valid:
+            keep_comparison_answer(valid[0])
+        else:
+            st.session_state.comparison = None
+
     # If there are image attachments, then, need to handle them separately.
     # Implemented it in create_message function...
     create_message('user', inp)
 
     try:
+        # Compare mode, answers are kept aside till the user chooses one:
+        if st.session_state.compare['enabled'] and len(st.session_state.compare['models']) > 1:
+            st.session_state.partial_chunks = None
+            st.session_state.comparison = write_comparison_stream(
+                st.session_state.compare['models'])
+            st.rerun()
+
         temp_container = st.container(border=True)
         logo_width = 0.6
         a, b = temp_container.columns([logo_width, 10-logo_width])
         a.image(st.session_state.icons["assistant"])
-        response_text = b.write_stream(get_response())
+        response_text, reasoning = write_response_stream(b)
 
         # Store the full response, so in next run of the st app, we can display the full response in the chat (automatically)
         if inp:
-            create_message("assistant", response_text)
+            create_message("assistant", response_text,
+                           metrics=st.session_state.get('last_metrics'),
+                           reasoning=reasoning)
+            st.session_state.partial_chunks = None
             st.rerun()
 
     except Exception as e:
         st.write(e)
 
     finally:
-        resp = app_threads.save_conversation(
+        # Response was cut (error, or session stopped by rerun), keep what was generated, marked as incomplete:
+        if st.session_state.get('partial_chunks'):
+            st.session_state.messages.append(app_threads.make_partial_message(
+                "".join(st.session_state.partial_chunks)))
+            st.session_state.partial_chunks = None
+
+        # Saved in the background, "Last saved" caption shows when it is on the disk:
+        app_saver.saver.submit(
             messages=st.session_state.messages,
             thread_name=st.session_state.thread_name,
             model_name=st.session_state.model,
-            thread_folder=st.session_state.folder['threads']
+            thread_folder=st.session_state.folder['threads'],
+            offset=st.session_state.messages_offset
         )
 
-        if resp['status'] == 'error':
-            st.error(f"Error: {resp['message']}")
-        else:
-            st.session_state.last_saved = resp['timestamp']
-
-            st.toast("Conversation saved successfully!",
-                     icon=st.session_state.icons['save_thread'])
-
 
 # ---------------------------------------------------------------------------------------
 # Upload File as System Prompt:
@@ -622,4 +1284,7 @@ if inp := st.chat_input(input_placeholder):
 
 if st.session_state.debug:
     ex = st.expander("Debugging")
+    if st.session_state.get('context_info'):
+        ex.caption(
+            f"Last request: ~{st.session_state.context_info['tokens']} tokens, {st.session_state.context_info['dropped']} older messages left out of context")
     ex.write(st.session_state.messages)
@@ -0,0 +1,303 @@
+# This code archives the deleted threads, so the deleted folder does not grow without bound
+# Deleted thread (json + journal in deleted folder, images in "deleted/images/<name>/") is packed in one zip file:
+#   "<deleted_threads_folder>/archive/<name>.zip" with:
+#       - "thread.json" : Thread json (journal merged into it)
+#       - "meta.json"   : {"thread_name": ..., "last_saved": ..., "archived_at": ..., "messages": ..., "images": ...}
+#       - "images/..."  : Images of the thread (stored as they are, they are already compressed)
+# After packing, deleted files are removed (references of the images were already dropped from the blob store on delete).
+# Archives older than MAX_AGE_DAYS are purged, then the oldest ones till all archives fit in MAX_ARCHIVE_BYTES.
+# Archived thread can be restored, it is saved again as a normal thread (with its images) and its archive is removed.
+
+
+import os
+import json
+import shutil
+import zipfile
+import tempfile
+import threading
+import app_images
+import app_journal
+import app_threads
+from datetime import datetime
+
+
+ARCHIVE_FOLDER = "archive"
+
+MAX_AGE_DAYS = 90
+MAX_ARCHIVE_BYTES = 1024 * 1024 * 1024
+
+# Archiving, restoring and moving threads into the deleted folder (app_threads.delete_thread) never run at the same time:
+_archive_lock = app_threads.deleted_lock
+
+# Background archiving is started only once at a time:
+_lock = threading.Lock()
+_running = False
+
+
+def get_archive_folder(deleted_threads_folder: str):
+    """Get the folder of the archives (created if needed)"""
+    archive_folder = os.path.join(deleted_threads_folder, ARCHIVE_FOLDER)
+    os.makedirs(archive_folder, exist_ok=True)
+    return archive_folder
+
+
+def archive_thread(name: str, deleted_threads_folder: str, deleted_images_folder: str):
+    """Pack one deleted thread (and its images) in a zip file and remove its deleted files
+
+    Args:
+        name (str): Name of the deleted thread file (without .json)
+        deleted_threads_folder (str): Folder where the deleted threads are moved
+        deleted_images_folder (str): Folder where the deleted images are moved
+
+    Returns:
+        str: Path of the archive
+    """
+    snapshot_path, journal_path = app_journal.get_paths(
+        name, deleted_threads_folder)
+    thread_images_folder = os.path.join(deleted_images_folder, name)
+
+    thread_json = app_journal.read_thread(name, deleted_threads_folder)
+    app_journal.forget_thread(name, deleted_threads_folder)
+
+    image_paths = []
+    if os.path.isdir(thread_images_folder):
+        image_paths = [os.path.join(thread_images_folder, file)
+                       for file in sorted(os.listdir(thread_images_folder))]
+
+    meta = {
+        "thread_name": name,
+        "last_saved": thread_json["config"].get("last_saved"),
+        "archived_at": app_threads.get_timestamp(),
+        "messages": len(thread_json["messages"]),
+        "images": len(image_paths),
+    }
+
+    archive_path = os.path.join(
+        get_archive_folder(deleted_threads_folder), f"{name}.zip")
+
+    # Thread of same name was archived before, add timestamp to new archive name:
+    if os.path.exists(archive_path):
+        archive_path = os.path.join(
+            get_archive_folder(deleted_threads_folder), f"{name}_{app_threads.get_timestamp_filename()}.zip")
+
+    tmp_path = archive_path + ".tmp"
+
+    with zipfile.ZipFile(tmp_path, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr("thread.json", json.dumps(thread_json, indent=4))
+        archive.writestr("meta.json", json.dumps(meta, indent=4))
+        for image_path in image_paths:
+            archive.write(image_path, f"images/{os.path.basename(image_path)}",
+                          compress_type=zipfile.ZIP_STORED)
+    os.replace(tmp_path, archive_path)
+
+    # Archive is in place, now the deleted files can go:
+    if image_paths or os.path.isdir(thread_images_folder):
+        shutil.rmtree(thread_images_folder, ignore_errors=True)
+    for path in (snapshot_path, journal_path):
+        if os.path.exists(path):
+            os.remove(path)
+
+    return archive_path
+
+
+def list_archives(deleted_threads_folder: str):
+    """List the archived threads, latest archived first
+
+    Args:
+        deleted_threads_folder (str): Folder where the deleted threads are moved
+
+    Returns:
+        list: List of dicts with archive name, size, modified time and the meta of the thread
+    """
+    archive_folder = get_archive_folder(deleted_threads_folder)
+    archives = []
+
+    for file in os.listdir(archive_folder):
+        if not file.endswith(".zip"):
+            continue
+
+        path = os.path.join(archive_folder, file)
+        try:
+            with zipfile.ZipFile(path) as archive:
+                meta = json.loads(archive.read("meta.json"))
+        except (OSError, KeyError, ValueError, zipfile.BadZipFile):
+            meta = {}
+
+        stat = os.stat(path)
+        archives.append({
+            "archive": file[:-len(".zip")],
+            "size": stat.st_size,
+            "mtime": stat.st_mtime,
+            **meta
+        })
+
+    archives.sort(key=lambda entry: entry["mtime"], reverse=True)
+    return archives
+
+
+def enforce_quotas(deleted_threads_folder: str, max_age_days: float = MAX_AGE_DAYS, max_bytes: int = MAX_ARCHIVE_BYTES):
+    """Purge the archives older than max age, then the oldest ones till the rest fit in max bytes
+
+    Args:
+        deleted_threads_folder (str): Folder where the deleted threads are moved
+        max_age_days (float, optional): Max age of the archives. Defaults to MAX_AGE_DAYS.
+        max_bytes (int, optional): Max total size of the archives. Defaults to MAX_ARCHIVE_BYTES.
+
+    Returns:
+        list: Names of the purged archives
+    """
+    archive_folder = get_archive_folder(deleted_threads_folder)
+    oldest_allowed = datetime.now().timestamp() - max_age_days * 24 * 60 * 60
+
+    archives = list_archives(deleted_threads_folder)
+    total = sum(entry["size"] for entry in archives)
+    purged = []
+
+    # Oldest first:
+    for entry in reversed(archives):
+        if entry["mtime"] >= oldest_allowed and total <= max_bytes:
+            break
+
+        os.remove(os.path.join(archive_folder, entry["archive"] + ".zip"))
+        total -= entry["size"]
+        purged.append(entry["archive"])
+
+    return purged
+
+
+def archive_deleted(
+        deleted_threads_folder: str,
+        deleted_images_folder: str,
+        max_age_days: float = MAX_AGE_DAYS,
+        max_bytes: int = MAX_ARCHIVE_BYTES
+):
+    """Archive all the deleted threads and enforce the quotas
+
+    Args:
+        deleted_threads_folder (str): Folder where the deleted threads are moved
+        deleted_images_folder (str): Folder where the deleted images are moved
+        max_age_days (float, optional): Max age of the archives. Defaults to MAX_AGE_DAYS.
+        max_bytes (int, optional): Max total size of the archives. Defaults to MAX_ARCHIVE_BYTES.
+
+    Returns:
+        dict: Names of the archived and purged threads, and the errors
+    """
+    result = {"archived": [], "purged": [], "errors": []}
+
+    names = set()
+    for file in os.listdir(deleted_threads_folder):
+        if file.endswith(app_journal.SNAPSHOT_EXT):
+            names.add(file[:-len(app_journal.SNAPSHOT_EXT)])
+        elif file.endswith(app_journal.JOURNAL_EXT):
+            names.add(file[:-len(app_journal.JOURNAL_EXT)])
+
+    with _archive_lock:
+        for name in sorted(names):
+            try:
+                archive_thread(name, deleted_threads_folder,
+                               deleted_images_folder)
+                result["archived"].append(name)
+            except Exception as e:
+                result["errors"].append({"name": name, "message": str(e)})
+
+        result["purged"] = enforce_quotas(
+            deleted_threads_folder, max_age_days, max_bytes)
+
+    return result
+
+
+def schedule_archiving(deleted_threads_folder: str, deleted_images_folder: str):
+    """Archive the deleted threads in a background thread (skipped if it is already running)
+
+    Args:
+        deleted_threads_folder (str): Folder where the deleted threads are moved
+        deleted_images_folder (str): Folder where the deleted images are moved
+
+    Returns:
+        bool: True if archiving was started
+    """
+    global _running
+    with _lock:
+        if _running:
+            return False
+        _running = True
+
+    def worker():
+        global _running
+        try:
+            archive_deleted(deleted_threads_folder, deleted_images_folder)
+        finally:
+            with _lock:
+                _running = False
+
+    threading.Thread(target=worker, daemon=True).start()
+    return True
+
+
+def restore_thread(archive_name: str, deleted_threads_folder: str, thread_folder: str, image_folder: str):
+    """Restore the archived thread as a normal thread (with its images), its archive is removed
+
+    Args:
+        archive_name (str): Name of the archive (without .zip)
+        deleted_threads_folder (str): Folder where the deleted threads are moved
+        thread_folder (str): Folder where the threads are saved
+        image_folder (str): Folder of the images of threads
+
+    Returns:
+        dict: Dictionary containing the status and the name of the restored thread
+    """
+    archive_path = os.path.join(
+        get_archive_folder(deleted_threads_folder), f"{archive_name}.zip")
+
+    try:
+        with _archive_lock:
+            with zipfile.ZipFile(archive_path) as archive:
+                thread_json = json.loads(archive.read("thread.json"))
+                meta = json.loads(archive.read("meta.json"))
+
+                # Same name may be in use by a new thread, then timestamp is added (same as deleting)
+                thread_name = meta.get("thread_name", archive_name)
+                if thread_name in app_threads.load_thread_names(thread_folder):
+                    thread_name = f"{thread_name}_{app_threads.get_timestamp_filename()}"
+
+                image_members = [member for member in archive.namelist()
+                                 if member.startswith("images/") and not member.endswith("/")]
+
+                renamed = {}
+                if image_members:
+                    with tempfile.TemporaryDirectory() as tmp_folder:
+                        archive.extractall(tmp_folder, members=image_members)
+                        resp = app_images.save_images_locally(
+                            image_list=[os.path.join(tmp_folder, member)
+                                        for member in image_members],
+                            image_folder=image_folder,
+                            thread_name=thread_name
+                        )
+                    if resp["status"] != "success":
+                        return {"status": "error", "message": f"{resp['message']} for `{resp['path']}`"}
+
+                    renamed = {
+                        os.path.basename(result["path"]): result["image_file"]
+                        for result in resp["results"]
+                    }
+
+            messages = thread_json.get("messages", [])
+            for message in messages:
+                if message.get("image_files"):
+                    message["image_files"] = [renamed.get(image_file, image_file)
+                                              for image_file in message["image_files"]]
+
+            resp = app_threads.save_conversation(
+                messages=messages,
+                thread_name=thread_name,
+                model_name=thread_json.get("config", {}).get("model"),
+                thread_folder=thread_folder
+            )
+            if resp["status"] == "error":
+                return resp
+
+            os.remove(archive_path)
+            return {"status": "success", "thread_name": thread_name}
+
+    except Exception as e:
+        return {"status": "error", "message": f"Failed to restore thread. \n\n {str(e)}"}
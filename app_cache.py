@@ -0,0 +1,182 @@
+# This code has the caches used by the app to avoid recomputing same things on every rerun
+# LRU cache is bounded by the total size (bytes) of the values (str or bytes), not by the number of entries
+# Optionally, a disk tier can be attached, where values evicted from memory are kept (also bounded by size)
+# With write_through, every value is also written to disk when it is put (so that it is kept across restarts)
+# Files of the disk tier and their total size are tracked in memory, folder is scanned only once when the cache is created.
+
+
+import os
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+
+
+class LRUCache:
+    """Thread safe LRU cache of string (or bytes) values, bounded by the total size of the values (with optional disk tier)"""
+
+    def __init__(self, max_bytes: int, disk_folder: str = None, disk_max_bytes: int = 0, write_through: bool = False):
+        """Create the cache
+
+        Args:
+            max_bytes (int): Max total size of the values kept in memory
+            disk_folder (str, optional): Folder for the disk tier. Defaults to None (no disk tier).
+            disk_max_bytes (int, optional): Max total size of the disk tier. Defaults to 0.
+            write_through (bool, optional): Write every value to disk tier, not only the evicted ones. Defaults to False.
+        """
+        self.max_bytes = max_bytes
+        self.disk_folder = disk_folder
+        self.disk_max_bytes = disk_max_bytes
+        self.write_through = write_through
+
+        self._items = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+        # Files of disk tier {name: size}, least recently used first:
+        self._disk_files = OrderedDict()
+        self._disk_size = 0
+
+        if self.disk_folder:
+            os.makedirs(self.disk_folder, exist_ok=True)
+            self._scan_disk()
+
+    def _scan_disk(self):
+        """Load the files left in disk tier by earlier runs (oldest used first)"""
+        files = []
+        for name in os.listdir(self.disk_folder):
+            path = os.path.join(self.disk_folder, name)
+            try:
+                # Temp file of a write which was cut (app was killed):
+                if name.endswith(".tmp"):
+                    os.remove(path)
+                    continue
+                stat = os.stat(path)
+            except OSError:
+                continue
+            files.append((stat.st_mtime, name, stat.st_size))
+
+        for _, name, size in sorted(files):
+            self._disk_files[name] = size
+            self._disk_size += size
+
+    def _disk_name(self, key):
+        """File name of the value of the key in disk tier"""
+        return hashlib.sha1(repr(key).encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """Get the value of the key (None if not cached)"""
+        with self._lock:
+            if key in self._items:
+                self._items.move_to_end(key)
+                return self._items[key]
+
+        if not self.disk_folder:
+            return None
+
+        name = self._disk_name(key)
+        path = os.path.join(self.disk_folder, name)
+        try:
+            with open(path, "rb") as file:
+                value = file.read()
+            if value.startswith(b"s"):
+                value = value[1:].decode("utf-8")
+            else:
+                value = value[1:]
+            # Touch the file, so that it is seen as recently used after a restart as well
+            os.utime(path)
+        except OSError:
+            return None
+
+        with self._lock:
+            if name in self._disk_files:
+                self._disk_files.move_to_end(name)
+
+        self._put_to_disk(self._put_memory(key, value))
+        return value
+
+    def put(self, key, value):
+        """Put the value of the key in the cache"""
+        evicted = self._put_memory(key, value)
+
+        if self.write_through and self.disk_folder:
+            self._put_disk(key, value)
+
+        self._put_to_disk(evicted)
+
+    def _put_memory(self, key, value):
+        """Put the value in memory tier and evict the least recently used values over the limit
+
+        Returns:
+            list: Evicted (key, value) pairs (the value itself, if it is larger than the whole memory tier)
+        """
+        size = len(value)
+        if size > self.max_bytes:
+            return [(key, value)]
+
+        evicted = []
+        with self._lock:
+            if key in self._items:
+                self._size -= len(self._items.pop(key))
+
+            self._items[key] = value
+            self._size += size
+
+            while self._size > self.max_bytes:
+                old_key, old_value = self._items.popitem(last=False)
+                self._size -= len(old_value)
+                evicted.append((old_key, old_value))
+
+        return evicted
+
+    def _put_to_disk(self, items: list):
+        """Keep the values evicted from memory in disk tier"""
+        if not self.disk_folder:
+            return
+        for key, value in items:
+            self._put_disk(key, value)
+
+    def _put_disk(self, key, value):
+        """Write the value in disk tier and evict the least recently used files over the limit"""
+        name = self._disk_name(key)
+        with self._lock:
+            if name in self._disk_files:
+                self._disk_files.move_to_end(name)
+                return
+
+        # First byte marks the type of value, "s" for str and "b" for bytes
+        data = b"s" + value.encode("utf-8") if isinstance(value, str) else b"b" + value
+
+        # Temp name is unique, in case same value is being written by two threads:
+        fd, tmp_path = tempfile.mkstemp(dir=self.disk_folder, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as file:
+                file.write(data)
+            os.replace(tmp_path, os.path.join(self.disk_folder, name))
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+
+        removed = []
+        with self._lock:
+            self._disk_size -= self._disk_files.pop(name, 0)
+            self._disk_files[name] = len(data)
+            self._disk_size += len(data)
+
+            while self._disk_size > self.disk_max_bytes and self._disk_files:
+                old_name, old_size = self._disk_files.popitem(last=False)
+                self._disk_size -= old_size
+                removed.append(old_name)
+
+        for old_name in removed:
+            try:
+                os.remove(os.path.join(self.disk_folder, old_name))
+            except OSError:
+                continue
+
+    def clear(self):
+        """Remove all the values from memory tier"""
+        with self._lock:
+            self._items.clear()
+            self._size = 0
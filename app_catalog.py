@@ -0,0 +1,270 @@
+# This code maintains the catalog (index) of all the threads in the threads folder
+# So that the sidebar list is served without listing and stat-ing every thread file on each rerun
+# Catalog is kept in "<thread_folder>/.index/" as:
+#   - "catalog.json"  : Snapshot {"dir": signature of threads folder, "threads": {thread_name: entry}}
+#   - "catalog.jsonl" : Log of the updates made after the snapshot, one json record per line
+# Entries are kept in the order of last use (latest at the end).
+# Entry of the thread looks like:
+#   {"mtime": 1700000000.0, "last_saved": "dd-mm-yyyy HH:MM:SS", "model": "llama3.1:latest", "messages": 5, "images": 2}
+# If the threads folder was changed outside of the app (folder's mtime differs), catalog is reconciled with the folder.
+
+
+import os
+import json
+import time
+import threading
+import app_journal
+
+
+# Number of log records after which log is merged into the catalog snapshot:
+COMPACT_EVERY = 500
+
+INDEX_FOLDER = ".index"
+
+_lock = threading.Lock()
+
+# Loaded catalogs {thread_folder: {"dir": ..., "threads": {...}, "records": int}}
+_catalogs = {}
+
+
+def _get_paths(thread_folder: str):
+    """Get the catalog snapshot and log paths (creates the index folder if needed)"""
+    index_folder = os.path.join(thread_folder, INDEX_FOLDER)
+    os.makedirs(index_folder, exist_ok=True)
+    return (
+        os.path.join(index_folder, "catalog.json"),
+        os.path.join(index_folder, "catalog.jsonl")
+    )
+
+
+def _folder_signature(thread_folder: str):
+    """Modified time of threads folder, changes whenever a file is added, removed or renamed in it"""
+    return os.stat(thread_folder).st_mtime_ns
+
+
+def _make_entry(messages: list, model_name: str, last_saved: str, mtime: float, offset: int = 0, previous: dict = None):
+    """Create the catalog entry of a thread from its messages
+    If older messages (before offset) are not given, images of the new messages are added to the previous entry's count."""
+    image_count = 0
+    skip = 0
+    if offset and previous:
+        image_count = previous["images"]
+        skip = max(0, previous["messages"] - offset)
+
+    for message in messages[skip:]:
+        image_count += len(message.get("image_files", []))
+
+    return {
+        "mtime": mtime,
+        "last_saved": last_saved,
+        "model": model_name,
+        "messages": offset + len(messages),
+        "images": image_count,
+    }
+
+
+def _read_catalog(thread_folder: str):
+    """Read the catalog snapshot and replay its log"""
+    snapshot_path, log_path = _get_paths(thread_folder)
+    catalog = {"dir": None, "threads": {}, "records": 0}
+
+    if os.path.exists(snapshot_path):
+        try:
+            with open(snapshot_path, "r") as file:
+                catalog.update(json.load(file))
+        except ValueError:
+            # Corrupt catalog, it is rebuilt from the folder by the reconcile
+            pass
+
+    if os.path.exists(log_path):
+        with open(log_path, "r") as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                _apply(catalog, record)
+                catalog["records"] += 1
+
+    return catalog
+
+
+def _apply(catalog: dict, record: dict):
+    """Apply a single log record on the loaded catalog"""
+    threads = catalog["threads"]
+
+    if "put" in record:
+        # Re-inserted at the end, to keep the order of last use
+        threads.pop(record["put"], None)
+        threads[record["put"]] = record["entry"]
+    elif "del" in record:
+        threads.pop(record["del"], None)
+
+    if "dir" in record:
+        catalog["dir"] = record["dir"]
+
+
+def _write_records(thread_folder: str, catalog: dict, records: list[dict]):
+    """Apply the records to the catalog and append them to the log, compact the log if it is too long"""
+    for record in records:
+        _apply(catalog, record)
+
+    snapshot_path, log_path = _get_paths(thread_folder)
+    catalog["records"] += len(records)
+
+    if catalog["records"] < COMPACT_EVERY:
+        with open(log_path, "a") as file:
+            for record in records:
+                file.write(json.dumps(record) + "\n")
+        return
+
+    tmp_path = snapshot_path + ".tmp"
+    with open(tmp_path, "w") as file:
+        json.dump({"dir": catalog["dir"], "threads": catalog["threads"]}, file)
+    os.replace(tmp_path, snapshot_path)
+
+    if os.path.exists(log_path):
+        os.remove(log_path)
+    catalog["records"] = 0
+
+
+def _reconcile(thread_folder: str, catalog: dict):
+    """Bring the catalog in sync with the thread files present in the folder"""
+    on_disk = set()
+    for file in os.listdir(thread_folder):
+        if file.endswith(".json"):
+            on_disk.add(file[:-len(".json")])
+
+    records = []
+    for thread_name in list(catalog["threads"]):
+        if thread_name not in on_disk:
+            records.append({"del": thread_name})
+
+    # New threads are read once, oldest first, so that the order of last use is kept
+    new_threads = []
+    for thread_name in on_disk - set(catalog["threads"]):
+        try:
+            new_threads.append(
+                (app_journal.get_mtime(thread_name, thread_folder), thread_name))
+        except OSError:
+            continue
+
+    for mtime, thread_name in sorted(new_threads):
+        try:
+            thread_json = app_journal.read_thread(thread_name, thread_folder)
+        except (OSError, ValueError):
+            continue
+
+        config = thread_json.get("config", {})
+        records.append({"put": thread_name, "entry": _make_entry(
+            messages=thread_json.get("messages", []),
+            model_name=config.get("model"),
+            last_saved=config.get("last_saved"),
+            mtime=mtime
+        )})
+
+    records.append({"dir": _folder_signature(thread_folder)})
+    _write_records(thread_folder, catalog, records)
+
+
+def _get_catalog(thread_folder: str, reconcile: bool = True):
+    """Get the loaded catalog of the folder, reconciled if the folder was changed outside of the app"""
+    catalog = _catalogs.get(thread_folder)
+    if catalog is None:
+        catalog = _read_catalog(thread_folder)
+        _catalogs[thread_folder] = catalog
+
+    if reconcile and catalog["dir"] != _folder_signature(thread_folder):
+        _reconcile(thread_folder, catalog)
+
+    return catalog
+
+
+def list_threads(thread_folder: str):
+    """List the thread names, latest used first
+
+    Args:
+        thread_folder (str): Folder where the threads are saved
+
+    Returns:
+        list: List of thread names
+    """
+    with _lock:
+        catalog = _get_catalog(thread_folder)
+        return list(reversed(catalog["threads"]))
+
+
+def get_entry(thread_name: str, thread_folder: str):
+    """Get the catalog entry of the thread
+
+    Args:
+        thread_name (str): Name of the thread
+        thread_folder (str): Folder where the threads are saved
+
+    Returns:
+        dict: Entry of the thread (None if thread is not in catalog)
+    """
+    with _lock:
+        return _get_catalog(thread_folder)["threads"].get(thread_name)
+
+
+def update_thread(
+        thread_name: str,
+        thread_folder: str,
+        messages: list[dict],
+        model_name: str,
+        last_saved: str,
+        offset: int = 0
+):
+    """Update the entry of the thread after it is saved
+
+    Args:
+        thread_name (str): Name of the thread
+        thread_folder (str): Folder where the threads are saved
+        messages (list[dict]): Messages of the thread (from the offset)
+        model_name (str): Model used in the thread
+        last_saved (str): Timestamp of the save
+        offset (int, optional): Index of the first given message. Defaults to 0.
+    """
+    with _lock:
+        # Entry is written first, so that the reconcile does not have to read this thread again
+        catalog = _get_catalog(thread_folder, reconcile=False)
+        entry = _make_entry(messages, model_name, last_saved, time.time(),
+                            offset, catalog["threads"].get(thread_name))
+        _write_records(thread_folder, catalog, [
+                       {"put": thread_name, "entry": entry}])
+        _get_catalog(thread_folder)
+
+
+def rename_thread(old_thread_name: str, new_thread_name: str, thread_folder: str):
+    """Move the entry of the thread to its new name
+
+    Args:
+        old_thread_name (str): Old name of the thread
+        new_thread_name (str): New name of the thread
+        thread_folder (str): Folder where the threads are saved
+    """
+    with _lock:
+        catalog = _get_catalog(thread_folder, reconcile=False)
+        entry = catalog["threads"].get(old_thread_name)
+
+        # If it is not in catalog yet, reconcile adds it from the folder
+        if entry is not None:
+            _write_records(thread_folder, catalog, [
+                {"del": old_thread_name},
+                {"put": new_thread_name, "entry": entry}
+            ])
+        _get_catalog(thread_folder)
+
+
+def remove_thread(thread_name: str, thread_folder: str):
+    """Remove the entry of the thread (after it is deleted)
+
+    Args:
+        thread_name (str): Name of the thread
+        thread_folder (str): Folder where the threads are saved
+    """
+    with _lock:
+        catalog = _get_catalog(thread_folder, reconcile=False)
+        _write_records(thread_folder, catalog, [{"del": thread_name}])
+        _get_catalog(thread_folder)
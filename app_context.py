@@ -0,0 +1,147 @@
+# This code builds the context (messages) sent to the model on every turn
+# Full thread is always saved in the thread file, but only the part of it which fits in the model's token budget is sent
+# Selected window = pinned messages (system messages and the first message) + as many latest messages as fit in the budget
+# Tokens are estimated (no tokenizer of the model is available here), estimates are cached per message content
+# Budget of a model is its context length from the model registry (see app_models.py), capped by MAX_CONTEXT_BUDGET (or the num_ctx set by user)
+# Budget is sent as num_ctx with the request (see request_options), else the server would cut the context at its own default
+
+
+import app_models
+from functools import lru_cache
+
+
+# Rough number of characters per token for the common tokenizers (llama, mistral, qwen...):
+CHARS_PER_TOKEN = 4
+
+# Tokens taken by the role and template around each message:
+MESSAGE_OVERHEAD = 4
+
+# Tokens taken by each attached image (vision encoders take a fixed number of patches per image):
+IMAGE_TOKENS = 576
+
+# Tokens kept free for the response of the model:
+RESPONSE_RESERVE = 512
+
+# Context budget (tokens) of the models, matched by prefix of the model name (overrides the registry's context length):
+MODEL_CONTEXT_BUDGETS = {}
+
+# Budget of the models whose context length is unknown:
+DEFAULT_CONTEXT_BUDGET = 2048
+
+# Registry's context length is capped to this, since the server allocates the memory (KV cache) for the whole num_ctx sent:
+MAX_CONTEXT_BUDGET = 8192
+
+
+@lru_cache(maxsize=8192)
+def _estimate_tokens(role: str, content: str, image_count: int):
+    """Estimate the tokens of a message (cached, so every message is counted only once)"""
+    text_tokens = (len(content) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+    return MESSAGE_OVERHEAD + text_tokens + image_count * IMAGE_TOKENS
+
+
+def count_tokens(message: dict):
+    """Estimate the number of tokens of the message
+
+    Args:
+        message (dict): Message of the thread
+
+    Returns:
+        int: Estimated number of tokens
+    """
+    return _estimate_tokens(
+        message.get("role", ""),
+        message.get("content", ""),
+        len(message.get("image_files", []))
+    )
+
+
+def get_context_budget(model_name: str, num_ctx: int = None):
+    """Get the context budget (tokens) of the model
+
+    Args:
+        model_name (str): Name of the model
+        num_ctx (int, optional): Context size set by the user (num_ctx option). Defaults to None (not set).
+
+    Returns:
+        int: Context size of the request, messages and response have to fit in it
+    """
+    budget = None
+    for prefix, configured in MODEL_CONTEXT_BUDGETS.items():
+        if model_name.startswith(prefix):
+            budget = configured
+            break
+
+    if budget is None:
+        try:
+            model_info = app_models.get_model_info(model_name)
+        except Exception:
+            # Server is not reachable, default budget is used
+            model_info = None
+        if model_info and model_info.get("context_length"):
+            budget = min(model_info["context_length"],
+                         num_ctx or MAX_CONTEXT_BUDGET)
+
+    # Model never sees more than the context size it was asked to load with:
+    if num_ctx:
+        budget = min(budget, num_ctx) if budget else num_ctx
+
+    return budget or DEFAULT_CONTEXT_BUDGET
+
+
+def request_options(options: dict, budget: int):
+    """Generation options of the request, with num_ctx set to the budget the context was built for
+
+    Args:
+        options (dict): Generation options set by the user (not set ones are left out)
+        budget (int): Budget of the context (from build_context)
+
+    Returns:
+        dict: Options to send with the request
+    """
+    return {**options, "num_ctx": budget}
+
+
+def build_context(messages: list[dict], model_name: str, budget: int = None, offset: int = 0, num_ctx: int = None):
+    """Select the messages to send to the model, within the token budget
+
+    Args:
+        messages (list[dict]): All the (loaded) messages of the thread
+        model_name (str): Name of the model
+        budget (int, optional): Token budget, overrides the model's budget. Defaults to None.
+        offset (int, optional): Number of older messages which are not loaded (first message is pinned only if loaded). Defaults to 0.
+        num_ctx (int, optional): Context size set by the user (num_ctx option). Defaults to None.
+
+    Returns:
+        dict: Dictionary containing the selected messages, their estimated tokens, number of messages dropped and the budget
+    """
+    if budget is None:
+        budget = get_context_budget(model_name, num_ctx)
+    available = budget - RESPONSE_RESERVE
+
+    # System messages and the first message are always sent:
+    pinned = set()
+    for ind, message in enumerate(messages):
+        if (ind == 0 and not offset) or message.get("role") == "system":
+            pinned.add(ind)
+
+    used = sum(count_tokens(messages[ind]) for ind in pinned)
+    selected = set(pinned)
+
+    # Latest messages first, till the budget is full (latest message is sent even if it alone is over budget)
+    for ind in range(len(messages) - 1, -1, -1):
+        if ind in selected:
+            continue
+
+        tokens = count_tokens(messages[ind])
+        if used + tokens > available and ind != len(messages) - 1:
+            break
+
+        selected.add(ind)
+        used += tokens
+
+    return {
+        "messages": [messages[ind] for ind in sorted(selected)],
+        "tokens": used,
+        "dropped": len(messages) - len(selected),
+        "budget": budget
+    }
@@ -0,0 +1,98 @@
+# This code sends one prompt to many models at once (compare mode)
+# Requests run concurrently on the async Ollama client, in an event loop of a background thread
+# At most max_concurrency requests run at a time (rest wait for their turn), and each also waits in the app_scheduler
+# Streamlit can be updated only from the script thread, so the chunks are passed back through a queue as events:
+#   ("chunk", model_name, text)      : Next part of the response of the model
+#   ("done", model_name, metrics)    : Model finished its response
+#   ("error", model_name, message)   : Request of the model failed
+
+
+import queue
+import asyncio
+import threading
+from time import perf_counter
+import ollama
+import app_metrics
+import app_scheduler
+
+
+# Default number of models generating at the same time:
+DEFAULT_CONCURRENCY = 2
+
+
+async def _stream_model(client, model_name: str, messages: list[dict], options: dict, semaphore, events):
+    """Stream the response of one model and put its events in the queue"""
+    async with semaphore:
+        # Request also waits for its turn in the scheduler shared with other users:
+        ticket = app_scheduler.scheduler.submit(model_name)
+        try:
+            await asyncio.to_thread(app_scheduler.scheduler.wait, ticket)
+            start_time = perf_counter()
+            ttft = None
+
+            response = await client.chat(
+                model=model_name,
+                messages=messages,
+                stream=True,
+                options=options or None,
+            )
+
+            async for chunk in response:
+                if ttft is None and chunk["message"]["content"]:
+                    ttft = perf_counter() - start_time
+
+                if chunk["message"]["content"]:
+                    events.put(("chunk", model_name,
+                               chunk["message"]["content"]))
+
+                if chunk["done"]:
+                    events.put(("done", model_name, app_metrics.collect_metrics(
+                        final_chunk=chunk, model_name=model_name, ttft=ttft)))
+
+        except Exception as e:
+            events.put(("error", model_name, str(e)))
+
+        finally:
+            app_scheduler.scheduler.release(ticket)
+
+
+async def _run_all(model_requests: dict, options: dict, max_concurrency: int, events):
+    """Run the requests of all the models"""
+    client = ollama.AsyncClient()
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    await asyncio.gather(*[
+        _stream_model(client, model_name, messages,
+                      options.get(model_name), semaphore, events)
+        for model_name, messages in model_requests.items()
+    ])
+
+
+def fan_out(model_requests: dict, options: dict = None, max_concurrency: int = DEFAULT_CONCURRENCY):
+    """Send the requests to many models concurrently and stream back their events
+
+    Args:
+        model_requests (dict): {model_name: messages of the request}
+        options (dict, optional): {model_name: generation options of the request}. Defaults to None.
+        max_concurrency (int, optional): Max models generating at a time. Defaults to DEFAULT_CONCURRENCY.
+
+    Yields:
+        tuple: Events (kind, model_name, value) as they come, till every model is done or failed
+    """
+    events = queue.Queue()
+    finished = object()
+
+    def worker():
+        try:
+            asyncio.run(_run_all(model_requests, options or {},
+                        max(1, max_concurrency), events))
+        finally:
+            events.put(finished)
+
+    threading.Thread(target=worker, daemon=True).start()
+
+    while True:
+        event = events.get()
+        if event is finished:
+            return
+        yield event
@@ -1,7 +1,87 @@
+# Attached images are stored once per content in the blob store: "<image_folder>/.blobs/<hash[:2]>/<hash><ext>"
+# Files in the threads' image folders ("<image_folder>/<thread_name>/<image_name>") are hardlinks (or reflinks) of these blobs
+# So, same image attached to many threads takes the disk space only once.
+# Blob index ("<image_folder>/.blobs/index.json") keeps:
+#   - "refs"    : {hash: number of thread files referring to the blob}
+#   - "sources" : {"path|size|mtime": hash} of already ingested source files, so they are not even read again
+
+
+import io
 import os
+import json
 import base64
 import shutil
+import hashlib
+import threading
+from app_cache import LRUCache
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+# fcntl is not available on windows, reflinks are skipped there:
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Pillow comes with streamlit, but if it is missing, original images are sent to the model as it is:
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+
+BLOB_FOLDER = ".blobs"
+
+# ioctl code of FICLONE (linux), to make a copy-on-write clone of file:
+FICLONE = 0x40049409
+
+DERIVED_FOLDER = "derived"
+
+_blob_lock = threading.Lock()
+
+# Vision models resize the images to their own input size anyway, so larger images are only wasted payload
+# Longest side (px) and jpeg quality of the image sent to the model, matched by the prefix of model name:
+MODEL_IMAGE_SETTINGS = {
+    "llama3.2-vision": {"max_side": 1120, "quality": 85},
+    "llava": {"max_side": 672, "quality": 85},
+    "bakllava": {"max_side": 672, "quality": 85},
+    "moondream": {"max_side": 756, "quality": 85},
+    "minicpm-v": {"max_side": 1344, "quality": 85},
+}
+DEFAULT_IMAGE_SETTINGS = {"max_side": 1024, "quality": 85}
+
+# Pool to read, hash, copy and encode the images concurrently:
+INGEST_WORKERS = min(8, os.cpu_count() or 1)
+_ingest_pool = ThreadPoolExecutor(
+    max_workers=INGEST_WORKERS, thread_name_prefix="image_ingest")
+
+# Base64 encodings of the images, keyed by identity of the file (device, inode, size, mtime)
+# Since thread images are hardlinks of blobs, same image in many threads is encoded only once
+base64_cache = LRUCache(max_bytes=256 * 1024 * 1024)
+
+
+# Thumbnails shown in the chat, so that every rerun does not send the full size images to the browser
+thumbnail_cache = LRUCache(max_bytes=64 * 1024 * 1024)
+
+
+def configure_base64_cache(max_bytes: int, disk_folder: str = None, disk_max_bytes: int = 0):
+    """Replace the base64 cache with the new limits (and optional disk tier)
+    Cache is shared by all the sessions, so it is replaced only if the limits are changed (calling it on every rerun is fine).
+
+    Args:
+        max_bytes (int): Max size of base64 strings kept in memory
+        disk_folder (str, optional): Folder to keep evicted encodings on disk. Defaults to None.
+        disk_max_bytes (int, optional): Max size of the disk folder. Defaults to 0.
+    """
+    global base64_cache
+    if (base64_cache.max_bytes, base64_cache.disk_folder, base64_cache.disk_max_bytes) == (max_bytes, disk_folder, disk_max_bytes):
+        return
+
+    base64_cache = LRUCache(
+        max_bytes=max_bytes,
+        disk_folder=disk_folder,
+        disk_max_bytes=disk_max_bytes
+    )
 
 
 def get_timestamp():
@@ -64,63 +144,422 @@ def parse_images_from_prompt(prompt: str):
         return {"status": "error", "message": "Some error occurred while parsing the images"}
 
 
-def save_images_locally(image_list: list, image_folder: str, thread_name: str):
+def _load_blob_index(blob_folder: str):
+    """Load the index of the blob store"""
+    index_path = os.path.join(blob_folder, "index.json")
+    if os.path.exists(index_path):
+        with open(index_path, "r") as file:
+            return json.load(file)
+    return {"refs": {}, "sources": {}}
+
+
+def _save_blob_index(blob_folder: str, index: dict):
+    """Save the index of the blob store atomically"""
+    index_path = os.path.join(blob_folder, "index.json")
+    with open(index_path + ".tmp", "w") as file:
+        json.dump(index, file)
+    os.replace(index_path + ".tmp", index_path)
+
+
+def hash_file(path: str):
+    """Get the sha256 hash of the file content
+
+    Args:
+        path (str): Path of the file
+
+    Returns:
+        str: Hex digest of the content
+    """
+    sha = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(1024 * 1024), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def _link_or_copy(src: str, dst: str):
+    """Make dst point to same content as src, by hardlink, else reflink, else plain copy"""
+    try:
+        os.link(src, dst)
+        return
+    except OSError:
+        pass
+
+    if fcntl is not None:
+        try:
+            with open(src, "rb") as src_file, open(dst, "wb") as dst_file:
+                fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+            return
+        except OSError:
+            if os.path.exists(dst):
+                os.remove(dst)
+
+    shutil.copyfile(src, dst)
+
+
+def _store_blob(image_path: str, blob_folder: str, sources: dict):
+    """Put the image in the blob store (if its content is not there already)
+
+    Returns:
+        tuple: (source key, hash of content, path of the blob)
+    """
+    stat = os.stat(image_path)
+    source_key = f"{os.path.abspath(image_path)}|{stat.st_size}|{stat.st_mtime_ns}"
+    ext = os.path.splitext(image_path)[1].lower()
+
+    digest = sources.get(source_key)
+    if digest is None:
+        digest = hash_file(image_path)
+
+    blob_path = os.path.join(blob_folder, digest[:2], digest + ext)
+    if not os.path.exists(blob_path):
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        # Temp name is unique per worker, in case same content is being stored by two workers
+        tmp_path = f"{blob_path}.{threading.get_ident()}.tmp"
+        shutil.copyfile(image_path, tmp_path)
+        os.replace(tmp_path, blob_path)
+
+    return source_key, digest, blob_path
+
+
+def _derived_prefix(stat: os.stat_result):
+    """Name prefix of the derivatives of the file (by its identity, so hardlinks of a blob share the derivatives)"""
+    identity = f"{stat.st_dev}|{stat.st_ino}|{stat.st_size}|{stat.st_mtime_ns}"
+    return hashlib.sha1(identity.encode("utf-8")).hexdigest()
+
+
+def _remove_derivatives(blob_folder: str, prefixes: set):
+    """Remove the derivatives of the files with the given prefixes"""
+    derived_folder = os.path.join(blob_folder, DERIVED_FOLDER)
+    if not prefixes or not os.path.isdir(derived_folder):
+        return
+
+    for file in os.listdir(derived_folder):
+        # Derivatives named before the prefixes (no "_" in name) can not be matched to a blob anymore, they go too
+        if "_" not in file or file.split("_", 1)[0] in prefixes:
+            try:
+                os.remove(os.path.join(derived_folder, file))
+            except OSError:
+                continue
+
+
+def release_images(image_paths: list, image_folder: str):
+    """Drop the references of the image files (which are about to be removed), blobs with no references are removed
+    Derivatives (see get_model_image) of the removed blobs, and of the image files which are copies (not links) of their blob, are removed too.
+
+    Args:
+        image_paths (list): Paths of the thread's image files which are being removed
+        image_folder (str): Image folder path under which the blob store is kept
+    """
+    blob_folder = os.path.join(image_folder, BLOB_FOLDER)
+    if not os.path.exists(blob_folder):
+        return
+
+    with _blob_lock:
+        index = _load_blob_index(blob_folder)
+        orphaned = set()
+
+        for image_path in image_paths:
+            if not os.path.exists(image_path):
+                continue
+
+            digest = hash_file(image_path)
+            if digest not in index["refs"]:
+                continue
+
+            blob_path = os.path.join(
+                blob_folder, digest[:2], digest + os.path.splitext(image_path)[1].lower())
+            image_stat = os.stat(image_path)
+            blob_stat = os.stat(blob_path) if os.path.exists(blob_path) else None
+
+            # Plain copy of the blob (no hardlink support), its derivatives are used by this file only:
+            if blob_stat is None or not os.path.samestat(image_stat, blob_stat):
+                orphaned.add(_derived_prefix(image_stat))
+
+            index["refs"][digest] -= 1
+            if index["refs"][digest] <= 0:
+                del index["refs"][digest]
+                if blob_stat is not None:
+                    orphaned.add(_derived_prefix(blob_stat))
+                    os.remove(blob_path)
+                index["sources"] = {
+                    k: v for k, v in index["sources"].items() if v != digest}
+
+        _save_blob_index(blob_folder, index)
+        _remove_derivatives(blob_folder, orphaned)
+
+
+def _prepare_image(image_path: str, blob_folder: str, sources: dict):
+    """Validate the image and put it in the blob store (runs in the ingestion pool)
+
+    Returns:
+        tuple: (source key, hash of content, path of the blob)
+    """
+    # Validate the image path exists
+    if not os.path.exists(image_path):
+        raise FileNotFoundError(f"Image not found at path: {image_path}")
+
+    get_mime_type(image_path)
+    return _store_blob(image_path, blob_folder, sources)
+
+
+def _link_image(image_path: str, digest: str, blob_path: str, thread_images_folder: str, index: dict):
+    """Link the stored blob in the thread's image folder
+
+    Returns:
+        str: Name of the image file in the thread's image folder
+    """
+    base_name = os.path.basename(image_path)
+    new_image_path = os.path.join(thread_images_folder, base_name)
+
+    # Same image is already attached in this thread, reuse it
+    if os.path.exists(new_image_path) and os.path.samefile(new_image_path, blob_path):
+        return base_name
+
+    # Append timestamp (and counter, if many images are linked in same second) if the file already exists
+    name, ext = os.path.splitext(base_name)
+    counter = 0
+    while os.path.exists(new_image_path):
+        suffix = f"_{counter}" if counter else ""
+        new_image_path = os.path.join(
+            thread_images_folder, f"{name}_{get_timestamp()}{suffix}{ext}")
+        counter += 1
+
+    # Link the blob to the new path
+    _link_or_copy(blob_path, new_image_path)
+    index["refs"][digest] = index["refs"].get(digest, 0) + 1
+    return os.path.basename(new_image_path)
+
+
+def save_images_locally(image_list: list, image_folder: str, thread_name: str, model_name: str = None):
     """Saves the images locally in the specified thread folder from the list of image paths (passed by user from anywhere in the system)
+    Content is stored once in the blob store, thread folder only gets a link to it.
+    Images are validated, hashed and stored concurrently, failure of one image does not stop the others.
 
     Args:
         image_list (list): List of image paths
         image_folder (str): Image folder path under which the images are to be stored
         thread_name (str): Name of the thread (to create subfolder under image_folder)
+        model_name (str, optional): Model the images are going to, to prepare their downscaled base64s in advance. Defaults to None.
 
     Returns:
-        dict: Dictionary containing the status and path of the saved images
+        dict: Dictionary containing the status ("success", "partial" or "error"), names of the saved images,
+              per image results and the errors (first error is also returned as "message" and "path")
     """
 
     # Create the thread folder if it does not exist
     thread_images_folder = os.path.join(image_folder, thread_name)
     os.makedirs(thread_images_folder, exist_ok=True)
 
-    error_flag = False
-    error_log = ""
-    error_path = ""
+    blob_folder = os.path.join(image_folder, BLOB_FOLDER)
+    os.makedirs(blob_folder, exist_ok=True)
 
-    local_image_list = []
-    for image_path in image_list:
-        try:
-            # Validate the image path exists
-            if not os.path.exists(image_path):
-                error_flag = True
-                error_log = f"Error: Image not found at path: {image_path}"
-                error_path = image_path
-                break
-
-            # Copy the image to the thread folder
-            # old_image_path = image_path
-            # new_image_path = f"{image_folder}/{thread_name}/{os.path.basename(image_path)}"
-            base_name = os.path.basename(image_path)
-            new_image_path = os.path.join(thread_images_folder, base_name)
-
-            # Append timestamp if the file already exists
-            if os.path.exists(new_image_path):
-                timestamp = get_timestamp()
-                name, ext = os.path.splitext(base_name)
-                new_image_path = os.path.join(
-                    thread_images_folder, f"{name}_{timestamp}{ext}")
-
-            # Copy the file to the new path
-            shutil.copy(image_path, new_image_path)
-            local_image_list.append(os.path.basename(new_image_path))
+    # Heavy part (reading, hashing, copying) runs in the pool:
+    sources = _load_blob_index(blob_folder)["sources"]
+    futures = [
+        _ingest_pool.submit(_prepare_image, image_path, blob_folder, sources)
+        for image_path in image_list
+    ]
 
+    # Ingestion is awaited without the lock, so that other sessions can link their images meanwhile:
+    prepared = []
+    for image_path, future in zip(image_list, futures):
+        try:
+            prepared.append((image_path, future.result(), None))
         except Exception as e:
-            error_flag = True
-            error_log += f"Error: {e}"
-            error_path = image_path
-            break
+            prepared.append((image_path, None, e))
+
+    # Linking is done in order, so that names of the images are decided same as they were passed
+    results = []
+    with _blob_lock:
+        index = _load_blob_index(blob_folder)
+
+        for image_path, blob, error in prepared:
+            try:
+                if error is not None:
+                    raise error
+
+                source_key, digest, blob_path = blob
+                # Blob was released (its last thread deleted) after it was stored, store it again:
+                if not os.path.exists(blob_path):
+                    source_key, digest, blob_path = _store_blob(
+                        image_path, blob_folder, {})
+
+                index["sources"][source_key] = digest
+                image_file = _link_image(
+                    image_path, digest, blob_path, thread_images_folder, index)
+                results.append(
+                    {"status": "success", "path": image_path, "image_file": image_file})
+
+            except Exception as e:
+                results.append(
+                    {"status": "error", "path": image_path, "message": f"Error: {e}"})
+
+        _save_blob_index(blob_folder, index)
+
+    local_image_list = [r["image_file"]
+                        for r in results if r["status"] == "success"]
+    errors = [r for r in results if r["status"] == "error"]
+
+    # Encode the saved images in background, so that base64s are cached by the time request is sent
+    for image_file in local_image_list:
+        _ingest_pool.submit(model_image_to_base64, os.path.join(
+            thread_images_folder, image_file), image_folder, model_name)
+
+    if not errors:
+        return {"status": "success", "image_list": local_image_list, "results": results}
+
+    status = "partial" if local_image_list else "error"
+    return {
+        "status": status,
+        "message": errors[0]["message"],
+        "path": errors[0]["path"],
+        "image_list": local_image_list,
+        "results": results,
+        "errors": errors
+    }
+
+
+def get_thumbnail(image_path: str, max_side: int = 400):
+    """Get the small version of the image to show in the chat (cached by file identity and size)
 
-    if error_flag:
-        return {"status": "error", "message": error_log, "path": error_path}
-    else:
-        return {"status": "success", "image_list": local_image_list}
+    Args:
+        image_path (str): Path of the image
+        max_side (int, optional): Longest side of the thumbnail (px). Defaults to 400.
+
+    Returns:
+        bytes | str: Png / jpeg bytes of the thumbnail (or the path itself, if Pillow is missing or it fails)
+    """
+    if Image is None:
+        return image_path
+
+    try:
+        stat = os.stat(image_path)
+        cache_key = (stat.st_dev, stat.st_ino, stat.st_size,
+                     stat.st_mtime_ns, max_side)
+
+        thumbnail = thumbnail_cache.get(cache_key)
+        if thumbnail is None:
+            with Image.open(image_path) as img:
+                # Phone photos are stored sideways with an orientation tag, so they are turned upright first:
+                img = ImageOps.exif_transpose(img)
+                img.thumbnail((max_side, max_side))
+                buffer = io.BytesIO()
+                if img.mode in ("RGBA", "LA", "P"):
+                    img.save(buffer, format="PNG")
+                else:
+                    img.convert("RGB").save(buffer, format="JPEG", quality=85)
+            thumbnail = buffer.getvalue()
+            thumbnail_cache.put(cache_key, thumbnail)
+
+        return thumbnail
+
+    except Exception:
+        return image_path
+
+
+def get_mime_type(image_path: str):
+    """Get the MIME type (format) of the image from its file extension
+
+    Args:
+        image_path (str): Path of the image file
+
+    Raises:
+        ValueError: If the format is not supported by the models
+
+    Returns:
+        str: MIME type of the image (like png, jpg)
+    """
+    mime_type = image_path.split('.')[-1].lower()
+    if mime_type not in ["png", "jpg", "jpeg", "gif", "bmp", "webp"]:
+        raise ValueError("Unsupported image format")
+    return mime_type
+
+
+def get_image_settings(model_name: str):
+    """Get the image size settings for the model
+
+    Args:
+        model_name (str): Name of the model (like "llava:13b")
+
+    Returns:
+        dict: Dictionary with "max_side" and "quality"
+    """
+    for prefix, settings in MODEL_IMAGE_SETTINGS.items():
+        if model_name.startswith(prefix):
+            return settings
+    return DEFAULT_IMAGE_SETTINGS
+
+
+def get_model_image(image_path: str, image_folder: str, model_name: str):
+    """Get the path of the image to send to the model, downscaled and recompressed as per the model settings
+    Derivative is created once and cached in the blob store, keyed by the original file and the settings
+    (named "<prefix of file>_<max side>_<quality>", so they are removed with the blob, see release_images).
+
+    Args:
+        image_path (str): Path of the original image
+        image_folder (str): Image folder path under which the blob store is kept
+        model_name (str): Name of the model the image is sent to
+
+    Returns:
+        str: Path of the derivative (or of the original, if it is already small enough or Pillow is missing)
+    """
+    if Image is None or not model_name:
+        return image_path
+
+    settings = get_image_settings(model_name)
+    name = f"{_derived_prefix(os.stat(image_path))}_{settings['max_side']}_{settings['quality']}"
+
+    derived_folder = os.path.join(image_folder, BLOB_FOLDER, DERIVED_FOLDER)
+    for ext in ("jpg", "png"):
+        derived_path = os.path.join(derived_folder, f"{name}.{ext}")
+        if os.path.exists(derived_path):
+            return derived_path
+
+    with Image.open(image_path) as img:
+        # Already small, nothing to gain:
+        if max(img.size) <= settings["max_side"]:
+            return image_path
+
+        img.thumbnail((settings["max_side"], settings["max_side"]))
+
+        # Transparent images stay png, rest are jpeg
+        has_alpha = img.mode in ("RGBA", "LA") or "transparency" in img.info
+        ext = "png" if has_alpha else "jpg"
+
+        os.makedirs(derived_folder, exist_ok=True)
+        derived_path = os.path.join(derived_folder, f"{name}.{ext}")
+        tmp_path = f"{derived_path}.{threading.get_ident()}.tmp"
+
+        if has_alpha:
+            img.save(tmp_path, format="PNG", optimize=True)
+        else:
+            img.convert("RGB").save(
+                tmp_path, format="JPEG", quality=settings["quality"], optimize=True)
+
+    os.replace(tmp_path, derived_path)
+    return derived_path
+
+
+def model_image_to_base64(image_path: str, image_folder: str, model_name: str):
+    """Converts the image to base64 format, after downscaling it for the model
+
+    Args:
+        image_path (str): Path of the original image
+        image_folder (str): Image folder path under which the blob store is kept
+        model_name (str): Name of the model the image is sent to
+
+    Returns:
+        dict: Same as path_to_base64 (error refers to the original path)
+    """
+    try:
+        get_mime_type(image_path)
+        model_image_path = get_model_image(
+            image_path, image_folder, model_name)
+    except Exception as e:
+        return {'status': "error", "message": f"Error: {e}", "path": image_path}
+
+    return path_to_base64(model_image_path)
 
 
 def path_to_base64(image_path: str):
@@ -134,16 +573,20 @@ def path_to_base64(image_path: str):
     """
 
     try:
-        # Open the file in binary mode
-        with open(image_path, "rb") as image_file:
-            # Encode the image file to base64
-            encoded_string = base64.b64encode(
-                image_file.read()).decode('utf-8')
-
         # Determine the MIME type based on file extension
-        mime_type = image_path.split('.')[-1].lower()
-        if mime_type not in ["png", "jpg", "jpeg", "gif", "bmp", "webp"]:
-            raise ValueError("Unsupported image format")
+        mime_type = get_mime_type(image_path)
+
+        stat = os.stat(image_path)
+        cache_key = (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+        encoded_string = base64_cache.get(cache_key)
+        if encoded_string is None:
+            # Open the file in binary mode
+            with open(image_path, "rb") as image_file:
+                # Encode the image file to base64
+                encoded_string = base64.b64encode(
+                    image_file.read()).decode('utf-8')
+            base64_cache.put(cache_key, encoded_string)
 
         return {"status": "success", "result": encoded_string, "mime_type": mime_type}
 
@@ -151,13 +594,14 @@ def path_to_base64(image_path: str):
         return {'status': "error", "message": f"Error: {e}", "path": image_path}
 
 
-def image_list_to_base64(image_list: list, image_folder: str, thread_name: str):
+def image_list_to_base64(image_list: list, image_folder: str, thread_name: str, model_name: str = None):
     """Converts the list of image paths to base64 format
 
     Args:
         image_list (list): List of image paths
         image_folder (str): Path of Folder containing the images
         thread_name (str): Name of the thread
+        model_name (str, optional): If given, images are downscaled for this model first. Defaults to None.
 
     Returns:
         dict: Dictionary containing the status and base64 encoded images
@@ -169,12 +613,17 @@ def image_list_to_base64(image_list: list, image_folder: str, thread_name: str):
     error_log = ""
     error_path = ""
 
-    for image_path in image_list:
-        # image is stored in: Threads/images/thread_name/image_name
-        # Because, in case of thread deletion, we can delete the whole image folder of that thread
-        image_path = f"{image_folder}/{thread_name}/{image_path}"
-        result = path_to_base64(image_path)
-
+    # image is stored in: Threads/images/thread_name/image_name
+    # Because, in case of thread deletion, we can delete the whole image folder of that thread
+    image_paths = [f"{image_folder}/{thread_name}/{image_path}"
+                   for image_path in image_list]
+
+    # Images are encoded concurrently, results come in same order as the list:
+    results = _ingest_pool.map(
+        lambda path: model_image_to_base64(path, image_folder, model_name),
+        image_paths
+    )
+    for result in results:
         if result['status'] == 'error':
             error_flag = True
             error_log += f"Error: {result['message']}"
@@ -0,0 +1,646 @@
+# This code handles the journaled storage of the threads
+# A thread is stored as three files in the threads folder:
+#   - "<thread_name>.json"  : Snapshot, same format as the old (legacy) thread files, with one message per line
+#   - "<thread_name>.jsonl" : Journal, one json record per line, appended after each save
+#   - "<thread_name>.idx"   : Index of the snapshot {"signature": .., "config": {...}, "count": N, "offsets": [[start, end], ...]}
+# Every journal record is idempotent, so replaying it over a snapshot which already contains it changes nothing:
+#   - {"i": 4, "message": {...}} : Put the message at index 4 (append if it is the next index, else replace)
+#   - {"config": {...}}          : Update the config of the thread
+# Once the journal grows beyond COMPACT_EVERY records, it is merged into the snapshot in a background thread.
+# With the index, config, message count and any range of messages (e.g. latest ones) are read without parsing the whole snapshot.
+# Legacy threads (only the .json file) are read as a snapshot with an empty journal, and are indexed on first partial read
+# (only the .idx file is written, the snapshot itself and its modified time are left as they are).
+
+
+import os
+import json
+import threading
+from contextlib import ExitStack, contextmanager
+
+
+# Number of journal records after which the journal is compacted into the snapshot:
+COMPACT_EVERY = 100
+
+SNAPSHOT_EXT = ".json"
+JOURNAL_EXT = ".jsonl"
+INDEX_EXT = ".idx"
+
+# Per file locks, so that appends and compaction of same thread never interleave:
+_locks = {}
+_locks_guard = threading.Lock()
+
+# Cached state of the persisted threads {base_path: {...}}, so that the journal is not replayed on every save:
+_states = {}
+
+# Threads which are already queued for the background compaction:
+_pending_compactions = set()
+
+
+def get_paths(thread_name: str, thread_folder: str):
+    """Get the snapshot and journal file paths of the thread
+
+    Args:
+        thread_name (str): Name of the thread
+        thread_folder (str): Folder where the thread is saved
+
+    Returns:
+        tuple: (snapshot path, journal path)
+    """
+    base = f"{thread_folder}/{thread_name}"
+    return base + SNAPSHOT_EXT, base + JOURNAL_EXT
+
+
+def get_index_path(thread_name: str, thread_folder: str):
+    """Get the path of the snapshot's index file
+
+    Args:
+        thread_name (str): Name of the thread
+        thread_folder (str): Folder where the thread is saved
+
+    Returns:
+        str: Index path
+    """
+    return f"{thread_folder}/{thread_name}{INDEX_EXT}"
+
+
+def _index_path(snapshot_path: str):
+    """Index path from the snapshot path"""
+    return snapshot_path[:-len(SNAPSHOT_EXT)] + INDEX_EXT
+
+
+def _get_lock(snapshot_path: str):
+    """Get the lock of the thread file (created on first use)"""
+    with _locks_guard:
+        if snapshot_path not in _locks:
+            _locks[snapshot_path] = threading.Lock()
+        return _locks[snapshot_path]
+
+
+@contextmanager
+def hold_threads(thread_names: list[str], thread_folder: str):
+    """Hold the locks of the threads (e.g. while their files are renamed or moved out)
+
+    Args:
+        thread_names (list[str]): Names of the threads
+        thread_folder (str): Folder where the threads are saved
+    """
+    # Locks are always taken in the same order, so two callers never wait on each other:
+    snapshot_paths = sorted({get_paths(name, thread_folder)[0]
+                             for name in thread_names})
+    with ExitStack() as stack:
+        for snapshot_path in snapshot_paths:
+            stack.enter_context(_get_lock(snapshot_path))
+        yield
+
+
+def _file_signature(snapshot_path: str, journal_path: str):
+    """Signature of the files on disk, used to validate the cached state"""
+    try:
+        snapshot_sig = os.stat(snapshot_path).st_mtime_ns
+    except FileNotFoundError:
+        snapshot_sig = None
+
+    try:
+        journal_sig = os.path.getsize(journal_path)
+    except FileNotFoundError:
+        journal_sig = 0
+
+    return (snapshot_sig, journal_sig)
+
+
+def _dumps(obj):
+    """Compact, stable json used for journal lines and for comparing messages"""
+    return json.dumps(obj, separators=(",", ":"), sort_keys=True)
+
+
+def _journal_records(journal_path: str):
+    """Read the records of the journal, in order"""
+    if not os.path.exists(journal_path):
+        return
+
+    with open(journal_path, "r") as file:
+        for line in file:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # Half written line (app was killed while appending), rest of the journal is ignored
+                return
+            yield record
+
+
+def _repair_journal(journal_path: str):
+    """Cut the half written tail of the journal (app was killed while appending), so that next appends are readable"""
+    try:
+        file = open(journal_path, "r+b")
+    except FileNotFoundError:
+        return
+
+    with file:
+        valid_end = 0
+        ends_with_newline = True
+        for line in file:
+            try:
+                json.loads(line)
+            except ValueError:
+                break
+            valid_end += len(line)
+            ends_with_newline = line.endswith(b"\n")
+
+        if valid_end < file.seek(0, os.SEEK_END):
+            file.truncate(valid_end)
+
+        # Last record is complete but its newline was not written:
+        if not ends_with_newline:
+            file.seek(valid_end)
+            file.write(b"\n")
+
+        file.flush()
+        os.fsync(file.fileno())
+
+
+def _replay(snapshot_path: str, journal_path: str):
+    """Read the snapshot and apply the journal records over it
+
+    Returns:
+        tuple: (thread json, number of journal records)
+    """
+    if os.path.exists(snapshot_path):
+        with open(snapshot_path, "r") as file:
+            thread_json = json.load(file)
+    else:
+        thread_json = {}
+
+    thread_json.setdefault("config", {})
+    messages = thread_json.setdefault("messages", [])
+    records = 0
+
+    for record in _journal_records(journal_path):
+        if "config" in record:
+            thread_json["config"].update(record["config"])
+        elif "message" in record:
+            ind = record["i"]
+            if ind < len(messages):
+                messages[ind] = record["message"]
+            elif ind == len(messages):
+                messages.append(record["message"])
+            else:
+                # Gap in the journal, this can not be replayed further
+                break
+        records += 1
+
+    return thread_json, records
+
+
+def _load_index(snapshot_path: str):
+    """Load the index of the snapshot, None if it is missing or does not match the snapshot"""
+    try:
+        with open(_index_path(snapshot_path), "r") as file:
+            index = json.load(file)
+        stat = os.stat(snapshot_path)
+    except (OSError, ValueError):
+        return None
+
+    if index.get("signature") != [stat.st_size, stat.st_mtime_ns]:
+        return None
+    return index
+
+
+def _read_layout(snapshot_path: str, journal_path: str):
+    """Config, message count and location of each message (snapshot offset or journal), body of snapshot is not parsed
+
+    Returns:
+        dict: Layout of the thread, None if the snapshot has no valid index
+    """
+    index = _load_index(snapshot_path)
+    if index is None:
+        return None
+
+    config = dict(index["config"])
+    count = index["count"]
+    journal_messages = {}
+    records = 0
+
+    for record in _journal_records(journal_path):
+        if "config" in record:
+            config.update(record["config"])
+        elif "message" in record:
+            ind = record["i"]
+            if ind > count:
+                break
+            journal_messages[ind] = record["message"]
+            count = max(count, ind + 1)
+        records += 1
+
+    return {"index": index, "config": config, "count": count, "journal": journal_messages, "records": records}
+
+
+def _read_messages(snapshot_path: str, layout: dict, start: int, end: int):
+    """Read the messages [start, end) of the thread, only their part of the snapshot is read"""
+    offsets = layout["index"]["offsets"]
+    needed = [ind for ind in range(start, min(end, layout["index"]["count"]))
+              if ind not in layout["journal"]]
+
+    parsed = {}
+    if needed:
+        base = offsets[needed[0]][0]
+        with open(snapshot_path, "rb") as file:
+            file.seek(base)
+            data = file.read(offsets[needed[-1]][1] - base)
+
+        for ind in needed:
+            parsed[ind] = json.loads(
+                data[offsets[ind][0] - base: offsets[ind][1] - base])
+
+    return [layout["journal"][ind] if ind in layout["journal"] else parsed[ind]
+            for ind in range(start, end)]
+
+
+def _write_index(snapshot_path: str, stat: os.stat_result, config: dict, offsets: list):
+    """Write the index of the snapshot (signature is of the given stat of the snapshot)"""
+    index = {
+        "signature": [stat.st_size, stat.st_mtime_ns],
+        "config": config,
+        "count": len(offsets),
+        "offsets": offsets
+    }
+
+    index_path = _index_path(snapshot_path)
+    with open(index_path + ".tmp", "w") as file:
+        json.dump(index, file)
+    os.replace(index_path + ".tmp", index_path)
+    return index
+
+
+def _index_snapshot(snapshot_path: str):
+    """Index a snapshot written without index (e.g. legacy thread file), the snapshot itself is not changed
+
+    Returns:
+        dict: Index of the snapshot, None if the snapshot is not a thread json
+    """
+    stat = os.stat(snapshot_path)
+    with open(snapshot_path, "rb") as file:
+        data = file.read()
+
+    text = data.decode("utf-8")
+    decoder = json.JSONDecoder()
+
+    def skip(pos):
+        while pos < len(text) and text[pos] in " \t\r\n":
+            pos += 1
+        return pos
+
+    # Offsets are in bytes, while the text is scanned by characters (same unless it has non-ascii characters):
+    byte_pos = {"char": 0, "byte": 0}
+
+    def to_bytes(pos):
+        byte_pos["byte"] += len(text[byte_pos["char"]:pos].encode("utf-8"))
+        byte_pos["char"] = pos
+        return byte_pos["byte"]
+
+    config = {}
+    offsets = []
+
+    try:
+        pos = skip(0)
+        if text[pos] != "{":
+            return None
+        pos = skip(pos + 1)
+
+        while text[pos] != "}":
+            key, pos = decoder.raw_decode(text, pos)
+            pos = skip(pos)
+            if text[pos] != ":":
+                return None
+            pos = skip(pos + 1)
+
+            if key == "messages" and text[pos] == "[":
+                pos = skip(pos + 1)
+                while text[pos] != "]":
+                    start = pos
+                    _, pos = decoder.raw_decode(text, pos)
+                    offsets.append([to_bytes(start), to_bytes(pos)])
+                    pos = skip(pos)
+                    if text[pos] == ",":
+                        pos = skip(pos + 1)
+                pos += 1
+            else:
+                value, pos = decoder.raw_decode(text, pos)
+                if key == "config":
+                    config = value
+
+            pos = skip(pos)
+            if text[pos] == ",":
+                pos = skip(pos + 1)
+
+    except (IndexError, ValueError):
+        return None
+
+    return _write_index(snapshot_path, stat, config, offsets)
+
+
+def _write_snapshot(snapshot_path: str, journal_path: str, thread_json: dict):
+    """Write the full snapshot atomically (temp file + rename) with its index, and empty the journal"""
+    config = thread_json.get("config", {})
+    messages = thread_json.get("messages", [])
+    offsets = []
+
+    # One message per line, so the file is still a normal json, and offsets of the messages are known while writing
+    tmp_path = snapshot_path + ".tmp"
+    with open(tmp_path, "wb") as file:
+        file.write(
+            ('{\n    "config": ' + json.dumps(config) + ',\n    "messages": [').encode("utf-8"))
+        for ind, message in enumerate(messages):
+            file.write(b",\n        " if ind else b"\n        ")
+            data = json.dumps(message).encode("utf-8")
+            start = file.tell()
+            file.write(data)
+            offsets.append([start, start + len(data)])
+        file.write(b"\n    ]\n}\n")
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_path, snapshot_path)
+
+    # Index is written after the snapshot, if it is missing (crash in between), snapshot is read fully
+    _write_index(snapshot_path, os.stat(snapshot_path), config, offsets)
+
+    # Journal is emptied only after snapshot is in place, in case of crash in between, replay is still correct (idempotent)
+    if os.path.exists(journal_path):
+        os.remove(journal_path)
+
+
+def _set_state(snapshot_path: str, journal_path: str, count: int, last: dict, records: int):
+    """Cache the state of the thread as it is on the disk now"""
+    _states[snapshot_path] = {
+        "count": count,
+        "last": _dumps(last) if count else None,
+        "records": records,
+        "signature": _file_signature(snapshot_path, journal_path),
+    }
+
+
+def _get_state(snapshot_path: str, journal_path: str):
+    """Get the cached state of thread, rebuild it from disk if the files were changed outside"""
+    state = _states.get(snapshot_path)
+    if state and state["signature"] == _file_signature(snapshot_path, journal_path):
+        return state
+
+    if not os.path.exists(snapshot_path) and not os.path.exists(journal_path):
+        return None
+
+    # State is rebuilt after a restart (or outside change), journal may end with a half written line:
+    _repair_journal(journal_path)
+
+    # Only the last message is needed, so it is read through the index if possible:
+    layout = _read_layout(snapshot_path, journal_path)
+    if layout is not None:
+        count = layout["count"]
+        last = _read_messages(snapshot_path, layout, count - 1,
+                              count)[0] if count else None
+        _set_state(snapshot_path, journal_path,
+                   count, last, layout["records"])
+    else:
+        thread_json, records = _replay(snapshot_path, journal_path)
+        messages = thread_json["messages"]
+        _set_state(snapshot_path, journal_path, len(messages),
+                   messages[-1] if messages else None, records)
+
+    return _states[snapshot_path]
+
+
+def read_thread(thread_name: str, thread_folder: str):
+    """Read the thread from the snapshot and the journal
+
+    Args:
+        thread_name (str): Name of the thread
+        thread_folder (str): Folder where the thread is saved
+
+    Returns:
+        dict: Thread json with "config" and "messages" keys (same as the legacy thread file)
+    """
+    snapshot_path, journal_path = get_paths(thread_name, thread_folder)
+
+    if not os.path.exists(snapshot_path) and not os.path.exists(journal_path):
+        raise FileNotFoundError(f"Thread file not found: {snapshot_path}")
+
+    with _get_lock(snapshot_path):
+        thread_json, records = _replay(snapshot_path, journal_path)
+        messages = thread_json["messages"]
+        _set_state(snapshot_path, journal_path, len(messages),
+                   messages[-1] if messages else None, records)
+
+    return thread_json
+
+
+def read_range(thread_name: str, thread_folder: str, start: int = None, end: int = None, tail: int = None):
+    """Read the config, message count and a range of messages of the thread (through the index, if it is valid)
+
+    Args:
+        thread_name (str): Name of the thread
+        thread_folder (str): Folder where the thread is saved
+        start (int, optional): Index of the first message to read. Defaults to None (0).
+        end (int, optional): Index after the last message to read. Defaults to None (till the last message).
+        tail (int, optional): Read only the latest these many messages (overrides start). Defaults to None.
+
+    Returns:
+        dict: {"config": {...}, "count": total messages, "offset": index of first message read, "messages": [...]}
+    """
+    snapshot_path, journal_path = get_paths(thread_name, thread_folder)
+
+    if not os.path.exists(snapshot_path) and not os.path.exists(journal_path):
+        raise FileNotFoundError(f"Thread file not found: {snapshot_path}")
+
+    with _get_lock(snapshot_path):
+        layout = _read_layout(snapshot_path, journal_path)
+
+        # Thread has no index (legacy, or written before indexes), it is indexed now for next time:
+        if layout is None and os.path.exists(snapshot_path) and _index_snapshot(snapshot_path) is not None:
+            layout = _read_layout(snapshot_path, journal_path)
+
+        if layout is not None:
+            config, count = layout["config"], layout["count"]
+        else:
+            thread_json, _ = _replay(snapshot_path, journal_path)
+            config, count = thread_json["config"], len(thread_json["messages"])
+
+        end = count if end is None else min(end, count)
+        start = max(0, end - tail) if tail is not None else (start or 0)
+        start = min(start, end)
+
+        if layout is not None:
+            messages = _read_messages(snapshot_path, layout, start, end)
+        else:
+            messages = thread_json["messages"][start:end]
+
+    return {"config": config, "count": count, "offset": start, "messages": messages}
+
+
+def write_thread(messages: list[dict], config: dict, thread_name: str, thread_folder: str, offset: int = 0):
+    """Persist the thread, only the messages which are not yet on the disk are appended to the journal
+
+    Messages are expected to be append-only, except the last persisted message which may be updated.
+    If the thread has lost messages, the full snapshot is written again.
+
+    Args:
+        messages (list[dict]): Messages of the thread, from the offset till the latest one
+        config (dict): Config of the thread
+        thread_name (str): Name of the thread
+        thread_folder (str): Folder where the thread is saved
+        offset (int, optional): Index of the first message (older ones were not loaded, they are kept as on disk). Defaults to 0.
+    """
+    snapshot_path, journal_path = get_paths(thread_name, thread_folder)
+    total = offset + len(messages)
+
+    with _get_lock(snapshot_path):
+        state = _get_state(snapshot_path, journal_path)
+
+        # New thread, or messages were removed, write the full snapshot:
+        if state is None or not os.path.exists(snapshot_path) or total < state["count"]:
+            older = []
+            if offset:
+                older = _replay(snapshot_path, journal_path)[0]["messages"][:offset]
+                if len(older) < offset:
+                    raise ValueError(
+                        "Older messages of the thread are missing on the disk")
+
+            _write_snapshot(snapshot_path, journal_path, {
+                "config": config, "messages": older + messages})
+            _set_state(snapshot_path, journal_path, total,
+                       messages[-1] if messages else (older[-1] if older else None), 0)
+            return
+
+        count = state["count"]
+        if count < offset:
+            raise ValueError(
+                "Older messages of the thread are missing on the disk")
+
+        lines = []
+
+        # Last persisted message was updated (e.g. partial response completed):
+        if count > offset and _dumps(messages[count - 1 - offset]) != state["last"]:
+            lines.append(
+                _dumps({"i": count - 1, "message": messages[count - 1 - offset]}))
+
+        for ind in range(count, total):
+            lines.append(_dumps({"i": ind, "message": messages[ind - offset]}))
+
+        lines.append(_dumps({"config": config}))
+
+        with open(journal_path, "a") as file:
+            file.write("\n".join(lines) + "\n")
+            file.flush()
+            os.fsync(file.fileno())
+
+        last = messages[-1] if messages else None
+        if not messages and count:
+            last = json.loads(state["last"])
+        _set_state(snapshot_path, journal_path, total, last,
+                   state["records"] + len(lines))
+        needs_compaction = _states[snapshot_path]["records"] >= COMPACT_EVERY
+
+    if needs_compaction:
+        schedule_compaction(thread_name, thread_folder)
+
+
+def _compact(snapshot_path: str, journal_path: str):
+    """Merge the journal into the snapshot, lock of the thread must be held"""
+    # Thread was renamed or deleted while compaction was waiting:
+    if not os.path.exists(snapshot_path) and not os.path.exists(journal_path):
+        return
+
+    # Nothing to merge and index is up to date:
+    had_journal = os.path.exists(journal_path)
+    if not had_journal and _load_index(snapshot_path) is not None:
+        return
+
+    thread_json, _ = _replay(snapshot_path, journal_path)
+
+    # Files must still be the ones which were read, else the new snapshot would bring the thread back under this name:
+    if not os.path.exists(snapshot_path) and not os.path.exists(journal_path):
+        return
+    if had_journal and not os.path.exists(journal_path):
+        return
+
+    _write_snapshot(snapshot_path, journal_path, thread_json)
+    messages = thread_json["messages"]
+    _set_state(snapshot_path, journal_path, len(messages),
+               messages[-1] if messages else None, 0)
+
+
+def compact_thread(thread_name: str, thread_folder: str):
+    """Merge the journal of the thread into its snapshot (and index the snapshot, if it has no valid index)
+
+    Args:
+        thread_name (str): Name of the thread
+        thread_folder (str): Folder where the thread is saved
+    """
+    snapshot_path, journal_path = get_paths(thread_name, thread_folder)
+
+    with _get_lock(snapshot_path):
+        with _locks_guard:
+            _pending_compactions.discard(snapshot_path)
+        _compact(snapshot_path, journal_path)
+
+
+def _run_scheduled_compaction(thread_name: str, thread_folder: str):
+    """Compact the thread, unless it was renamed or deleted since it was scheduled"""
+    snapshot_path, journal_path = get_paths(thread_name, thread_folder)
+
+    with _get_lock(snapshot_path):
+        with _locks_guard:
+            if snapshot_path not in _pending_compactions:
+                return
+            _pending_compactions.discard(snapshot_path)
+        _compact(snapshot_path, journal_path)
+
+
+def schedule_compaction(thread_name: str, thread_folder: str):
+    """Compact the thread in a background thread (only once, if it is already queued)
+
+    Args:
+        thread_name (str): Name of the thread
+        thread_folder (str): Folder where the thread is saved
+    """
+    snapshot_path, _ = get_paths(thread_name, thread_folder)
+
+    with _locks_guard:
+        if snapshot_path in _pending_compactions:
+            return
+        _pending_compactions.add(snapshot_path)
+
+    threading.Thread(
+        target=_run_scheduled_compaction,
+        args=(thread_name, thread_folder),
+        daemon=True
+    ).start()
+
+
+def get_mtime(thread_name: str, thread_folder: str):
+    """Last modified time of the thread, considering both snapshot and journal
+
+    Args:
+        thread_name (str): Name of the thread
+        thread_folder (str): Folder where the thread is saved
+
+    Returns:
+        float: Modified time of the latest written file of the thread
+    """
+    snapshot_path, journal_path = get_paths(thread_name, thread_folder)
+    mtime = os.path.getmtime(snapshot_path)
+
+    if os.path.exists(journal_path):
+        mtime = max(mtime, os.path.getmtime(journal_path))
+
+    return mtime
+
+
+def forget_thread(thread_name: str, thread_folder: str):
+    """Drop the cached state and the pending compaction of the thread (after it is renamed or deleted)
+
+    Args:
+        thread_name (str): Name of the thread
+        thread_folder (str): Folder where the thread was saved
+    """
+    snapshot_path, _ = get_paths(thread_name, thread_folder)
+    _states.pop(snapshot_path, None)
+    with _locks_guard:
+        _pending_compactions.discard(snapshot_path)
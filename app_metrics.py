@@ -0,0 +1,79 @@
+# This code collects the generation metrics of the responses
+# Ollama sends the counts and durations (in nanoseconds) in the last chunk of the stream (done=True)
+# Time to first token is measured here, from sending the request to receiving the first content.
+# Metrics are stored with the assistant message in the thread json as:
+#   "metrics": {"model": ..., "ttft": 0.42, "eval_count": 350, "eval_duration": 7.1, "prompt_eval_count": 1200, ...}
+# Durations are converted to seconds.
+
+
+# Fields of the last chunk which are kept:
+COUNT_FIELDS = ["eval_count", "prompt_eval_count"]
+DURATION_FIELDS = ["eval_duration", "prompt_eval_duration",
+                   "load_duration", "total_duration"]
+
+
+def collect_metrics(final_chunk, model_name: str, ttft: float):
+    """Collect the metrics from the final chunk of the stream
+
+    Args:
+        final_chunk: Last chunk of the response stream (done=True)
+        model_name (str): Model which generated the response
+        ttft (float): Seconds from request to the first token (None if no token came)
+
+    Returns:
+        dict: Metrics of the response
+    """
+    metrics = {"model": model_name, "ttft": ttft}
+
+    for field in COUNT_FIELDS:
+        metrics[field] = getattr(final_chunk, field, None)
+
+    for field in DURATION_FIELDS:
+        value = getattr(final_chunk, field, None)
+        metrics[field] = value / 1e9 if value is not None else None
+
+    return metrics
+
+
+def tokens_per_second(count: int, duration: float):
+    """Tokens per second, None if it can not be calculated"""
+    if not count or not duration:
+        return None
+    return count / duration
+
+
+def format_metrics(metrics: dict):
+    """Format the metrics in a single line for the UI
+
+    Args:
+        metrics (dict): Metrics of the response
+
+    Returns:
+        str: Formatted metrics
+    """
+    parts = []
+
+    if metrics.get("cached"):
+        parts.append("♻️ cached")
+
+    speed = tokens_per_second(
+        metrics.get("eval_count"), metrics.get("eval_duration"))
+    if speed:
+        parts.append(f"⚡ {speed:.1f} tokens/s ({metrics['eval_count']} tokens)")
+
+    prompt_speed = tokens_per_second(
+        metrics.get("prompt_eval_count"), metrics.get("prompt_eval_duration"))
+    if prompt_speed:
+        parts.append(
+            f"prompt: {metrics['prompt_eval_count']} tokens in {metrics['prompt_eval_duration']:.2f}s ({prompt_speed:.0f} tokens/s)")
+
+    if metrics.get("ttft") is not None:
+        parts.append(f"first token: {metrics['ttft']:.2f}s")
+
+    if metrics.get("load_duration"):
+        parts.append(f"load: {metrics['load_duration']:.2f}s")
+
+    if metrics.get("model"):
+        parts.append(metrics["model"])
+
+    return " · ".join(parts)
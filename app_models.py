@@ -1,60 +1,207 @@
-# This code is for checking and stopping the running models:
-import os
-import subprocess
-
-def check_running_models(temp_folder: str):
-    """Check the running models and save the output to a filename.
-
-    Args:
-        temp_folder (str): Temporary folder to store the temp text file
+# This code is for listing the installed models (registry) and checking and stopping the running models:
+# All the calls go to the Ollama HTTP API through one shared client (no 'ollama' CLI processes)
+# Registry is shared by all the sessions of the app (process wide), so that reruns do not call the Ollama server
+# It is refreshed in background once it is older than REGISTRY_TTL seconds
+import time
+import ollama
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Client is shared, so the connections to the server are pooled (host is taken from OLLAMA_HOST env var):
+client = ollama.Client()
+
+# Seconds after which the registry is refreshed (in background):
+REGISTRY_TTL = 60
+
+_registry = {
+    "models": [],       # List of model dicts, in order of ollama.list()
+    "details": {},      # ollama.show() details per digest, so unchanged models are not shown again
+    "updated": 0.0,
+    "refreshing": False,
+}
+_registry_lock = threading.Lock()
+
+# How long the prewarmed model stays loaded (ollama keep_alive format):
+PREWARM_KEEP_ALIVE = "10m"
+
+# Model prewarmed within these many seconds is not prewarmed again (by any session):
+PREWARM_DEDUP_SECONDS = 60
+
+# Prewarm state of models, shared by all the sessions {model_name: time of last prewarm (None while it is loading)}
+_prewarmed = {}
+_prewarm_lock = threading.Lock()
+
+
+def _get_model_details(model_name: str):
+    """Get the capability details of the model from ollama.show()"""
+    show = client.show(model_name)
+    model_info = dict(getattr(show, "modelinfo", None) or {})
+    details = getattr(show, "details", None)
+    families = list(getattr(details, "families", None) or [])
+
+    context_length = None
+    for key, value in model_info.items():
+        if key.endswith(".context_length"):
+            context_length = value
+            break
+
+    # Newer servers list the capabilities directly, else vision is detected from the projector / vision tower:
+    capabilities = getattr(show, "capabilities", None)
+    if capabilities is not None:
+        vision = "vision" in capabilities
+    else:
+        vision = (
+            any(family in ("clip", "mllama") for family in families)
+            or any(".vision." in key for key in model_info)
+        )
+
+    return {"context_length": context_length, "vision": vision}
+
+
+def refresh_registry():
+    """Reload the installed models and their details from the Ollama server"""
+    try:
+        models = []
+        details_cache = dict(_registry["details"])
+
+        for model in client.list()["models"]:
+            if model["digest"] not in details_cache:
+                try:
+                    details_cache[model["digest"]] = _get_model_details(
+                        model["model"])
+                except Exception:
+                    details_cache[model["digest"]] = {
+                        "context_length": None, "vision": None}
+
+            models.append({
+                "name": model["model"],
+                "family": model["details"]["family"],
+                "parameter_size": model["details"]["parameter_size"],
+                "digest": model["digest"],
+                **details_cache[model["digest"]]
+            })
+
+        with _registry_lock:
+            _registry["models"] = models
+            _registry["details"] = details_cache
+            _registry["updated"] = time.time()
+
+    finally:
+        _registry["refreshing"] = False
+
+
+def get_models():
+    """Get the installed models from the registry (loaded on first call, later refreshed in background)
 
     Returns:
-        str: Filename of the text file
+        list: List of dicts with name, family, parameter_size, digest, context_length and vision of the models
     """
+    if not _registry["models"]:
+        refresh_registry()
 
-    filename = f"{temp_folder}/tmp_running_models.txt"
+    elif time.time() - _registry["updated"] > REGISTRY_TTL:
+        with _registry_lock:
+            start = not _registry["refreshing"]
+            _registry["refreshing"] = True
 
-    # Clear the file if it already exists
-    if os.path.exists(filename):
-        os.remove(filename)
+        if start:
+            threading.Thread(target=refresh_registry, daemon=True).start()
 
-    # Run the command and save the output to the file
-    subprocess.run(["ollama", "ps"], stdout=open(filename, "w"))
+    return _registry["models"]
 
-    return filename
 
+def get_model_info(model_name: str):
+    """Get the registry entry of the model
 
-def get_running_models(temp_folder: str):
-    """Get the running models from the file as a list.
-    
     Args:
-        temp_folder (str): Temporary folder to store the temp text file
+        model_name (str): Name of the model
 
     Returns:
-        list: List of running models
+        dict: Entry of the model (None if it is not installed)
     """
+    for model in get_models():
+        if model["name"] == model_name:
+            return model
+    return None
 
-    filename = check_running_models(temp_folder=temp_folder)
-    running_models = []
-    ind = 0
 
-    with open(filename, "r") as file:
-        for line_no, line_content in enumerate(file.readlines()):
-            if line_no == 0:
-                ind = line_content.find("ID")
-            else:
-                running_models.append(line_content[:ind].strip())
+def get_running_models():
+    """Get the running (loaded) models from the Ollama server
+
+    Returns:
+        list: List of dicts with name, size, size_vram (bytes) and expires_at (datetime) of the running models
+    """
+    running_models = []
+    for model in client.ps()["models"]:
+        running_models.append({
+            "name": model["name"],
+            "size": model["size"],
+            "size_vram": model["size_vram"],
+            "expires_at": model["expires_at"],
+        })
 
     return running_models
 
 
+def stop_model(model_name: str):
+    """Unload the model from the memory (same as 'ollama stop')
+
+    Args:
+        model_name (str): Name of the model
+    """
+    client.generate(model=model_name, prompt="", keep_alive=0)
+
+
 def stop_running_models(running_models: list):
-    """Stop the running models.
-    
+    """Stop the running models, all at once.
+
     Args:
-        running_models (list): List of running models
+        running_models (list): List of running model names (or dicts from get_running_models)
     """
-    for model in running_models:
-        subprocess.run(["ollama", "stop", model])
-        
+    names = [model["name"] if isinstance(model, dict) else model
+             for model in running_models]
+
+    if not names:
+        return
+
+    with ThreadPoolExecutor(max_workers=len(names)) as pool:
+        # list() to raise the error of any failed stop here
+        list(pool.map(stop_model, names))
+
+
+def _prewarm(model_name: str, keep_alive: str):
+    """Load the model with an empty prompt (runs in background thread)"""
+    try:
+        client.generate(model=model_name, prompt="", keep_alive=keep_alive)
+        with _prewarm_lock:
+            _prewarmed[model_name] = time.time()
+    except Exception:
+        # Failed prewarm is not an error for user, model is loaded by the first prompt then
+        with _prewarm_lock:
+            _prewarmed.pop(model_name, None)
 
+
+def prewarm_model(model_name: str, keep_alive: str = None):
+    """Load the model in background, so that first response of the thread does not wait for model load
+
+    Args:
+        model_name (str): Name of the model
+        keep_alive (str, optional): How long the model stays loaded. Defaults to PREWARM_KEEP_ALIVE.
+
+    Returns:
+        bool: True if prewarm was started, False if it is already loading or was loaded recently
+    """
+    with _prewarm_lock:
+        if model_name in _prewarmed:
+            last = _prewarmed[model_name]
+            if last is None or time.time() - last < PREWARM_DEDUP_SECONDS:
+                return False
+        _prewarmed[model_name] = None
+
+    threading.Thread(
+        target=_prewarm,
+        args=(model_name, keep_alive or PREWARM_KEEP_ALIVE),
+        daemon=True
+    ).start()
+    return True
@@ -0,0 +1,109 @@
+# This code splits the responses of the "thinking" models in reasoning and answer
+# Reasoning models write their thinking first, inside the <think> ... </think> tags, and then the answer
+# While streaming, tags can come split in many chunks, so ReasoningSplitter holds back the text which may be part of a tag
+# New messages store the parts separately ("reasoning" and "content"), so history is never parsed again
+# Old messages (full response in "content") are parsed by split_reasoning, which is cached
+
+
+from functools import lru_cache
+
+
+THINK_START = "<think>"
+THINK_END = "</think>"
+
+
+@lru_cache(maxsize=1024)
+def split_reasoning(text: str):
+    """Split the full response in reasoning and answer
+
+    Args:
+        text (str): Full response of the model
+
+    Returns:
+        tuple: (reasoning, answer), reasoning is None if the response has no thinking part
+    """
+    start = text.find(THINK_START)
+    if start == -1:
+        return None, text
+
+    end = text.find(THINK_END, start)
+
+    # Thinking was cut before it ended (incomplete response)
+    if end == -1:
+        return text[start + len(THINK_START):].strip(), ""
+
+    reasoning = text[start + len(THINK_START): end].strip()
+    answer = (text[:start] + text[end + len(THINK_END):]).strip()
+    return reasoning, answer
+
+
+class ReasoningSplitter:
+    """Routes the streamed chunks of response to reasoning or answer, as they come"""
+
+    def __init__(self):
+        self.in_think = False
+        self.buffer = ""
+        self.reasoning = []
+        self.answer = []
+
+    def _emit(self, text: str, parts: list):
+        """Add the text to the current part"""
+        if not text:
+            return
+        kind = "reasoning" if self.in_think else "answer"
+        getattr(self, kind).append(text)
+        parts.append((kind, text))
+
+    def feed(self, text: str):
+        """Feed the next chunk of the stream
+
+        Args:
+            text (str): Chunk of the response
+
+        Returns:
+            list: List of (kind, text) parts, kind is "reasoning" or "answer"
+        """
+        parts = []
+        self.buffer += text
+
+        while True:
+            tag = THINK_END if self.in_think else THINK_START
+            ind = self.buffer.find(tag)
+
+            if ind != -1:
+                self._emit(self.buffer[:ind], parts)
+                self.buffer = self.buffer[ind + len(tag):]
+                self.in_think = not self.in_think
+                continue
+
+            # End of buffer may be the start of a tag, it is held till next chunk
+            keep = 0
+            for size in range(min(len(tag) - 1, len(self.buffer)), 0, -1):
+                if tag.startswith(self.buffer[-size:]):
+                    keep = size
+                    break
+
+            self._emit(self.buffer[:len(self.buffer) - keep], parts)
+            self.buffer = self.buffer[len(self.buffer) - keep:]
+            return parts
+
+    def finish(self):
+        """Flush the held back text at the end of the stream
+
+        Returns:
+            list: List of (kind, text) parts
+        """
+        parts = []
+        self._emit(self.buffer, parts)
+        self.buffer = ""
+        return parts
+
+    def get_reasoning(self):
+        """Reasoning received till now (None if model did not think)"""
+        if not self.reasoning:
+            return None
+        return "".join(self.reasoning).strip()
+
+    def get_answer(self):
+        """Answer received till now"""
+        return "".join(self.answer).strip()
@@ -0,0 +1,118 @@
+# This code caches the responses of the model for the deterministic requests (opt-in)
+# Request is deterministic if temperature is 0 or a fixed seed is given, then same request gives the same response anyway
+# Key = hash of model name + messages (role, content and hashes of images) + generation options
+# Cached responses are kept in memory and on disk (both bounded by size, least recently used are evicted)
+# On hit, cached response is replayed as a stream, so UI works the same way as with the model.
+
+
+import json
+import hashlib
+from app_cache import LRUCache
+
+
+# Characters per chunk, while replaying the cached response:
+REPLAY_CHUNK_CHARS = 24
+
+_cache = None
+
+
+def configure(cache_folder: str, max_bytes: int = 16 * 1024 * 1024, disk_max_bytes: int = 256 * 1024 * 1024):
+    """Set up the response cache (it is shared by all the sessions, so it is created only once)
+
+    Args:
+        cache_folder (str): Folder to keep the cached responses
+        max_bytes (int, optional): Max size of responses kept in memory. Defaults to 16 MB.
+        disk_max_bytes (int, optional): Max size of responses kept on disk. Defaults to 256 MB.
+    """
+    global _cache
+    if _cache is None:
+        _cache = LRUCache(
+            max_bytes=max_bytes,
+            disk_folder=cache_folder,
+            disk_max_bytes=disk_max_bytes,
+            # Responses are small and costly to generate again, so they are kept on disk across restarts:
+            write_through=True
+        )
+
+
+def is_deterministic(options: dict):
+    """Check if the generation options give same response every time
+
+    Args:
+        options (dict): Generation options of the request
+
+    Returns:
+        bool: True if temperature is 0 or seed is fixed
+    """
+    return options.get("temperature") == 0 or options.get("seed") is not None
+
+
+def make_key(model_name: str, messages: list[dict], options: dict):
+    """Make the cache key of the request
+
+    Args:
+        model_name (str): Name of the model
+        messages (list[dict]): Messages of the request (with base64 images)
+        options (dict): Generation options of the request
+
+    Returns:
+        str: Hex digest of the request
+    """
+    sanitized = []
+    for message in messages:
+        sanitized.append({
+            "role": message["role"],
+            "content": message["content"],
+            "images": [hashlib.sha256(image.encode("utf-8")).hexdigest()
+                       for image in message.get("images", [])]
+        })
+
+    payload = json.dumps(
+        {"model": model_name, "messages": sanitized, "options": options},
+        sort_keys=True
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def get_response(key: str):
+    """Get the cached response of the request
+
+    Args:
+        key (str): Cache key of the request
+
+    Returns:
+        dict: Dictionary with "text" and "metrics" of the response (None if not cached)
+    """
+    if _cache is None:
+        return None
+
+    value = _cache.get(key)
+    if value is None:
+        return None
+    return json.loads(value)
+
+
+def put_response(key: str, text: str, metrics: dict):
+    """Cache the full response of the request
+
+    Args:
+        key (str): Cache key of the request
+        text (str): Full response of the model
+        metrics (dict): Generation metrics of the response
+    """
+    if _cache is None:
+        return
+    _cache.put(key, json.dumps({"text": text, "metrics": metrics}))
+
+
+def replay(text: str):
+    """Replay the cached response as a stream
+
+    Args:
+        text (str): Cached response
+
+    Yields:
+        str: Chunks of the response
+    """
+    for ind in range(0, len(text), REPLAY_CHUNK_CHARS):
+        yield text[ind: ind + REPLAY_CHUNK_CHARS]
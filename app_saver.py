@@ -0,0 +1,149 @@
+# This code saves the threads in the background (write-behind), so the UI never waits for the disk
+# Saves are queued per thread, a newer save of the same thread replaces the pending one (coalescing)
+# Pending save is written once the thread is quiet for DEBOUNCE_SECONDS, but never later than MAX_DELAY_SECONDS after it was queued
+# Writes go through app_threads.save_conversation (snapshots are written to temp file + renamed, see app_journal.py)
+# Status of each thread ("last_saved" timestamp of the last durable write, pending or not, last error) is kept for the UI
+# Pending saves are flushed before the thread is renamed, deleted or loaded, and when the process exits.
+
+
+import time
+import atexit
+import threading
+import app_threads
+
+
+DEBOUNCE_SECONDS = 0.3
+MAX_DELAY_SECONDS = 2.0
+
+
+class WriteBehindSaver:
+    """Background writer of the threads, one pending save per thread"""
+
+    def __init__(self, debounce: float = DEBOUNCE_SECONDS, max_delay: float = MAX_DELAY_SECONDS):
+        self.debounce = debounce
+        self.max_delay = max_delay
+
+        self._condition = threading.Condition()
+        self._pending = {}        # {(thread_folder, thread_name): job}
+        self._writing = None      # Key of the thread being written now
+        self._status = {}         # {(thread_folder, thread_name): {"last_saved": ..., "error": ...}}
+        self._flushing = 0
+        self._worker = None
+
+    def _due_in(self, job: dict, now: float):
+        """Seconds till the pending save is due (0 or less if due now)"""
+        if self._flushing:
+            return 0
+        return min(job["last"] + self.debounce, job["first"] + self.max_delay) - now
+
+    def _run(self):
+        """Write the due saves, one at a time"""
+        while True:
+            with self._condition:
+                while True:
+                    now = time.monotonic()
+                    waits = {key: self._due_in(job, now)
+                             for key, job in self._pending.items()}
+                    due = [key for key, wait in waits.items() if wait <= 0]
+                    if due:
+                        break
+                    self._condition.wait(min(waits.values()) if waits else None)
+
+                key = due[0]
+                job = self._pending.pop(key)
+                self._writing = key
+
+            thread_folder, thread_name = key
+            resp = app_threads.save_conversation(
+                messages=job["messages"],
+                thread_name=thread_name,
+                model_name=job["model_name"],
+                thread_folder=thread_folder,
+                offset=job["offset"]
+            )
+
+            with self._condition:
+                self._writing = None
+                status = self._status.setdefault(
+                    key, {"last_saved": None, "error": None})
+                if resp["status"] == "error":
+                    status["error"] = resp["message"]
+                else:
+                    status["last_saved"] = resp["timestamp"]
+                    status["error"] = None
+                self._condition.notify_all()
+
+    def submit(self, messages: list[dict], thread_name: str, model_name: str, thread_folder: str, offset: int = 0):
+        """Queue the save of the thread (replaces the pending save of the same thread)
+
+        Args:
+            messages (list[dict]): List of messages to save
+            thread_name (str): Name of the thread to save
+            model_name (str): Name of the model used in the thread
+            thread_folder (str): Folder where the thread is saved
+            offset (int, optional): Index of the first message, when only the latest messages were loaded. Defaults to 0.
+        """
+        key = (thread_folder, thread_name)
+        # Messages are copied, since the session keeps changing them while the save is pending
+        messages = [dict(message) for message in messages]
+
+        with self._condition:
+            now = time.monotonic()
+            previous = self._pending.get(key)
+            self._pending[key] = {
+                "messages": messages,
+                "model_name": model_name,
+                "offset": offset,
+                "first": previous["first"] if previous else now,
+                "last": now,
+            }
+
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, daemon=True)
+                self._worker.start()
+
+            self._condition.notify_all()
+
+    def flush(self, timeout: float = None):
+        """Write all the pending saves now and wait till they are on the disk
+
+        Args:
+            timeout (float, optional): Seconds to wait. Defaults to None (wait till done).
+
+        Returns:
+            bool: True if nothing is pending anymore
+        """
+        with self._condition:
+            self._flushing += 1
+            self._condition.notify_all()
+            try:
+                return self._condition.wait_for(
+                    lambda: not self._pending and self._writing is None, timeout)
+            finally:
+                self._flushing -= 1
+
+    def status(self, thread_name: str, thread_folder: str):
+        """Save status of the thread
+
+        Args:
+            thread_name (str): Name of the thread
+            thread_folder (str): Folder where the thread is saved
+
+        Returns:
+            dict: {"pending": bool, "last_saved": timestamp of last durable save or None, "error": message or None}
+        """
+        key = (thread_folder, thread_name)
+        with self._condition:
+            status = self._status.get(key, {})
+            return {
+                "pending": key in self._pending or self._writing == key,
+                "last_saved": status.get("last_saved"),
+                "error": status.get("error"),
+            }
+
+
+# Saver of this server process, shared by all the sessions:
+saver = WriteBehindSaver()
+
+# Pending saves are written before the app exits:
+atexit.register(saver.flush)
@@ -0,0 +1,168 @@
+# This code schedules the generation requests of all the sessions (users) of the app
+# One scheduler is shared by the whole server process, every request to the model takes a ticket and waits for its turn
+# Limits:
+#   - MAX_GLOBAL    : Requests generating at the same time (over all models)
+#   - MAX_PER_MODEL : Requests generating at the same time on one model
+# To avoid swapping the models in and out of the memory, waiting requests of the already loaded models go first.
+# Request waiting longer than MAX_WAIT_SECONDS goes first anyway, so no one waits forever.
+
+
+import time
+import itertools
+import threading
+from contextlib import contextmanager
+
+
+MAX_GLOBAL = 2
+MAX_PER_MODEL = 1
+MAX_WAIT_SECONDS = 30
+
+# Number of recently used models considered as loaded in the memory:
+LOADED_MODELS = 1
+
+
+class Ticket:
+    """Place of one request in the scheduler"""
+
+    def __init__(self, ticket_id: int, model_name: str):
+        self.id = ticket_id
+        self.model_name = model_name
+        self.created = time.time()
+        self.started = None
+
+
+class RequestScheduler:
+    """Queue of the generation requests, with global and per model concurrency limits"""
+
+    def __init__(self, max_global: int = MAX_GLOBAL, max_per_model: int = MAX_PER_MODEL):
+        self.max_global = max_global
+        self.max_per_model = max_per_model
+
+        self._condition = threading.Condition()
+        self._ids = itertools.count()
+        self._waiting = []
+        self._running = {}        # {model_name: number of running requests}
+        self._loaded = []         # Recently used models, latest at the end
+
+    def _is_loaded(self, model_name: str):
+        """Model is running now, or was used recently (probably still in memory)"""
+        return self._running.get(model_name, 0) > 0 or model_name in self._loaded[-LOADED_MODELS:]
+
+    def _dispatch(self):
+        """Start the waiting requests, as long as the limits allow (called with the lock held)"""
+        while sum(self._running.values()) < self.max_global:
+            candidates = [
+                ticket for ticket in self._waiting
+                if self._running.get(ticket.model_name, 0) < self.max_per_model
+            ]
+            if not candidates:
+                return
+
+            # Loaded models (and requests waiting too long) go first, else the oldest request:
+            now = time.time()
+            preferred = [
+                ticket for ticket in candidates
+                if self._is_loaded(ticket.model_name) or now - ticket.created > MAX_WAIT_SECONDS
+            ]
+            ticket = (preferred or candidates)[0]
+
+            self._waiting.remove(ticket)
+            ticket.started = now
+            self._running[ticket.model_name] = self._running.get(
+                ticket.model_name, 0) + 1
+
+            if ticket.model_name in self._loaded:
+                self._loaded.remove(ticket.model_name)
+            self._loaded.append(ticket.model_name)
+
+        self._condition.notify_all()
+
+    def submit(self, model_name: str):
+        """Take a ticket for a request to the model
+
+        Args:
+            model_name (str): Name of the model
+
+        Returns:
+            Ticket: Ticket of the request
+        """
+        with self._condition:
+            ticket = Ticket(next(self._ids), model_name)
+            self._waiting.append(ticket)
+            self._dispatch()
+            return ticket
+
+    def position(self, ticket: Ticket):
+        """Position of the ticket in the queue
+
+        Args:
+            ticket (Ticket): Ticket of the request
+
+        Returns:
+            int: 0 if the request has started, else 1 based position in the queue
+        """
+        with self._condition:
+            if ticket.started:
+                return 0
+            return self._waiting.index(ticket) + 1
+
+    def wait(self, ticket: Ticket, timeout: float = None):
+        """Wait till the request can start
+
+        Args:
+            ticket (Ticket): Ticket of the request
+            timeout (float, optional): Seconds to wait. Defaults to None (wait till it starts).
+
+        Returns:
+            bool: True if request has started
+        """
+        with self._condition:
+            # Waiting too long may make the request preferred now
+            self._dispatch()
+            return self._condition.wait_for(lambda: ticket.started is not None, timeout)
+
+    def release(self, ticket: Ticket):
+        """Finish (or cancel) the request, so that next ones can start
+
+        Args:
+            ticket (Ticket): Ticket of the request
+        """
+        with self._condition:
+            if ticket.started is None:
+                if ticket in self._waiting:
+                    self._waiting.remove(ticket)
+            else:
+                self._running[ticket.model_name] -= 1
+                if not self._running[ticket.model_name]:
+                    del self._running[ticket.model_name]
+            self._dispatch()
+
+    @contextmanager
+    def slot(self, model_name: str):
+        """Wait for the turn and hold the slot till the block ends
+
+        Args:
+            model_name (str): Name of the model
+
+        Yields:
+            Ticket: Started ticket
+        """
+        ticket = self.submit(model_name)
+        try:
+            self.wait(ticket)
+            yield ticket
+        finally:
+            self.release(ticket)
+
+    def status(self):
+        """Current state of the scheduler
+
+        Returns:
+            dict: Numbers of running requests per model and of waiting requests
+        """
+        with self._condition:
+            return {"running": dict(self._running), "waiting": len(self._waiting)}
+
+
+# Scheduler of this server process, shared by all the sessions:
+scheduler = RequestScheduler()
@@ -0,0 +1,410 @@
+# This code maintains the full text search index over the messages of all the threads
+# Index is kept in "<thread_folder>/.index/" (next to the catalog) as:
+#   - "search.json"  : Snapshot of the indexed documents {"generation": N, "docs": {thread_name: {"count": .., "last": .., "messages": {index: doc}}}}
+#   - "search.N.jsonl" : Log of the updates made after the snapshot of generation N, one json record per line ("search.jsonl" for 0)
+# Once the log is larger than the snapshot, it is merged into a new snapshot in a background thread:
+#   generation is bumped (new records go to the next log), snapshot is written, then the older logs are removed.
+#   If the app stops in between, the older snapshot is read with both logs, so no record is lost or applied twice.
+# Document of a message is {"tf": {term: count}, "length": number of terms, "snippet": first part of content}
+# Inverted index (term -> thread -> message index -> count) is built in memory from the documents, when loaded.
+# Like the journal of threads, messages are expected to be append-only except the last one, so only new messages are indexed on save.
+# Results are ranked with BM25.
+
+
+import os
+import re
+import json
+import math
+import hashlib
+import threading
+import app_catalog
+import app_storage
+
+
+# Log is merged into the snapshot once it is larger than the snapshot, and at least these many bytes:
+COMPACT_MIN_BYTES = 1024 * 1024
+
+# Length of the snippet of message stored for the results:
+SNIPPET_CHARS = 160
+
+# BM25 parameters:
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+_lock = threading.Lock()
+
+# Loaded indexes {thread_folder: {"docs": {...}, "postings": {...}, "total_docs": int, "total_length": int,
+#                                 "generation": int, "log_bytes": int, "snapshot_bytes": int, "compacting": bool}}
+_indexes = {}
+
+
+def tokenize(text: str):
+    """Split the text in lower case terms (words of 2 or more characters)
+
+    Args:
+        text (str): Text to split
+
+    Returns:
+        list: List of terms
+    """
+    return [term for term in re.findall(r"\w+", text.lower()) if len(term) > 1]
+
+
+def _get_snapshot_path(thread_folder: str):
+    """Get the search snapshot path"""
+    index_folder = os.path.join(thread_folder, app_catalog.INDEX_FOLDER)
+    os.makedirs(index_folder, exist_ok=True)
+    return os.path.join(index_folder, "search.json")
+
+
+def _get_log_path(thread_folder: str, generation: int):
+    """Get the path of the log written after the snapshot of the generation"""
+    index_folder = os.path.join(thread_folder, app_catalog.INDEX_FOLDER)
+    if not generation:
+        return os.path.join(index_folder, "search.jsonl")
+    return os.path.join(index_folder, f"search.{generation}.jsonl")
+
+
+def _hash(message: dict):
+    """Hash of the message content, to detect the update of the last message"""
+    return hashlib.sha1(message.get("content", "").encode("utf-8")).hexdigest()
+
+
+def _make_doc(message: dict):
+    """Create the document of the message"""
+    content = message.get("content", "")
+    tf = {}
+    terms = tokenize(content)
+    for term in terms:
+        tf[term] = tf.get(term, 0) + 1
+
+    return {"tf": tf, "length": len(terms), "snippet": content[:SNIPPET_CHARS]}
+
+
+def _add_postings(index: dict, thread_name: str, ind: str, doc: dict):
+    """Add the terms of the document to the inverted index"""
+    index["total_docs"] += 1
+    index["total_length"] += doc["length"]
+    for term, count in doc["tf"].items():
+        index["postings"].setdefault(term, {}).setdefault(
+            thread_name, {})[ind] = count
+
+
+def _remove_postings(index: dict, thread_name: str, ind: str, doc: dict):
+    """Remove the terms of the document from the inverted index"""
+    index["total_docs"] -= 1
+    index["total_length"] -= doc["length"]
+    for term in doc["tf"]:
+        threads = index["postings"].get(term, {})
+        threads.get(thread_name, {}).pop(ind, None)
+        if thread_name in threads and not threads[thread_name]:
+            del threads[thread_name]
+        if not threads:
+            index["postings"].pop(term, None)
+
+
+def _drop_thread(index: dict, thread_name: str):
+    """Remove the thread and all its postings from the loaded index"""
+    thread = index["docs"].pop(thread_name, None)
+    if thread:
+        for ind, doc in thread["messages"].items():
+            _remove_postings(index, thread_name, ind, doc)
+    return thread
+
+
+def _apply(index: dict, record: dict):
+    """Apply a single log record on the loaded index"""
+    docs = index["docs"]
+
+    if "put" in record:
+        thread = docs.setdefault(
+            record["put"], {"count": 0, "last": None, "messages": {}})
+        ind = str(record["i"])
+
+        if ind in thread["messages"]:
+            _remove_postings(index, record["put"], ind, thread["messages"][ind])
+        thread["messages"][ind] = record["doc"]
+        _add_postings(index, record["put"], ind, record["doc"])
+
+        thread["count"] = max(thread["count"], record["i"] + 1)
+        thread["last"] = record["last"]
+
+    elif "trim" in record:
+        thread = docs.get(record["trim"])
+        if thread:
+            for ind in [ind for ind in thread["messages"] if int(ind) >= record["count"]]:
+                _remove_postings(index, record["trim"], ind,
+                                 thread["messages"].pop(ind))
+            thread["count"] = min(thread["count"], record["count"])
+
+    elif "drop" in record:
+        _drop_thread(index, record["drop"])
+
+    elif "rename" in record:
+        thread = _drop_thread(index, record["rename"])
+        if thread:
+            # Thread may be renamed onto the name of an indexed thread, which is replaced:
+            _drop_thread(index, record["to"])
+            for ind, doc in thread["messages"].items():
+                _add_postings(index, record["to"], ind, doc)
+            docs[record["to"]] = thread
+
+
+def _read_index(thread_folder: str):
+    """Read the snapshot and the logs, and build the inverted index"""
+    snapshot_path = _get_snapshot_path(thread_folder)
+    index = {"docs": {}, "postings": {}, "total_docs": 0, "total_length": 0,
+             "generation": 0, "log_bytes": 0, "snapshot_bytes": 0, "compacting": False}
+
+    if os.path.exists(snapshot_path):
+        try:
+            with open(snapshot_path, "r") as file:
+                snapshot = json.load(file)
+            index["snapshot_bytes"] = os.path.getsize(snapshot_path)
+        except ValueError:
+            snapshot = {}
+
+        # Snapshots of older versions have only the docs (and are followed by "search.jsonl"):
+        if isinstance(snapshot.get("generation"), int) and isinstance(snapshot.get("docs"), dict):
+            index["generation"] = snapshot["generation"]
+            index["docs"] = snapshot["docs"]
+        else:
+            index["docs"] = snapshot
+
+    for thread_name, thread in index["docs"].items():
+        for ind, doc in thread["messages"].items():
+            _add_postings(index, thread_name, ind, doc)
+
+    # Logs of older generations are already in the snapshot (left if the app stopped while compacting):
+    for generation in range(index["generation"]):
+        log_path = _get_log_path(thread_folder, generation)
+        if os.path.exists(log_path):
+            os.remove(log_path)
+
+    # Log of the snapshot's generation, and of the next one if the app stopped while compacting:
+    generation = index["generation"]
+    while os.path.exists(_get_log_path(thread_folder, generation)):
+        index["generation"] = generation
+        log_path = _get_log_path(thread_folder, generation)
+        with open(log_path, "r") as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                _apply(index, record)
+        index["log_bytes"] += os.path.getsize(log_path)
+        generation += 1
+
+    return index
+
+
+def _compact(thread_folder: str, index: dict):
+    """Merge the log into a new snapshot (runs in background, index is locked only while it is serialized)"""
+    try:
+        with _lock:
+            # Index was loaded again meanwhile, it compacts itself:
+            if _indexes.get(thread_folder) is not index:
+                return
+            index["generation"] += 1
+            generation = index["generation"]
+            data = json.dumps({"generation": generation, "docs": index["docs"]})
+            index["log_bytes"] = 0
+
+        snapshot_path = _get_snapshot_path(thread_folder)
+        tmp_path = snapshot_path + ".tmp"
+        with open(tmp_path, "w") as file:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, snapshot_path)
+
+        # Logs are removed only after the snapshot is in place:
+        for older in range(generation):
+            log_path = _get_log_path(thread_folder, older)
+            if os.path.exists(log_path):
+                os.remove(log_path)
+
+        with _lock:
+            index["snapshot_bytes"] = len(data)
+
+    finally:
+        with _lock:
+            index["compacting"] = False
+
+
+def _write_records(thread_folder: str, index: dict, records: list[dict]):
+    """Apply the records to the index and append them to the log, compact the log in background if it is too long"""
+    if not records:
+        return
+
+    for record in records:
+        _apply(index, record)
+
+    data = "".join(json.dumps(record) + "\n" for record in records)
+    with open(_get_log_path(thread_folder, index["generation"]), "a") as file:
+        file.write(data)
+    index["log_bytes"] += len(data)
+
+    if index["compacting"] or index["log_bytes"] < max(index["snapshot_bytes"], COMPACT_MIN_BYTES):
+        return
+
+    index["compacting"] = True
+    threading.Thread(target=_compact, args=(
+        thread_folder, index), daemon=True).start()
+
+
+def _thread_records(thread_name: str, messages: list[dict], thread: dict, offset: int = 0):
+    """Records to index the new (and updated last) messages of the thread (messages start at the offset)"""
+    records = []
+    count = thread["count"] if thread else 0
+    total = offset + len(messages)
+
+    # Messages were removed, given messages are indexed again
+    if thread and total < count:
+        records.append({"trim": thread_name, "count": offset})
+        count = offset
+
+    # Last indexed message was updated (e.g. partial response completed):
+    start = max(count, offset)
+    if count > offset and _hash(messages[count - 1 - offset]) != thread["last"]:
+        start = count - 1
+
+    for ind in range(start, total):
+        records.append({
+            "put": thread_name,
+            "i": ind,
+            "doc": _make_doc(messages[ind - offset]),
+            "last": _hash(messages[ind - offset])
+        })
+
+    return records
+
+
+def _get_index(thread_folder: str):
+    """Get the loaded index of the folder, threads missing from it (saved before the index existed) are indexed once"""
+    index = _indexes.get(thread_folder)
+    if index is not None:
+        return index
+
+    index = _read_index(thread_folder)
+    _indexes[thread_folder] = index
+
+    thread_names = app_storage.get_backend().list_threads(thread_folder)
+    records = [{"drop": name}
+               for name in index["docs"] if name not in set(thread_names)]
+
+    for thread_name in thread_names:
+        if thread_name in index["docs"]:
+            continue
+        try:
+            thread_json = app_storage.get_backend().read(thread_name, thread_folder)
+        except (OSError, ValueError):
+            continue
+        records.extend(_thread_records(
+            thread_name, thread_json.get("messages", []), None))
+
+    _write_records(thread_folder, index, records)
+    return index
+
+
+def update_thread(thread_name: str, thread_folder: str, messages: list[dict], offset: int = 0):
+    """Index the new messages of the thread after it is saved
+
+    Args:
+        thread_name (str): Name of the thread
+        thread_folder (str): Folder where the threads are saved
+        messages (list[dict]): Messages of the thread (from the offset)
+        offset (int, optional): Index of the first given message. Defaults to 0.
+    """
+    with _lock:
+        index = _get_index(thread_folder)
+        records = _thread_records(
+            thread_name, messages, index["docs"].get(thread_name), offset)
+        _write_records(thread_folder, index, records)
+
+
+def rename_thread(old_thread_name: str, new_thread_name: str, thread_folder: str):
+    """Move the indexed messages of the thread to its new name
+
+    Args:
+        old_thread_name (str): Old name of the thread
+        new_thread_name (str): New name of the thread
+        thread_folder (str): Folder where the threads are saved
+    """
+    with _lock:
+        index = _get_index(thread_folder)
+        _write_records(thread_folder, index, [
+                       {"rename": old_thread_name, "to": new_thread_name}])
+
+
+def remove_thread(thread_name: str, thread_folder: str):
+    """Remove the indexed messages of the thread (after it is deleted)
+
+    Args:
+        thread_name (str): Name of the thread
+        thread_folder (str): Folder where the threads are saved
+    """
+    with _lock:
+        index = _get_index(thread_folder)
+        _write_records(thread_folder, index, [{"drop": thread_name}])
+
+
+def search(query: str, thread_folder: str, limit: int = 20):
+    """Search the messages of all the threads
+
+    Args:
+        query (str): Text to search
+        thread_folder (str): Folder where the threads are saved
+        limit (int, optional): Max number of results. Defaults to 20.
+
+    Returns:
+        list: List of hits (dicts with thread_name, index of message, score and snippet), best first
+    """
+    terms = set(tokenize(query))
+    if not terms:
+        return []
+
+    with _lock:
+        index = _get_index(thread_folder)
+        docs = index["docs"]
+
+        total_docs = index["total_docs"]
+        if not total_docs:
+            return []
+        avg_length = index["total_length"] / total_docs
+
+        scores = {}
+        for term in terms:
+            threads = index["postings"].get(term)
+            if not threads:
+                continue
+
+            doc_freq = sum(len(messages) for messages in threads.values())
+            idf = math.log(1 + (total_docs - doc_freq + 0.5) / (doc_freq + 0.5))
+
+            for thread_name, messages in threads.items():
+                thread = docs.get(thread_name)
+                for ind, tf in messages.items():
+                    # Postings without a document (left by an older index) are skipped
+                    doc = thread["messages"].get(ind) if thread else None
+                    if doc is None:
+                        continue
+                    length = doc["length"]
+                    norm = BM25_K1 * (1 - BM25_B + BM25_B *
+                                      length / (avg_length or 1))
+                    score = idf * tf * (BM25_K1 + 1) / (tf + norm)
+                    key = (thread_name, ind)
+                    scores[key] = scores.get(key, 0) + score
+
+        best = sorted(scores.items(), key=lambda x: x[1], reverse=True)[:limit]
+
+        return [
+            {
+                "thread_name": thread_name,
+                "index": int(ind),
+                "score": score,
+                "snippet": docs[thread_name]["messages"][ind]["snippet"]
+            }
+            for (thread_name, ind), score in best
+        ]
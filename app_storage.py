@@ -0,0 +1,411 @@
+# This code selects the storage backend of the threads
+# Backends:
+#   - "folder" : One json snapshot + journal per thread in the threads folder (see app_journal.py), listed by app_catalog.py
+#   - "sqlite" : All threads in one SQLite database "<thread_folder>/threads.db" (WAL mode), listed by an index on recency
+# Both backends have the same methods, used by app_threads.py:
+#   read(thread_name, thread_folder)                     : {"config": {...}, "messages": [...]} (same as the thread json)
+#   read_range(thread_name, thread_folder, start, end, tail) : {"config", "count", "offset", "messages"}, only a range of messages
+#   write(messages, config, thread_name, thread_folder, offset) : Persist the thread (new messages, updated last message, config)
+#   rename(old_thread_name, new_thread_name, thread_folder) : False if the thread is not found
+#   delete(thread_name, thread_folder, deleted_path)     : Move the thread out as a json file at deleted_path
+#   list_threads(thread_folder)                          : Thread names, latest used first
+#   get_info(thread_name, thread_folder)                 : {"model", "messages", "last_saved"} of the thread without reading it (None if unknown)
+#   exists(thread_name, thread_folder)
+# Backend is selected by configure(), default is "folder".
+# Threads of the folder layout can be copied into the database once, with:
+#   python app_storage.py --threads-folder ./Threads
+
+
+import os
+import json
+import time
+import sqlite3
+import argparse
+import threading
+import app_journal
+import app_catalog
+from contextlib import contextmanager
+
+
+DB_NAME = "threads.db"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS threads (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    config TEXT NOT NULL,
+    message_count INTEGER NOT NULL DEFAULT 0,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS threads_by_recency ON threads (updated DESC);
+CREATE TABLE IF NOT EXISTS messages (
+    thread_id INTEGER NOT NULL REFERENCES threads (id) ON DELETE CASCADE,
+    idx INTEGER NOT NULL,
+    message TEXT NOT NULL,
+    PRIMARY KEY (thread_id, idx)
+) WITHOUT ROWID;
+"""
+
+
+def _dumps(obj):
+    """Compact, stable json used for stored messages (so that they can be compared as text)"""
+    return json.dumps(obj, separators=(",", ":"), sort_keys=True)
+
+
+class FolderStorage:
+    """Threads as json files (snapshot + journal) in the threads folder"""
+
+    name = "folder"
+
+    def read(self, thread_name: str, thread_folder: str):
+        return app_journal.read_thread(thread_name, thread_folder)
+
+    def read_range(self, thread_name: str, thread_folder: str, start: int = None, end: int = None, tail: int = None):
+        return app_journal.read_range(thread_name, thread_folder, start, end, tail)
+
+    def write(self, messages: list[dict], config: dict, thread_name: str, thread_folder: str, offset: int = 0):
+        app_journal.write_thread(
+            messages=messages,
+            config=config,
+            thread_name=thread_name,
+            thread_folder=thread_folder,
+            offset=offset
+        )
+        app_catalog.update_thread(
+            thread_name=thread_name,
+            thread_folder=thread_folder,
+            messages=messages,
+            model_name=config.get("model"),
+            last_saved=config.get("last_saved"),
+            offset=offset
+        )
+
+    def rename(self, old_thread_name: str, new_thread_name: str, thread_folder: str):
+        old_filename, old_journal = app_journal.get_paths(
+            old_thread_name, thread_folder)
+        new_filename, new_journal = app_journal.get_paths(
+            new_thread_name, thread_folder)
+
+        # Files are moved only while no save or compaction of either name is running:
+        with app_journal.hold_threads([old_thread_name, new_thread_name], thread_folder):
+            if not os.path.exists(old_filename):
+                return False
+
+            # Same as the UNIQUE name of the SQLite backend, another thread is never overwritten:
+            if new_thread_name != old_thread_name and self.exists(new_thread_name, thread_folder):
+                raise FileExistsError(
+                    f"Thread already exists: {new_thread_name}")
+
+            os.rename(old_filename, new_filename)
+            if os.path.exists(old_journal):
+                os.rename(old_journal, new_journal)
+
+            old_index = app_journal.get_index_path(
+                old_thread_name, thread_folder)
+            if os.path.exists(old_index):
+                os.rename(old_index, app_journal.get_index_path(
+                    new_thread_name, thread_folder))
+
+            app_journal.forget_thread(old_thread_name, thread_folder)
+            app_journal.forget_thread(new_thread_name, thread_folder)
+
+        app_catalog.rename_thread(
+            old_thread_name, new_thread_name, thread_folder)
+        return True
+
+    def delete(self, thread_name: str, thread_folder: str, deleted_path: str):
+        old_filename, old_journal = app_journal.get_paths(
+            thread_name, thread_folder)
+
+        with app_journal.hold_threads([thread_name], thread_folder):
+            # Move the file (and its journal) to deleted folder
+            if os.path.exists(old_filename):
+                os.rename(old_filename, deleted_path)
+            if os.path.exists(old_journal):
+                os.rename(old_journal, deleted_path + "l")
+
+            # Index is not needed in deleted folder, it is made again if the thread is restored
+            old_index = app_journal.get_index_path(thread_name, thread_folder)
+            if os.path.exists(old_index):
+                os.remove(old_index)
+
+            app_journal.forget_thread(thread_name, thread_folder)
+
+        app_catalog.remove_thread(thread_name, thread_folder)
+
+    def list_threads(self, thread_folder: str):
+        return app_catalog.list_threads(thread_folder)
+
+    def get_info(self, thread_name: str, thread_folder: str):
+        entry = app_catalog.get_entry(thread_name, thread_folder)
+        if entry is None:
+            return None
+        return {"model": entry.get("model"), "messages": entry.get("messages"), "last_saved": entry.get("last_saved")}
+
+    def exists(self, thread_name: str, thread_folder: str):
+        snapshot_path, journal_path = app_journal.get_paths(
+            thread_name, thread_folder)
+        return os.path.exists(snapshot_path) or os.path.exists(journal_path)
+
+
+class SQLiteStorage:
+    """Threads in a SQLite database (WAL mode), one row per message"""
+
+    name = "sqlite"
+
+    def __init__(self):
+        # One connection per database, shared by all the threads (sessions, saver, compaction) and used under the lock,
+        # so no connection (and its WAL reader) is left open by the threads which come and go:
+        self._connections = {}
+        self._lock = threading.RLock()
+
+    @contextmanager
+    def _connect(self, thread_folder: str):
+        """Use the connection to the database of the threads folder (opened on first use), while holding the lock"""
+        db_path = os.path.join(thread_folder, DB_NAME)
+
+        with self._lock:
+            conn = self._connections.get(db_path)
+            if conn is None:
+                conn = sqlite3.connect(
+                    db_path, timeout=30, isolation_level=None, check_same_thread=False)
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("PRAGMA synchronous=NORMAL")
+                conn.execute("PRAGMA foreign_keys=ON")
+                conn.executescript(SCHEMA)
+                self._connections[db_path] = conn
+
+            yield conn
+
+    @contextmanager
+    def _transaction(self, thread_folder: str):
+        """Run the block in a write transaction"""
+        with self._connect(thread_folder) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+
+    def close(self):
+        """Close the connections to the databases"""
+        with self._lock:
+            for conn in self._connections.values():
+                conn.close()
+            self._connections = {}
+
+    def _write(self, conn, messages: list[dict], config: dict, thread_name: str, updated: float, offset: int = 0):
+        """Write the thread inside an open transaction, only new and changed messages are written
+        Messages start at the offset, older ones are kept as they are in the database."""
+        total = offset + len(messages)
+        row = conn.execute(
+            "SELECT id, message_count FROM threads WHERE name = ?", (thread_name,)).fetchone()
+
+        if row is None:
+            if offset:
+                raise ValueError(
+                    "Older messages of the thread are missing in the database")
+            thread_id = conn.execute(
+                "INSERT INTO threads (name, config, message_count, updated) VALUES (?, ?, ?, ?)",
+                (thread_name, _dumps(config), total, updated)
+            ).lastrowid
+            start = 0
+
+        else:
+            thread_id, count = row
+            if count < offset:
+                raise ValueError(
+                    "Older messages of the thread are missing in the database")
+
+            # Messages were removed, write all of the given ones again:
+            if total < count:
+                conn.execute(
+                    "DELETE FROM messages WHERE thread_id = ? AND idx >= ?", (thread_id, total))
+                start = offset
+            else:
+                start = count
+                # Last persisted message may be updated (e.g. partial response completed):
+                if count > offset:
+                    last = conn.execute(
+                        "SELECT message FROM messages WHERE thread_id = ? AND idx = ?", (thread_id, count - 1)).fetchone()
+                    if last is None or last[0] != _dumps(messages[count - 1 - offset]):
+                        start = count - 1
+
+            conn.execute(
+                "UPDATE threads SET config = ?, message_count = ?, updated = ? WHERE id = ?",
+                (_dumps(config), total, updated, thread_id)
+            )
+
+        conn.executemany(
+            "INSERT OR REPLACE INTO messages (thread_id, idx, message) VALUES (?, ?, ?)",
+            [(thread_id, ind, _dumps(messages[ind - offset]))
+             for ind in range(start, total)]
+        )
+
+    def read(self, thread_name: str, thread_folder: str):
+        with self._connect(thread_folder) as conn:
+            row = conn.execute(
+                "SELECT id, config FROM threads WHERE name = ?", (thread_name,)).fetchone()
+            if row is None:
+                raise FileNotFoundError(f"Thread not found: {thread_name}")
+
+            thread_id, config = row
+            messages = [
+                json.loads(message) for (message,) in conn.execute(
+                    "SELECT message FROM messages WHERE thread_id = ? ORDER BY idx", (thread_id,))
+            ]
+        return {"config": json.loads(config), "messages": messages}
+
+    def read_range(self, thread_name: str, thread_folder: str, start: int = None, end: int = None, tail: int = None):
+        with self._connect(thread_folder) as conn:
+            row = conn.execute(
+                "SELECT id, config, message_count FROM threads WHERE name = ?", (thread_name,)).fetchone()
+            if row is None:
+                raise FileNotFoundError(f"Thread not found: {thread_name}")
+
+            thread_id, config, count = row
+            end = count if end is None else min(end, count)
+            start = max(0, end - tail) if tail is not None else (start or 0)
+            start = min(start, end)
+
+            messages = [
+                json.loads(message) for (message,) in conn.execute(
+                    "SELECT message FROM messages WHERE thread_id = ? AND idx >= ? AND idx < ? ORDER BY idx",
+                    (thread_id, start, end))
+            ]
+        return {"config": json.loads(config), "count": count, "offset": start, "messages": messages}
+
+    def write(self, messages: list[dict], config: dict, thread_name: str, thread_folder: str, offset: int = 0):
+        with self._transaction(thread_folder) as conn:
+            self._write(conn, messages, config, thread_name, time.time(), offset)
+
+    def import_threads(self, threads, thread_folder: str):
+        """Write many threads in one transaction
+
+        Args:
+            threads: Iterable of (thread_name, thread json, updated time) tuples
+            thread_folder (str): Folder of the database
+        """
+        with self._transaction(thread_folder) as conn:
+            for thread_name, thread_json, updated in threads:
+                self._write(conn, thread_json.get("messages", []),
+                            thread_json.get("config", {}), thread_name, updated)
+
+    def rename(self, old_thread_name: str, new_thread_name: str, thread_folder: str):
+        with self._transaction(thread_folder) as conn:
+            cursor = conn.execute(
+                "UPDATE threads SET name = ? WHERE name = ?", (new_thread_name, old_thread_name))
+            return cursor.rowcount > 0
+
+    def delete(self, thread_name: str, thread_folder: str, deleted_path: str):
+        # Deleted thread is moved out as json, same as the folder backend, so the deleted folder works with both
+        thread_json = self.read(thread_name, thread_folder)
+        with open(deleted_path + ".tmp", "w") as file:
+            json.dump(thread_json, file, indent=4)
+        os.replace(deleted_path + ".tmp", deleted_path)
+
+        with self._transaction(thread_folder) as conn:
+            conn.execute("DELETE FROM threads WHERE name = ?", (thread_name,))
+
+    def list_threads(self, thread_folder: str):
+        with self._connect(thread_folder) as conn:
+            return [name for (name,) in conn.execute("SELECT name FROM threads ORDER BY updated DESC")]
+
+    def get_info(self, thread_name: str, thread_folder: str):
+        with self._connect(thread_folder) as conn:
+            row = conn.execute(
+                "SELECT config, message_count FROM threads WHERE name = ?", (thread_name,)).fetchone()
+        if row is None:
+            return None
+        config = json.loads(row[0])
+        return {"model": config.get("model"), "messages": row[1], "last_saved": config.get("last_saved")}
+
+    def exists(self, thread_name: str, thread_folder: str):
+        with self._connect(thread_folder) as conn:
+            return conn.execute("SELECT 1 FROM threads WHERE name = ?", (thread_name,)).fetchone() is not None
+
+
+BACKENDS = {
+    "folder": FolderStorage,
+    "sqlite": SQLiteStorage,
+}
+
+_backend = FolderStorage()
+
+
+def configure(backend: str = "folder"):
+    """Select the storage backend of the threads
+
+    Args:
+        backend (str, optional): "folder" or "sqlite". Defaults to "folder".
+    """
+    global _backend
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown storage backend: {backend}")
+
+    if _backend.name != backend:
+        if hasattr(_backend, "close"):
+            _backend.close()
+        _backend = BACKENDS[backend]()
+
+
+def get_backend():
+    """Get the selected storage backend"""
+    return _backend
+
+
+def migrate_folder_to_sqlite(thread_folder: str, batch_size: int = 500):
+    """Copy the threads of the folder layout into the SQLite database (threads already in the database are skipped)
+    Json files are left as they are, so the folder backend still works with them.
+
+    Args:
+        thread_folder (str): Folder where the threads are saved
+        batch_size (int, optional): Threads written per transaction. Defaults to 500.
+
+    Returns:
+        dict: Numbers of migrated, skipped and failed threads
+    """
+    folder = FolderStorage()
+    database = SQLiteStorage()
+
+    existing = set(database.list_threads(thread_folder))
+    result = {"migrated": 0, "skipped": 0, "failed": []}
+    batch = []
+
+    for thread_name in folder.list_threads(thread_folder):
+        if thread_name in existing:
+            result["skipped"] += 1
+            continue
+
+        try:
+            thread_json = folder.read(thread_name, thread_folder)
+            # Recency is kept, so the threads are listed in the same order as before
+            updated = app_journal.get_mtime(thread_name, thread_folder)
+        except (OSError, ValueError) as e:
+            result["failed"].append({"thread_name": thread_name, "message": str(e)})
+            continue
+
+        batch.append((thread_name, thread_json, updated))
+        if len(batch) >= batch_size:
+            database.import_threads(batch, thread_folder)
+            result["migrated"] += len(batch)
+            batch = []
+
+    if batch:
+        database.import_threads(batch, thread_folder)
+        result["migrated"] += len(batch)
+
+    database.close()
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Copy the threads of the folder layout into the SQLite database")
+    parser.add_argument("--threads-folder", type=str, default="./Threads",
+                        help="Folder where the threads are saved")
+    args = parser.parse_args()
+
+    print(json.dumps(migrate_folder_to_sqlite(args.threads_folder), indent=4))
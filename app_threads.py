@@ -1,16 +1,20 @@
 # This code handles the threads in the LocalGPT
 # Image attachment are saved as the file paths in the json files
-# Since thread is loaded form the file only once, base64s will be created and attached in the json->st.session_state.messages at that time
-# But in rest (in the json saved), only the file paths will be saved
-# Now, once thread with base64s is loaded in st, we do not load the json file again and again.
+# Thread in st.session_state.messages also keeps only the file paths, base64s are never stored in it
+# Base64s are created only when the request is sent to the model (prepare_messages_for_model), for the messages going in the request
+# Once thread is loaded in st, we do not load the json file again and again.
 # Instead, st.session_state.messages (thread) is saved repeatedly in the json file
-# So, while saving the thread, we will remove the base64s (file paths remain as it is since they were not updated / removed).
+# Older threads may still have base64s in messages, so, while saving the thread, we remove them.
+# Threads are persisted by the selected storage backend (see app_storage.py), folder of json files by default.
+# With the folder backend, saving only appends the new messages to the thread's journal (see app_journal.py).
 
 
 import os
-import json
+import threading
+import app_search
+import app_storage
 from datetime import datetime
-from app_images import image_list_to_base64
+from app_images import image_list_to_base64, release_images
 
 
 def get_timestamp():
@@ -32,21 +36,32 @@ def get_timestamp_filename():
     return datetime.now().strftime("%d-%m-%Y_%H-%M-%S")
 
 
+# Partial response is checkpointed at most once in these many seconds, or once these many new characters arrive:
+CHECKPOINT_SECONDS = 2.0
+CHECKPOINT_CHARS = 4096
+
+
+# Moving threads into the deleted folder and archiving them from there (see app_archive.py) never run at the same time:
+deleted_lock = threading.Lock()
+
+
 # Read the file "./sample_thread.json" and "./sample_api_call.json" once to understand the structure of the json file and design of save and load functions.
 # Function to save conversation to a file:
 def save_conversation(
         messages: list[dict],
         thread_name: str,
         model_name: str,
-        thread_folder: str
+        thread_folder: str,
+        offset: int = 0
 ):
-    """Save the conversation to a json file and update the config in same file with the last used model name
+    """Save the conversation in the storage backend and update the config with the last used model name
 
     Args:
         messages (list[dict]): List of messages to save
         thread_name (str): Name of the thread to save
         model_name (str): Name of the model used in the thread
         thread_folder (str): Folder where the thread is saved
+        offset (int, optional): Index of the first message, when only the latest messages were loaded. Defaults to 0.
 
     Returns:
         dict: Dictionary containing the status of the saving
@@ -59,17 +74,25 @@ def save_conversation(
             if message.get("role") == "user" and "images" in message:
                 del message["images"]
 
-        json_to_save = {
-            "config": {
-                "model": model_name,
-                "last_saved": ts
-            },
-            "messages": messages
+        config = {
+            "model": model_name,
+            "last_saved": ts
         }
 
-        filename = f"{thread_folder}/{thread_name}.json"
-        with open(filename, "w") as file:
-            json.dump(json_to_save, file, indent=4)
+        app_storage.get_backend().write(
+            messages=messages,
+            config=config,
+            thread_name=thread_name,
+            thread_folder=thread_folder,
+            offset=offset
+        )
+
+        app_search.update_thread(
+            thread_name=thread_name,
+            thread_folder=thread_folder,
+            messages=messages,
+            offset=offset
+        )
 
         return {"status": "success", "timestamp": ts}
 
@@ -77,64 +100,141 @@ def save_conversation(
         return {"status": "error", "message": f"Failed to save thread. \n\n {str(e)}"}
 
 
+# Message of the partial response while it is being generated:
+def make_partial_message(partial_response: str):
+    """Build the assistant message of the partial response, marked as incomplete
+    It is checkpointed on a throttle (CHECKPOINT_SECONDS / CHECKPOINT_CHARS) while streaming, and kept if the response is cut.
+    Since only the changed last message is written again, repeated checkpoints are cheap.
+
+    Args:
+        partial_response (str): Response generated till now
+
+    Returns:
+        dict: Assistant message with the incomplete flag
+    """
+    return {
+        "role": "assistant",
+        "content": partial_response,
+        "incomplete": True
+    }
+
+
 # function to load conversation from a file:
-def load_conversation(thread_name: str, thread_folder: str, image_folder: str):
-    """Load the conversation from a json file and set the model to the last used model
+def load_conversation(thread_name: str, thread_folder: str, image_folder: str, tail: int = None):
+    """Load the conversation from the storage backend and set the model to the last used model
 
     Args:
         thread_name (str): Name of the thread to load
         thread_folder (str): Folder where the thread is saved
         image_folder (str): Folder where the images are saved under threads' folders
+        tail (int, optional): Load only the latest these many messages (older ones by load_messages). Defaults to None (all).
 
     Returns:
-        dict: Dictionary containing the messages, thread name, model name and last saved timestamp
+        dict: Dictionary containing the messages, thread name, model name, last saved timestamp,
+              offset (index of the first loaded message) and total message count
     """
 
     try:
-        filename = f"{thread_folder}/{thread_name}.json"
-
-        with open(filename, "r") as file:
-            thread_json = json.load(file)
+        thread_json = app_storage.get_backend().read_range(
+            thread_name=thread_name,
+            thread_folder=thread_folder,
+            tail=tail
+        )
 
         last_saved = thread_json.get("config", {}).get(
             "last_saved", get_timestamp())
         model_name = thread_json.get("config", {}).get("model", None)
         messages = thread_json.get("messages", [])
 
-        # Add base64 images to the messages based on the image file paths:
-        for message in messages:
-            if message.get("role") == "user" and "image_files" in message:
-                resp = image_list_to_base64(
-                    image_list=message["image_files"],
-                    image_folder=image_folder,
-                    thread_name=thread_name
-                )
-
-                if resp["status"] == "success":
-                    message["images"] = resp["result"]
-                else:
-                    # If there is error in processing some single image, return the error message of that image as it is
-                    return resp
-
+        # Images are not converted here, only when the request is sent (see prepare_messages_for_model)
         return {
             "status": "success",
             "messages": messages,
             "thread_name": thread_name,
             "model_name": model_name,
-            "last_saved": last_saved
+            "last_saved": last_saved,
+            "offset": thread_json["offset"],
+            "message_count": thread_json["count"]
         }
 
     except Exception as e:
         return {"status": "error", "message": f"Failed to load thread. \n\n {str(e)}"}
 
 
+# Load the older messages of the partially loaded thread:
+def load_messages(thread_name: str, thread_folder: str, start: int, end: int):
+    """Load a range of messages of the thread (only that part is read, if storage has an index of the thread)
+
+    Args:
+        thread_name (str): Name of the thread
+        thread_folder (str): Folder where the thread is saved
+        start (int): Index of the first message to load
+        end (int): Index after the last message to load
+
+    Returns:
+        dict: Dictionary containing the status and the messages
+    """
+
+    try:
+        thread_json = app_storage.get_backend().read_range(
+            thread_name=thread_name,
+            thread_folder=thread_folder,
+            start=start,
+            end=end
+        )
+        return {"status": "success", "messages": thread_json["messages"], "offset": thread_json["offset"]}
+
+    except Exception as e:
+        return {"status": "error", "message": f"Failed to load messages. \n\n {str(e)}"}
+
+
+# Build the messages for the model request:
+def prepare_messages_for_model(messages: list[dict], image_folder: str, thread_name: str, model_name: str = None):
+    """Build the messages to send to the model, base64 images are attached only here (from the image file paths)
+
+    Args:
+        messages (list[dict]): Messages going in the request
+        image_folder (str): Folder where the images are saved under threads' folders
+        thread_name (str): Name of the thread
+        model_name (str, optional): Model of the request, images are downscaled for it. Defaults to None.
+
+    Returns:
+        dict: Dictionary containing the status and the messages for the model
+    """
+
+    request_messages = []
+    for message in messages:
+        request_message = {
+            "role": message["role"],
+            "content": message["content"]
+        }
+
+        if message.get("role") == "user" and message.get("image_files"):
+            resp = image_list_to_base64(
+                image_list=message["image_files"],
+                image_folder=image_folder,
+                thread_name=thread_name,
+                model_name=model_name
+            )
+
+            if resp["status"] == "error":
+                # If there is error in processing some single image, return the error message of that image as it is
+                return resp
+
+            request_message["images"] = resp["result"]
+
+        request_messages.append(request_message)
+
+    return {"status": "success", "messages": request_messages}
+
+
 # Rename the thread file:
 def rename_thread(
         old_thread_name: str,
         new_thread_name: str,
         thread_folder: str,
 ):
-    """Rename the thread and its json file
+    """Rename the thread (and its json file, with the folder backend)
 
     Args:
         old_thread_name (str): Old name of the thread
@@ -146,11 +246,9 @@ def rename_thread(
     """
 
     try:
-        old_filename = f"{thread_folder}/{old_thread_name}.json"
-        new_filename = f"{thread_folder}/{new_thread_name}.json"
-
-        if os.path.exists(old_filename):
-            os.rename(old_filename, new_filename)
+        if app_storage.get_backend().rename(old_thread_name, new_thread_name, thread_folder):
+            app_search.rename_thread(
+                old_thread_name, new_thread_name, thread_folder)
             return {"status": "success"}
         else:
             return {"status": "error", "message": "Thread not found"}
@@ -161,7 +259,7 @@ def rename_thread(
 
 # Load thread names by latest first order:
 def load_thread_names(thread_folder: str):
-    """Load all the thread names present in the Threads folder, based on the last modified time of the file
+    """Load all the thread names present in the Threads folder, latest used first (served from the storage backend's index)
 
     Args:
         thread_folder (str): Folder where the threads are saved
@@ -170,19 +268,22 @@ def load_thread_names(thread_folder: str):
         list: List of thread names
     """
 
-    thread_names = []
-    files = []
-    for file in os.listdir(thread_folder):
-        if file.endswith(".json"):
-            files.append(file)
+    return app_storage.get_backend().list_threads(thread_folder)
 
-    files.sort(key=lambda x: os.path.getmtime(
-        f"{thread_folder}/{x}"), reverse=True)
 
-    for file in files:
-        thread_names.append(file.split(".")[0])
+# Details of the thread shown in the list, without loading it:
+def get_thread_info(thread_name: str, thread_folder: str):
+    """Get the last used model, number of messages and last saved timestamp of the thread (from the storage backend's index)
 
-    return thread_names
+    Args:
+        thread_name (str): Name of the thread
+        thread_folder (str): Folder where the threads are saved
+
+    Returns:
+        dict: Dictionary with model, messages and last_saved (None if the thread is not found)
+    """
+
+    return app_storage.get_backend().get_info(thread_name, thread_folder)
 
 
 # Delete the thread:
@@ -207,30 +308,40 @@ def delete_thread(
     """
 
     try:
-        old_filename = f"{thread_folder}/{thread_name}.json"
-        new_filename = f"{deleted_threads_folder}/{thread_name}.json"
+        # Archiver does not pick the thread up till both its file and its images are moved:
+        with deleted_lock:
+            deleted_name = thread_name
 
-        # If file already exists in deleted folder, add timestamp to new filename:
-        if os.path.exists(new_filename):
-            new_filename = f"{deleted_threads_folder}/{thread_name}_{get_timestamp_filename()}.json"
+            # If file already exists in deleted folder, add timestamp to new filename:
+            if os.path.exists(f"{deleted_threads_folder}/{deleted_name}.json"):
+                deleted_name = f"{thread_name}_{get_timestamp_filename()}"
 
-        # Move the file to deleted folder
-        if os.path.exists(old_filename):
-            os.rename(old_filename, new_filename)
+            new_filename = f"{deleted_threads_folder}/{deleted_name}.json"
 
-        # Move the thread's images folder to deleted folder:
-        old_image_folder = f"{image_folder}/{thread_name}"
-        new_image_folder = f"{deleted_images_folder}/{thread_name}/"
+            # Move the thread to deleted folder (as json file, whichever the backend)
+            app_storage.get_backend().delete(thread_name, thread_folder, new_filename)
+            app_search.remove_thread(thread_name, thread_folder)
 
-        if not os.path.exists(new_image_folder):
-            os.makedirs(new_image_folder)
+            # Move the thread's images folder to deleted folder (named same as the deleted json, so they stay together):
+            old_image_folder = f"{image_folder}/{thread_name}"
+            new_image_folder = f"{deleted_images_folder}/{deleted_name}/"
+
+            if not os.path.exists(new_image_folder):
+                os.makedirs(new_image_folder)
+
+            if os.path.exists(old_image_folder):
+                # Thread does not refer to its blobs anymore, blobs which no other thread uses are removed
+                # (deleted copies are links of the same content, so they stay readable till they are archived)
+                release_images(
+                    image_paths=[f"{old_image_folder}/{file}" for file in os.listdir(old_image_folder)],
+                    image_folder=image_folder
+                )
 
-        if os.path.exists(old_image_folder):
-            for file in os.listdir(old_image_folder):
-                os.rename(f"{old_image_folder}/{file}",
-                          f"{new_image_folder}/{file}")
+                for file in os.listdir(old_image_folder):
+                    os.rename(f"{old_image_folder}/{file}",
+                              f"{new_image_folder}/{file}")
 
-            os.rmdir(old_image_folder)
+                os.rmdir(old_image_folder)
 
         return {"status": "success"}
 
@@ -244,7 +355,7 @@ def create_new_thread(thread_folder: str):
     thread_name = f"New Thread"
 
     # Check the thread folder if thread_name already exists, if yes, add timestamp to the new thread name
-    if f"{thread_folder}/{thread_name}.json" in os.listdir(thread_folder):
+    if app_storage.get_backend().exists(thread_name, thread_folder):
         thread_name = f"New Thread {get_timestamp_filename()}"
 
     return thread_name
@@ -0,0 +1,281 @@
+# Headless batch mode of LocalGPT, runs prompts from a JSONL file without the Streamlit UI
+# Every prompt becomes a thread (same format as the app), so the results can be opened later in the app as well
+# Each line of the input file is a json object like:
+#   {"prompt": "Describe this image", "images": ["/abs/path/img.png"], "model": "llava:latest", "thread": "name"}
+# Only "prompt" is required, images can also be given in the prompt itself as +++{image: [...]}+++ (same as in the app)
+# Run it like:
+#   python batch.py prompts.jsonl --model llama3.1:latest --workers 4 --summary summary.json
+
+
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+import statistics
+import app_images
+import app_models
+import app_context
+import app_metrics
+import app_threads
+import app_storage
+import app_reasoning
+import app_scheduler
+from concurrent.futures import ThreadPoolExecutor
+
+
+def read_jobs(input_file: str):
+    """Read the prompts from the JSONL file
+
+    Args:
+        input_file (str): Path of the JSONL file
+
+    Yields:
+        tuple: (line number, job dict, error message) - job is None if the line is not a valid job
+    """
+    with open(input_file, "r") as file:
+        for line_no, line in enumerate(file, start=1):
+            line = line.strip()
+            if not line:
+                continue
+
+            # One malformed line is reported in the results, rest of the batch still runs:
+            try:
+                job = json.loads(line)
+            except ValueError as e:
+                yield line_no, None, f"Invalid json on line {line_no}: {str(e)}"
+                continue
+
+            if not isinstance(job, dict):
+                yield line_no, None, f"Line {line_no} is not a json object"
+                continue
+
+            yield line_no, job, None
+
+
+def run_job(line_no: int, job: dict, args, folder: dict):
+    """Run one prompt through the model and save it as a thread
+
+    Returns:
+        dict: Result of the job (status, thread name, latency and metrics)
+    """
+    start_time = time.perf_counter()
+    model_name = job.get("model", args.model)
+    thread_name = job.get("thread", f"{args.thread_prefix} {line_no:05d}")
+
+    try:
+        prompt = job["prompt"]
+        image_list = job.get("images", [])
+
+        # Images can also be given in the prompt itself, same as in the app:
+        if app_images.check_if_image_in_prompt(prompt):
+            parsed = app_images.parse_images_from_prompt(prompt)
+            if parsed["status"] == "error":
+                raise ValueError(parsed["message"])
+            prompt = parsed["prompt"]
+            image_list = image_list + parsed["image_list"]
+
+        user_msg = {"role": "user", "content": prompt}
+
+        if image_list:
+            resp = app_images.save_images_locally(
+                image_list=image_list,
+                image_folder=folder["images"],
+                thread_name=thread_name,
+                model_name=model_name
+            )
+            if resp["status"] != "success":
+                raise ValueError(f"{resp['message']} for `{resp['path']}`")
+
+            user_msg["mimes"] = [app_images.get_mime_type(image)
+                                 for image in resp["image_list"]]
+            user_msg["image_files"] = resp["image_list"]
+
+        messages = []
+        if job.get("system"):
+            messages.append({"role": "system", "content": job["system"]})
+        messages.append(user_msg)
+
+        context = app_context.build_context(
+            messages, model_name, num_ctx=args.options.get("num_ctx"))
+        request = app_threads.prepare_messages_for_model(
+            messages=context["messages"],
+            image_folder=folder["images"],
+            thread_name=thread_name,
+            model_name=model_name
+        )
+        if request["status"] == "error":
+            raise ValueError(f"{request['message']} for `{request['path']}`")
+
+        with app_scheduler.scheduler.slot(model_name):
+            response = app_models.client.chat(
+                model=model_name,
+                messages=request["messages"],
+                stream=False,
+                options=app_context.request_options(
+                    args.options, context["budget"]),
+            )
+
+        reasoning, answer = app_reasoning.split_reasoning(
+            response["message"]["content"])
+        metrics = app_metrics.collect_metrics(
+            final_chunk=response, model_name=model_name, ttft=None)
+
+        ai_msg = {"role": "assistant", "content": answer, "metrics": metrics}
+        if reasoning:
+            ai_msg["reasoning"] = reasoning
+        messages.append(ai_msg)
+
+        saved = app_threads.save_conversation(
+            messages=messages,
+            thread_name=thread_name,
+            model_name=model_name,
+            thread_folder=folder["threads"]
+        )
+        if saved["status"] == "error":
+            raise ValueError(saved["message"])
+
+        return {
+            "line": line_no,
+            "status": "success",
+            "thread_name": thread_name,
+            "latency": time.perf_counter() - start_time,
+            "metrics": metrics,
+        }
+
+    except Exception as e:
+        return {
+            "line": line_no,
+            "status": "error",
+            "thread_name": thread_name,
+            "latency": time.perf_counter() - start_time,
+            "message": str(e),
+        }
+
+
+def summarize(results: list, wall_time: float):
+    """Summary of the batch, with throughput numbers
+
+    Args:
+        results (list): Results of all the jobs
+        wall_time (float): Seconds taken by the whole batch
+
+    Returns:
+        dict: Summary of the batch
+    """
+    done = [r for r in results if r["status"] == "success"]
+    latencies = sorted(r["latency"] for r in done)
+    eval_tokens = sum(r["metrics"]["eval_count"] or 0 for r in done)
+    prompt_tokens = sum(r["metrics"]["prompt_eval_count"] or 0 for r in done)
+
+    def pct(p):
+        if not latencies:
+            return None
+        return latencies[min(len(latencies) - 1, int(p / 100 * len(latencies)))]
+
+    return {
+        "total": len(results),
+        "succeeded": len(done),
+        "failed": len(results) - len(done),
+        "wall_time_s": wall_time,
+        "prompts_per_s": len(done) / wall_time if wall_time else None,
+        "generated_tokens": eval_tokens,
+        "generated_tokens_per_s": eval_tokens / wall_time if wall_time else None,
+        "prompt_tokens": prompt_tokens,
+        "latency_mean_s": statistics.mean(latencies) if latencies else None,
+        "latency_p50_s": pct(50),
+        "latency_p90_s": pct(90),
+        "latency_p99_s": pct(99),
+        "errors": [
+            {"line": r["line"], "message": r["message"]}
+            for r in results if r["status"] == "error"
+        ],
+    }
+
+
+def run_batch(args):
+    """Run all the prompts of the input file with a bounded pool of workers"""
+    folder = {
+        "threads": args.threads_folder,
+        "images": os.path.join(args.threads_folder, "images"),
+    }
+    for path in folder.values():
+        os.makedirs(path, exist_ok=True)
+
+    # Threads are saved in the same storage backend as the app uses, so they are listed there:
+    app_storage.configure(args.storage)
+
+    # Scheduler allows as many requests as workers, on one model as well unless it is limited:
+    app_scheduler.scheduler.max_global = args.workers
+    app_scheduler.scheduler.max_per_model = args.per_model or args.workers
+
+    results = []
+    results_lock = threading.Lock()
+    # Only a few jobs are read ahead of the workers, so huge input files are not loaded at once
+    in_flight = threading.BoundedSemaphore(args.workers * 2)
+
+    def add_result(result):
+        with results_lock:
+            results.append(result)
+            if not args.quiet:
+                status = "ok " if result["status"] == "success" else "ERR"
+                print(f"[{len(results)}] {status} line {result['line']} -> {result['thread_name'] or '-'} ({result['latency']:.1f}s)",
+                      file=sys.stderr)
+
+    def on_done(future):
+        in_flight.release()
+        add_result(future.result())
+
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        for line_no, job, error in read_jobs(args.input):
+            if error:
+                add_result({"line": line_no, "status": "error", "thread_name": None,
+                            "latency": 0.0, "message": error})
+                continue
+
+            in_flight.acquire()
+            future = pool.submit(run_job, line_no, job, args, folder)
+            future.add_done_callback(on_done)
+
+    return summarize(results, time.perf_counter() - start_time)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Run prompts from a JSONL file through a local model, results are saved as LocalGPT threads")
+    parser.add_argument("input", type=str,
+                        help="JSONL file with one prompt per line")
+    parser.add_argument("--model", type=str, default="llama3.1:latest",
+                        help="Model for the prompts which do not name one")
+    parser.add_argument("--workers", type=int, default=2,
+                        help="Prompts running at the same time")
+    parser.add_argument("--per-model", type=int, default=None,
+                        help="Prompts running at the same time on one model (default: same as --workers)")
+    parser.add_argument("--threads-folder", type=str, default="./Threads",
+                        help="Folder where the threads are saved")
+    parser.add_argument("--storage", type=str, choices=sorted(app_storage.BACKENDS),
+                        default=os.environ.get("LOCALGPT_STORAGE", "folder"),
+                        help="Storage backend of the threads (default from LOCALGPT_STORAGE, same as the app)")
+    parser.add_argument("--thread-prefix", type=str, default=f"Batch {app_threads.get_timestamp_filename()}",
+                        help="Name prefix of the created threads")
+    parser.add_argument("--temperature", type=float, default=None,
+                        help="Temperature of the model (default of model if not given)")
+    parser.add_argument("--seed", type=int, default=None,
+                        help="Seed of the model")
+    parser.add_argument("--summary", type=str, default=None,
+                        help="Also write the summary json to this file")
+    parser.add_argument("--quiet", action="store_true",
+                        help="Do not print the progress")
+    args = parser.parse_args()
+
+    args.options = {key: value for key, value in
+                    {"temperature": args.temperature, "seed": args.seed}.items() if value is not None}
+
+    summary = run_batch(args)
+    print(json.dumps(summary, indent=4))
+
+    if args.summary:
+        with open(args.summary, "w") as file:
+            json.dump(summary, file, indent=4)
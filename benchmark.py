@@ -0,0 +1,231 @@
+# Micro-benchmarks of the thread and image modules (app_threads, app_images)
+# Synthetic threads and images are generated in a temporary folder, so real threads are never touched
+# Run it like:
+#   python benchmark.py
+#   python benchmark.py --threads 1000 --messages 500 --images 20 --image-kb 2048 --repeat 50
+#   python benchmark.py --storage sqlite
+# Reports the throughput (ops/s) and the latency percentiles (ms) per operation.
+
+
+import os
+import sys
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import statistics
+import app_images
+import app_storage
+import app_threads
+
+
+def percentile(values: list, pct: float):
+    """Get the percentile of the values (nearest rank)"""
+    ordered = sorted(values)
+    ind = max(0, min(len(ordered) - 1, round(pct / 100 * len(ordered)) - 1))
+    return ordered[ind]
+
+
+def measure(name: str, fn, repeat: int, results: list):
+    """Run the function repeat times and collect its timings
+
+    Args:
+        name (str): Name of the operation
+        fn (callable): Function to measure, called with the index of run
+        repeat (int): Number of runs
+        results (list): List where the result row is appended
+    """
+    timings = []
+    for ind in range(repeat):
+        start = time.perf_counter()
+        fn(ind)
+        timings.append(time.perf_counter() - start)
+
+    total = sum(timings)
+    results.append({
+        "operation": name,
+        "runs": repeat,
+        "ops_per_s": repeat / total if total else float("inf"),
+        "mean_ms": statistics.mean(timings) * 1000,
+        "p50_ms": percentile(timings, 50) * 1000,
+        "p90_ms": percentile(timings, 90) * 1000,
+        "p99_ms": percentile(timings, 99) * 1000,
+    })
+
+
+def make_messages(count: int, image_files: list = None):
+    """Generate the synthetic conversation"""
+    messages = [{"role": "assistant", "content": "Hello 👋, How may I help you?"}]
+    for ind in range(count // 2):
+        user_msg = {"role": "user",
+                    "content": f"Question {ind} " + "lorem ipsum " * 20}
+        if image_files and ind == 0:
+            user_msg["image_files"] = image_files
+        messages.append(user_msg)
+        messages.append({"role": "assistant",
+                         "content": f"Answer {ind} " + "dolor sit amet " * 60})
+    return messages
+
+
+def make_images(folder: str, count: int, size_kb: int):
+    """Generate the synthetic image files (random bytes, with png extension)"""
+    os.makedirs(folder, exist_ok=True)
+    paths = []
+    for ind in range(count):
+        path = os.path.join(folder, f"image_{ind}.png")
+        with open(path, "wb") as file:
+            file.write(os.urandom(size_kb * 1024))
+        paths.append(path)
+    return paths
+
+
+def run(args):
+    """Generate the data and run all the benchmarks"""
+    root = tempfile.mkdtemp(prefix="localgpt_bench_")
+    folder = {
+        "threads": os.path.join(root, "Threads"),
+        "deleted_threads": os.path.join(root, "Threads", "deleted"),
+        "images": os.path.join(root, "Threads", "images"),
+        "deleted_images": os.path.join(root, "Threads", "deleted", "images"),
+    }
+    for path in folder.values():
+        os.makedirs(path, exist_ok=True)
+
+    results = []
+    random.seed(args.seed)
+    app_storage.configure(args.storage)
+
+    try:
+        # Data:
+        source_images = make_images(
+            os.path.join(root, "source"), args.images, args.image_kb)
+
+        print(f"Generating {args.threads} threads of {args.messages} messages in {root} ...")
+        for ind in range(args.threads):
+            app_threads.save_conversation(
+                messages=make_messages(args.messages),
+                thread_name=f"thread_{ind}",
+                model_name="bench:latest",
+                thread_folder=folder["threads"]
+            )
+
+        # Images:
+        saved = {}
+
+        def save_images(ind):
+            resp = app_images.save_images_locally(
+                image_list=source_images,
+                image_folder=folder["images"],
+                thread_name=f"thread_{ind % args.threads}"
+            )
+            saved[ind % args.threads] = resp["image_list"]
+
+        measure("save_images_locally", save_images, args.repeat, results)
+
+        def to_base64(ind):
+            thread_ind = random.choice(list(saved))
+            app_images.image_list_to_base64(
+                image_list=saved[thread_ind],
+                image_folder=folder["images"],
+                thread_name=f"thread_{thread_ind}"
+            )
+
+        app_images.base64_cache.clear()
+        measure("image_list_to_base64 (cold)", lambda ind: (
+            app_images.base64_cache.clear(), to_base64(ind)), args.repeat, results)
+        measure("image_list_to_base64 (cached)", to_base64, args.repeat, results)
+
+        # Threads:
+        conversations = {}
+
+        def save_turn(ind):
+            thread_ind = ind % args.threads
+            messages = conversations.setdefault(
+                thread_ind, make_messages(args.messages))
+            messages.append({"role": "user", "content": f"Follow up {ind}"})
+            messages.append({"role": "assistant", "content": "Reply " * 50})
+            app_threads.save_conversation(
+                messages=messages,
+                thread_name=f"thread_{thread_ind}",
+                model_name="bench:latest",
+                thread_folder=folder["threads"]
+            )
+
+        measure("save_conversation (new turn)", save_turn, args.repeat, results)
+
+        measure("load_conversation", lambda ind: app_threads.load_conversation(
+            thread_name=f"thread_{random.randrange(args.threads)}",
+            thread_folder=folder["threads"],
+            image_folder=folder["images"]
+        ), args.repeat, results)
+
+        measure("load_conversation (latest 20)", lambda ind: app_threads.load_conversation(
+            thread_name=f"thread_{random.randrange(args.threads)}",
+            thread_folder=folder["threads"],
+            image_folder=folder["images"],
+            tail=20
+        ), args.repeat, results)
+
+        measure("load_thread_names", lambda ind: app_threads.load_thread_names(
+            thread_folder=folder["threads"]
+        ), args.repeat, results)
+
+        delete_count = min(args.repeat, args.threads)
+        measure("delete_thread", lambda ind: app_threads.delete_thread(
+            thread_name=f"thread_{ind}",
+            thread_folder=folder["threads"],
+            deleted_threads_folder=folder["deleted_threads"],
+            image_folder=folder["images"],
+            deleted_images_folder=folder["deleted_images"]
+        ), delete_count, results)
+
+    finally:
+        if not args.keep:
+            shutil.rmtree(root, ignore_errors=True)
+
+    return results
+
+
+def print_results(results: list, out=sys.stdout):
+    """Print the results as a table"""
+    header = f"{'operation':<32}{'runs':>6}{'ops/s':>10}{'mean ms':>10}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}"
+    print(header, file=out)
+    print("-" * len(header), file=out)
+    for row in results:
+        print(
+            f"{row['operation']:<32}{row['runs']:>6}{row['ops_per_s']:>10.1f}"
+            f"{row['mean_ms']:>10.2f}{row['p50_ms']:>10.2f}{row['p90_ms']:>10.2f}{row['p99_ms']:>10.2f}",
+            file=out
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Micro-benchmarks of thread and image storage of LocalGPT")
+    parser.add_argument("--threads", type=int, default=200,
+                        help="Number of synthetic threads")
+    parser.add_argument("--messages", type=int, default=100,
+                        help="Messages per thread")
+    parser.add_argument("--images", type=int, default=5,
+                        help="Images attached per prompt")
+    parser.add_argument("--image-kb", type=int, default=512,
+                        help="Size of each image (KB)")
+    parser.add_argument("--repeat", type=int, default=50,
+                        help="Runs per operation")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Random seed")
+    parser.add_argument("--storage", type=str, default="folder", choices=list(app_storage.BACKENDS),
+                        help="Storage backend of the threads")
+    parser.add_argument("--keep", action="store_true",
+                        help="Keep the generated folder")
+    parser.add_argument("--output", type=str, default=None,
+                        help="Also write the results to this file")
+    args = parser.parse_args()
+
+    results = run(args)
+    print_results(results)
+
+    if args.output:
+        with open(args.output, "w") as file:
+            print_results(results, out=file)
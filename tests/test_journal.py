@@ -0,0 +1,35 @@
+# Tests of the journaled thread storage (app_journal.py)
+# Run from the repository root with:
+#   python -m pytest -q
+
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app_journal
+
+
+def messages(count: int):
+    return [{"role": "user", "content": f"m{ind}"} for ind in range(count)]
+
+
+def test_saves_after_torn_journal_tail(tmp_path):
+    thread_folder = str(tmp_path)
+    app_journal.write_thread(messages(1), {"model": "test"}, "t", thread_folder)
+    app_journal.write_thread(messages(2), {"model": "test"}, "t", thread_folder)
+
+    # App was killed while appending:
+    _, journal_path = app_journal.get_paths("t", thread_folder)
+    with open(journal_path, "a") as file:
+        file.write('{"i": 2, "mess')
+
+    # Restart (cached state is gone), then more saves:
+    app_journal.forget_thread("t", thread_folder)
+    app_journal.write_thread(messages(3), {"model": "test"}, "t", thread_folder)
+    app_journal.write_thread(messages(4), {"model": "test"}, "t", thread_folder)
+
+    app_journal.forget_thread("t", thread_folder)
+    thread_json = app_journal.read_thread("t", thread_folder)
+    assert thread_json["messages"] == messages(4)
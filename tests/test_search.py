@@ -0,0 +1,41 @@
+# Tests of the full text search index (app_search.py)
+# Run from the repository root with:
+#   python -m pytest -q
+
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app_search
+import app_threads
+
+
+def save(thread_name: str, contents: list[str], thread_folder: str):
+    messages = [{"role": "user", "content": content} for content in contents]
+    resp = app_threads.save_conversation(
+        messages=messages,
+        thread_name=thread_name,
+        model_name="test:latest",
+        thread_folder=thread_folder
+    )
+    assert resp["status"] == "success"
+
+
+def test_rename_onto_existing_thread(tmp_path):
+    thread_folder = str(tmp_path)
+    save("old", ["apples and pears"], thread_folder)
+    save("taken", ["bananas", "more bananas", "apples too"], thread_folder)
+
+    # Storage refuses it, but an index renamed onto an indexed name must stay searchable:
+    assert app_threads.rename_thread("old", "taken", thread_folder)["status"] == "error"
+    app_search.rename_thread("old", "taken", thread_folder)
+
+    hits = app_search.search("bananas apples", thread_folder)
+    assert [(hit["thread_name"], hit["index"]) for hit in hits] == [("taken", 0)]
+
+    # Same state is rebuilt from the log after a restart ("old" is still in storage, so it is indexed again):
+    app_search._indexes.pop(thread_folder)
+    hits = app_search.search("bananas apples", thread_folder)
+    assert [hit["index"] for hit in hits if hit["thread_name"] == "taken"] == [0]